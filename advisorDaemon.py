@@ -0,0 +1,371 @@
+'''
+A long running deck advisor answering queries over localhost HTTP
+
+'''
+
+import os
+import json
+import heapq
+import operator
+import time
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from hearthstone.enums import CardClass
+import deckAdvisor
+from deckcache import DeckCache
+from filtercache import FilterCache
+from incremental import IncrementalScorer
+
+def fileState(path):
+    """Return (mtime, size) of PATH, or None if it doesn't exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+def parseCardClass(value):
+    """Parse a class query parameter, a CardClass name (eg. MAGE) or number, into a CardClass
+    """
+    if value.isdigit():
+        return CardClass(int(value))
+    return CardClass[value.upper()]
+
+class AdvisorState:
+    """The card database, the collection and the scored deck list, kept in memory
+    The deck list follows the collection through an IncrementalScorer, so a
+    collection update re-scores only the decks containing the changed cards.
+    The lacked and already-have card totals behind the wanted and useless
+    reports are kept up to date the same way. All the methods are serialized
+    by a lock.
+    """
+    def __init__(self, cardDefs, deckJSONFile, collectionFile, collectionDeckstringFile=None,
+                 dateLimit="01/05/2015", ratingLimit=5, filterCacheDir="cache/filtered",
+                 deckCacheFile="cache/deckstrings.cache", workers=1):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          cardDefs: The CardDefs.xml file
+          deckJSONFile: The deck json file produced by the crawler
+          collectionFile: The mycards.csv file, updates of the collection are written into it
+          collectionDeckstringFile: The deckstring file to init the collection from if collectionFile doesn't exist
+          dateLimit, ratingLimit: The deck filters, see calculateLacksFromJSONFile()
+          filterCacheDir: The directory of the FilterCache
+          deckCacheFile: The DeckCache file
+          workers: The number of processes to ingest the deck json file with
+        """
+        self.deckJSONFile = deckJSONFile
+        self.collectionFile = collectionFile
+        self.collectionDeckstringFile = collectionDeckstringFile
+        self.dateLimit = dateLimit
+        self.ratingLimit = ratingLimit
+        self.workers = workers
+        self.lock = threading.RLock()
+        self.db = deckAdvisor.initDatabaseFromXml(cardDefs)
+        self.deckCache = DeckCache(deckCacheFile)
+        self.filterCache = FilterCache(filterCacheDir)
+        self.collection = None # The card collection
+        self.scorer = None # The IncrementalScorer of the deck list
+        self.partitions = {} # The partitions of the deck list, see partitionDecks()
+        self.version = 0 # Increased on every change of the results
+        self.lackedTotals = {} # card id -> the lacked count summed over all the decks
+        self.haveTotals = {} # card id -> the already-have count summed over all the decks
+        self.fileStates = {} # path -> (mtime, size) when it's loaded
+        self.loadCollection()
+        self.loadDecks()
+
+    def loadCollection(self):
+        """Load the collection from its file, updating the current one in place if there is one
+        """
+        with self.lock:
+            if os.path.exists(self.collectionFile) or self.collectionDeckstringFile == None:
+                path = self.collectionFile
+            else:
+                path = self.collectionDeckstringFile
+            collection = deckAdvisor.loadCollection(path, self.deckCache)
+            self.fileStates[path] = fileState(path)
+            if self.collection == None:
+                self.collection = collection
+                return
+            changes = []
+            for card in set(self.collection.collect_db) | set(collection.collect_db):
+                diff = collection.ows(card) - self.collection.ows(card)
+                if diff != 0:
+                    changes.append((card, diff))
+            self.updateCollection(changes, save=False)
+
+    def loadDecks(self):
+        """Ingest the deck json file and score it with the collection
+        """
+        with self.lock:
+            self.fileStates[self.deckJSONFile] = fileState(self.deckJSONFile)
+            deckList = deckAdvisor.calculateLacksCached(self.deckJSONFile, self.collection, self.db, self.filterCache,
+                                                        self.dateLimit, self.ratingLimit, batch=True,
+                                                        deckCache=self.deckCache, workers=self.workers)
+            self.deckCache.save()
+            if self.scorer != None:
+                self.scorer.close()
+            self.scorer = IncrementalScorer(self.collection, self.db, deckList)
+            self.partitions = deckAdvisor.partitionDecks(self.scorer.deckList)
+            self.lackedTotals = {}
+            self.haveTotals = {}
+            self.countCards(range(len(deckList)), 1)
+            self.version += 1
+
+    def countCards(self, deckIds, sign):
+        """Add (SIGN=1) or subtract (SIGN=-1) the cards of some decks to the card totals
+        """
+        deckList = self.scorer.deckList
+        for deckId in deckIds:
+            for card, count in deckList[deckId]['lacked']:
+                self.lackedTotals[card] = self.lackedTotals.get(card, 0) + sign * count
+            for card, count in deckList[deckId]['alreadyHave']:
+                self.haveTotals[card] = self.haveTotals.get(card, 0) + sign * count
+
+    def changedFiles(self):
+        """Return the loaded files whose mtime or size changed since
+        """
+        with self.lock:
+            return [path for path, state in self.fileStates.items() if fileState(path) != state]
+
+    def reloadChanged(self):
+        """Reload the changed input files
+        Returns:
+          changed: The paths reloaded
+        """
+        with self.lock:
+            changed = self.changedFiles()
+            if self.deckJSONFile in changed:
+                self.loadDecks()
+            if [path for path in changed if path != self.deckJSONFile]:
+                self.loadCollection()
+            return changed
+
+    def updateCollection(self, changes, save=True):
+        """Add cards into the collection, or remove them with negative counts
+
+        Args:
+          changes: A list of (card id, count)
+          save: Write the collection into collectionFile
+        Returns:
+          rescored: How many decks are re-scored
+        """
+        with self.lock:
+            # The scorer re-scores the decks containing the card on every add()
+            deckIds = self.scorer.index.decksContainingAny([card for card, count in changes])
+            self.countCards(deckIds, -1)
+            for card, count in changes:
+                if self.collection.ows(card) + count < 0:
+                    count = -self.collection.ows(card)
+                if count != 0:
+                    self.collection.add((card, count))
+            self.collection.limitTo(2)
+            self.countCards(deckIds, 1)
+            if save:
+                self.collection.writeToFiles(self.collectionFile)
+                self.fileStates[self.collectionFile] = fileState(self.collectionFile)
+            self.version += 1
+            return len(deckIds)
+
+    def recommend(self, top=20, dustLimit=-1, decktype=None, cardClass=None):
+        """Return the recommended decks, see recommendDecks()
+        """
+        with self.lock:
+            return [self.deckSummary(item) for item in
+                    deckAdvisor.recommendDecks(self.partitions, top, dustLimit, decktype, cardClass)]
+
+    def wanted(self, top=10):
+        """Return the most wanted cards, as theMostWantedCards() does
+        The cards of the same count are in the same order too: the card first
+        lacked by a later deck first.
+
+        Returns:
+          cardPairs: A list of (card id, times lacked), the most wanted first
+        """
+        with self.lock:
+            cardPairs = [(card, count) for card, count in self.lackedTotals.items() if count > 0]
+            lackPostings = self.scorer.index.lackPostings
+            return self.topOf(cardPairs, top, lambda card: self.firstSeen(card, min(lackPostings[card])), reverse=True)
+
+    def useless(self, top=10):
+        """Return the least used cards of the collection, as theUselessCards() does
+        The cards of the same count are in the same order too: the card first
+        used by an earlier deck first, then the cards no deck uses in the
+        order of the collection.
+
+        Returns:
+          cardPairs: A list of (card id, times used), the least used first
+        """
+        with self.lock:
+            cardPairs = [(card, count) for card, count in self.haveTotals.items() if count > 0]
+            cardPairs += [(card, 0) for card in self.collection.collect_db if not self.haveTotals.get(card)]
+            postings = self.scorer.index.postings
+            positions = {}
+            def order(card):
+                if postings.get(card):
+                    return self.firstSeen(card, postings[card][0])
+                if not positions:
+                    positions.update((other, i) for i, other in enumerate(self.collection.collect_db))
+                return (len(self.scorer.deckList), positions[card])
+            return self.topOf(cardPairs, top, order)
+
+    def topOf(self, cardPairs, top, order, reverse=False):
+        """Return the TOP card pairs of the largest (REVERSE) or smallest counts
+        The ties at the cut and within it are broken by ORDER(card), only the
+        cards of a count up to the cut are ordered.
+        """
+        select = heapq.nlargest if reverse else heapq.nsmallest
+        candidates = select(top, cardPairs, key=operator.itemgetter(1))
+        if not candidates:
+            return []
+        cut = candidates[-1][1]
+        tied = [cardPair for cardPair in cardPairs if (cardPair[1] >= cut if reverse else cardPair[1] <= cut)]
+        return select(top, tied, key=lambda cardPair: (cardPair[1], order(cardPair[0])))
+
+    def firstSeen(self, card, deckId):
+        """Return (DECKID, the position of CARD in the deck), the order a scan of the deck list meets the card in
+        """
+        return (deckId, [cardPair[0] for cardPair in self.scorer.deckList[deckId]['deck'].cards].index(card))
+
+    def cardSummary(self, cardPair):
+        card = self.db.get(cardPair[0])
+        return {"card": cardPair[0], "count": cardPair[1],
+                "name": card.name if card != None else None,
+                "cost": card.cost if card != None else None,
+                "rarity": int(card.rarity) if card != None else None}
+
+    def deckSummary(self, item):
+        return {"name": item['name'], "url": item['url'], "deckstring": item['deckstring'],
+                "type": item['type'], "date": item['date'], "rating-sum": item['rating-sum'],
+                "cardclass": int(item['cardclass']) if item['cardclass'] != None else None,
+                "dust": item['dust'], "lacked": [self.cardSummary(cardPair) for cardPair in item['lacked']]}
+
+    def status(self):
+        with self.lock:
+            return {"decks": len(self.scorer.deckList), "cards": self.collection.total_num_cards,
+                    "version": self.version}
+
+class AdvisorHandler(BaseHTTPRequestHandler):
+    """GET /recommend?class=MAGE&format=standard&dust=2000&top=20
+    GET /wanted?top=10, GET /useless?top=10, GET /status
+    POST /collection with {"add": [[card id, count], ...]}, negative counts remove cards
+    """
+    protocol_version = "HTTP/1.1" # Keep-alive
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        query = dict((key, values[-1]) for key, values in parse_qs(parts.query).items())
+        state = self.server.state
+        start = time.perf_counter()
+        try:
+            top = int(query.get("top", 20))
+            if parts.path == "/recommend":
+                cardClass = parseCardClass(query["class"]) if query.get("class") else None
+                body = state.recommend(top, int(query.get("dust", -1)), query.get("format"), cardClass)
+            elif parts.path == "/wanted":
+                body = [state.cardSummary(cardPair) for cardPair in state.wanted(top)]
+            elif parts.path == "/useless":
+                body = [state.cardSummary(cardPair) for cardPair in state.useless(top)]
+            elif parts.path == "/status":
+                body = state.status()
+            else:
+                self.reply(404, {"error": "unknown query " + parts.path})
+                return
+        except (KeyError, ValueError) as e:
+            self.reply(400, {"error": "bad parameter: %s" % e})
+            return
+        self.reply(200, {"result": body, "ms": (time.perf_counter() - start) * 1000})
+
+    def do_POST(self):
+        if urlsplit(self.path).path != "/collection":
+            self.reply(404, {"error": "unknown query " + self.path})
+            return
+        start = time.perf_counter()
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            changes = [(int(card), int(count)) for card, count in request["add"]]
+        except (KeyError, TypeError, ValueError) as e:
+            self.reply(400, {"error": "bad request: %s" % e})
+            return
+        rescored = self.server.state.updateCollection(changes)
+        self.reply(200, {"result": {"rescored": rescored}, "ms": (time.perf_counter() - start) * 1000})
+
+    def reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+class AdvisorServer(ThreadingHTTPServer):
+    """Serve the queries of an AdvisorState on localhost, and reload its changed input files
+    """
+    daemon_threads = True
+
+    def __init__(self, state, port=8765, poll=5.0):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          state: The AdvisorState
+          port: The port to listen on, 0 for any free one
+          poll: Seconds between two checks of the input files, 0 to not watch them
+        """
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), AdvisorHandler)
+        self.state = state
+        self.poll = poll
+        self.baseUrl = "http://127.0.0.1:%d" % self.server_address[1]
+        self.stopped = threading.Event()
+        self.watcher = None
+
+    def watch(self):
+        while not self.stopped.wait(self.poll):
+            changed = self.state.reloadChanged()
+            if changed:
+                print ("Reloaded", ", ".join(changed))
+
+    def serve(self):
+        """Serve until interrupted, watching the input files in a background thread
+        """
+        if self.poll > 0:
+            self.watcher = threading.Thread(target=self.watch, daemon=True)
+            self.watcher.start()
+        try:
+            self.serve_forever()
+        finally:
+            self.stopped.set()
+            self.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HearthStone deck advisor daemon")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--poll", type=float, default=5.0, help="seconds between two checks of the input files")
+    parser.add_argument("--card-defs", default=os.path.join("hsdata", "CardDefs.xml"))
+    parser.add_argument("--decks", default="inputs/decks.json", help="the deck json file")
+    parser.add_argument("--collection", default="inputs/mycards.csv")
+    parser.add_argument("--collection-deckstrings", default="inputs/mycards",
+                        help="the deckstring file to init the collection from if the csv file doesn't exist")
+    parser.add_argument("--date-limit", default="01/05/2015")
+    parser.add_argument("--rating-limit", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    state = AdvisorState(args.card_defs, args.decks, args.collection, args.collection_deckstrings,
+                         args.date_limit, args.rating_limit, workers=args.workers)
+    server = AdvisorServer(state, args.port, args.poll)
+    print ("Serving", len(state.scorer.deckList), "decks at", server.baseUrl)
+    try:
+        server.serve()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
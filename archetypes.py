@@ -0,0 +1,224 @@
+'''
+Archetype clustering of decks with mini-batch k-means over card-count vectors
+
+'''
+
+import os
+import itertools
+import numpy as np
+from batch import DeckMatrix
+
+def chunked(iterable, size):
+    """Yield lists of SIZE items of ITERABLE, the last one may be shorter
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+class ArchetypeModel:
+    """Archetype clusters of decks, learned by mini-batch k-means (Sculley, 2010)
+    A deck is a sparse vector of its card counts normalized to unit length,
+    and it belongs to the cluster of the closest centroid by cosine, so two
+    decks sharing most of their cards fall in the same cluster whatever the
+    scraped archetype says.
+    The decks are read BATCHSIZE at a time: a batch is assigned to the
+    current centroids, and every centroid moves to the running mean of all
+    the decks ever assigned to it. Only the centroids (clusters x cards seen)
+    and one batch are in memory, whatever the number of decks, and decks can
+    be added later with partialFit() without refitting.
+    The first batch seeds the centroids with k-means++.
+    """
+    def __init__(self, clusters=20, batchSize=1024, seed=1):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          clusters: The number of clusters, fewer if the first batch has fewer distinct decks
+          batchSize: The decks of a batch
+          seed: The seed of the k-means++ seeding
+        """
+        self.clusters = clusters
+        self.batchSize = batchSize
+        self.seed = seed
+        self.rng = np.random.RandomState(seed)
+        self.cards = [] # column -> card id
+        self.columnOf = np.full(0, -1, dtype=np.int64) # card id -> column, -1 for the cards never seen
+        self.centroids = None # clusters x columns, None before the first batch
+        self.counts = None # cluster -> the decks ever assigned to it
+
+    def __len__(self):
+        return 0 if self.centroids is None else len(self.centroids)
+
+    def vectors(self, cardsList, grow=False):
+        """Convert decks into unit card-count vectors, a CSR matrix over the columns
+
+        Args:
+          cardsList: A list of decks, each in format [(card id, count)]
+          grow: Add a column for the cards never seen, or leave them out
+        Returns:
+          indptr, columns, values: Row i is columns[indptr[i]:indptr[i+1]] with values[indptr[i]:indptr[i+1]]
+        """
+        matrix = DeckMatrix.fromCardsList(cardsList)
+        indices = matrix.indices
+        if len(indices) > 0 and indices.max() >= len(self.columnOf):
+            self.columnOf = np.concatenate([self.columnOf, np.full(int(indices.max()) + 1 - len(self.columnOf), -1, dtype=np.int64)])
+        columns = self.columnOf[indices]
+        if grow:
+            newCards = np.unique(indices[columns < 0])
+            if len(newCards) > 0:
+                self.columnOf[newCards] = np.arange(len(self.cards), len(self.cards) + len(newCards))
+                self.cards.extend(int(card) for card in newCards)
+                columns = self.columnOf[indices]
+                if self.centroids is not None and self.centroids.shape[1] < len(self.cards):
+                    # New cards weigh nothing in the centroids so far, with room for more
+                    width = max(len(self.cards), 2 * self.centroids.shape[1])
+                    self.centroids = np.hstack([self.centroids, np.zeros((len(self.centroids), width - self.centroids.shape[1]))])
+        known = columns >= 0
+        rows = matrix.rows()[known]
+        columns = columns[known]
+        values = matrix.counts[known].astype(np.float64)
+        norms = np.sqrt(np.bincount(rows, weights=values * values, minlength=len(cardsList)))
+        values /= norms[rows]
+        indptr = np.zeros(len(cardsList) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(cardsList)))
+        return indptr, columns, values
+
+    def dot(self, indptr, columns, values, dense):
+        """Return the dot products of the rows of a CSR matrix with the rows of DENSE, len(dense) x rows
+        """
+        result = np.zeros((len(dense), len(indptr) - 1))
+        # reduceat can't sum an empty row, only the rows with cards are summed
+        filled = np.diff(indptr) > 0
+        if filled.any():
+            result[:, filled] = np.add.reduceat(dense[:, columns] * values, indptr[:-1][filled], axis=1)
+        return result
+
+    def similarities(self, indptr, columns, values):
+        """Return the cosine similarity of every row to every centroid, clusters x rows
+        """
+        norms = np.sqrt((self.centroids * self.centroids).sum(axis=1))
+        norms[norms == 0] = 1
+        return self.dot(indptr, columns, values, self.centroids) / norms[:, None]
+
+    def seedCentroids(self, indptr, columns, values):
+        """Pick the first centroids among the rows with k-means++
+        A row is picked with a probability in proportion to its squared
+        distance to the closest centroid picked, so the seeds spread over the
+        archetypes instead of piling up in the most played one.
+        """
+        rows = len(indptr) - 1
+        width = max(len(self.cards), 1)
+        def dense(row):
+            vector = np.zeros(width)
+            vector[columns[indptr[row]:indptr[row + 1]]] = values[indptr[row]:indptr[row + 1]]
+            return vector
+        seeds = [dense(self.rng.randint(rows))]
+        closest = np.maximum(2 - 2 * self.dot(indptr, columns, values, seeds[0][None, :])[0], 0)
+        while len(seeds) < self.clusters:
+            total = closest.sum()
+            if total <= 1e-12: # Every row is a copy of a seed
+                break
+            seeds.append(dense(self.rng.choice(rows, p=closest / total)))
+            closest = np.minimum(closest, np.maximum(2 - 2 * self.dot(indptr, columns, values, seeds[-1][None, :])[0], 0))
+        self.centroids = np.array(seeds)
+        self.counts = np.zeros(len(seeds), dtype=np.int64)
+
+    def partialFit(self, cardsList):
+        """Assign a batch of decks to the closest clusters, and move the centroids to the new means
+
+        Args:
+          cardsList: A list of decks, each in format [(card id, count)]
+        Returns:
+          clusters: The cluster of every deck
+        """
+        if len(cardsList) == 0:
+            return np.zeros(0, dtype=np.int64)
+        indptr, columns, values = self.vectors(cardsList, grow=True)
+        if self.centroids is None:
+            self.seedCentroids(indptr, columns, values)
+        clusters = self.similarities(indptr, columns, values).argmax(axis=0)
+        # The running mean of every cluster: centroid * n / (n + m) + sum(batch) / (n + m)
+        lengths = np.diff(indptr)
+        assigned = np.bincount(clusters[lengths > 0], minlength=len(self.centroids))
+        counts = self.counts + assigned
+        moved = assigned > 0
+        self.centroids[moved] *= (self.counts[moved] / counts[moved])[:, None]
+        rowClusters = np.repeat(clusters, lengths)
+        np.add.at(self.centroids, (rowClusters, columns), values / counts[rowClusters])
+        self.counts = counts
+        return clusters
+
+    def fit(self, cardsList, epochs=2):
+        """Learn the clusters from decks, EPOCHS passes of batches
+
+        Args:
+          cardsList: A list (or any iterable that can be read again) of decks, each in format [(card id, count)]
+          epochs: How many times the decks are read
+        """
+        for epoch in range(epochs):
+            for chunk in chunked(cardsList, self.batchSize):
+                self.partialFit(chunk)
+
+    def assign(self, cardsList):
+        """Return the closest cluster of every deck, and the cosine similarity to it, without moving the centroids
+        The cards the model has never seen are left out.
+        """
+        clusters = []
+        scores = []
+        for chunk in chunked(cardsList, self.batchSize):
+            similarities = self.similarities(*self.vectors(chunk))
+            clusters.append(similarities.argmax(axis=0))
+            scores.append(similarities.max(axis=0))
+        if not clusters:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        return np.concatenate(clusters), np.concatenate(scores)
+
+    def topCards(self, cluster, count=3):
+        """Return the COUNT cards weighing the most in a cluster's centroid, heaviest first
+        """
+        weights = self.centroids[cluster, :len(self.cards)]
+        return [self.cards[column] for column in np.argsort(-weights, kind="stable")[:count] if weights[column] > 0]
+
+    def label(self, cluster, db, count=3):
+        """Return a name for a cluster, the names of its heaviest cards
+        """
+        return "/".join(db[card].name for card in self.topCards(cluster, count))
+
+    def save(self, path):
+        """Write the model into the npz file PATH
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmpPath = path + ".tmp"
+        with open (tmpPath, "wb") as f:
+            np.savez(f, params=np.array([self.clusters, self.batchSize, self.seed]),
+                     cards=np.array(self.cards, dtype=np.int64),
+                     centroids=self.centroids[:, :len(self.cards)],
+                     counts=self.counts)
+        os.replace(tmpPath, path)
+
+    def load(self, path):
+        """Read the model written by save() into PATH, if it's made with the same parameters
+
+        Returns:
+          loaded: Whether the model is read
+        """
+        try:
+            with np.load(path) as data:
+                if list(data["params"]) != [self.clusters, self.batchSize, self.seed]:
+                    return False
+                cards = [int(card) for card in data["cards"]]
+                centroids = data["centroids"]
+                counts = data["counts"]
+        except (OSError, ValueError, KeyError):
+            return False
+        self.cards = cards
+        self.columnOf = np.full(max(cards) + 1 if cards else 0, -1, dtype=np.int64)
+        self.columnOf[cards] = np.arange(len(cards))
+        self.centroids = centroids
+        self.counts = counts
+        return True
@@ -0,0 +1,501 @@
+#!/usr/bin/env python
+# -*- encoding: utf-8 -*-
+'''
+Standalone asyncio crawler of the hearthpwn decks, without pyspider
+
+It writes the same json lines as hearthPwnCrawler.py, which
+deckAdvisor.calculateLacksFromJSONFile() reads.
+'''
+
+import os
+import re
+import ssl
+import json
+import random
+import asyncio
+import argparse
+from email.parser import Parser
+from html.parser import HTMLParser
+from urllib.parse import urlsplit, urljoin
+from crawlcheckpoint import CrawlCheckpoint, deckIdFromUrl
+
+USER_AGENT = "deckAdvisor-crawler/1.0"
+RETRY_STATUS = (429, 500, 502, 503, 504)
+REDIRECT_STATUS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5 # The redirects followed for a url at most
+# The elements without an end tag
+VOID_TAGS = set(["area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "param", "source", "track", "wbr"])
+
+class HTTPError(Exception):
+    def __init__(self, status, url):
+        Exception.__init__(self, "HTTP %d: %s" % (status, url))
+        self.status = status
+
+class Response:
+    def __init__(self, url, status, headers, body):
+        self.url = url
+        self.status = status
+        self.headers = headers # An email.message.Message, the names are case insensitive
+        self.body = body
+
+class ConnectionPool:
+    """Keep-alive HTTP/1.1 connections, at most maxPerHost open to every host
+    """
+    def __init__(self, maxPerHost=8, timeout=30):
+        """Constructor
+        All the member vars are listed
+        """
+        self.maxPerHost = maxPerHost
+        self.timeout = timeout
+        self.idle = {} # (scheme, host, port) -> [(reader, writer)]
+        self.slots = {} # (scheme, host, port) -> a Semaphore of maxPerHost
+        self.opened = 0 # How many connections are opened
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        self.opened += 1
+        return await asyncio.wait_for(asyncio.open_connection(host, port, ssl=ssl.create_default_context() if scheme == "https" else None),
+                                      self.timeout)
+
+    async def request(self, url, headers={}):
+        """GET URL
+
+        Args:
+          url: The url
+          headers: Extra request headers
+        Returns:
+          response: A Response
+        """
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == "https" else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        lines = ["GET %s HTTP/1.1" % path,
+                 "Host: %s" % parts.netloc,
+                 "User-Agent: %s" % USER_AGENT,
+                 "Accept-Encoding: identity",
+                 "Connection: keep-alive"]
+        lines += ["%s: %s" % (name, value) for name, value in headers.items()]
+        message = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+
+        slot = self.slots.setdefault(key, asyncio.Semaphore(self.maxPerHost))
+        async with slot:
+            idle = self.idle.setdefault(key, [])
+            while True:
+                reused = bool(idle)
+                reader, writer = idle.pop() if reused else await self._connect(key)
+                try:
+                    writer.write(message)
+                    await writer.drain()
+                    status, responseHeaders, body, keepAlive = await asyncio.wait_for(self._readResponse(reader), self.timeout)
+                except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError):
+                    writer.close()
+                    if reused:
+                        continue # The server has closed the idle connection, open a new one
+                    raise
+                if keepAlive:
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+                return Response(url, status, responseHeaders, body)
+
+    async def _readResponse(self, reader):
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise asyncio.IncompleteReadError(b"", None)
+        version, status = statusLine.decode("latin-1").split(None, 2)[:2]
+        status = int(status)
+        headerLines = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            headerLines.append(line.decode("latin-1"))
+        headers = Parser().parsestr("".join(headerLines), headersonly=True)
+        keepAlive = version == "HTTP/1.1" and (headers.get("Connection") or "").lower() != "close"
+        if status in (204, 304) or 100 <= status < 200:
+            body = b""
+        elif (headers.get("Transfer-Encoding") or "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass # Trailers
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b"".join(chunks)
+        elif headers.get("Content-Length") != None:
+            body = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            body = await reader.read()
+            keepAlive = False
+        return status, headers, body, keepAlive
+
+    def close(self):
+        for connections in self.idle.values():
+            for reader, writer in connections:
+                writer.close()
+        self.idle = {}
+
+class RateLimiter:
+    """A token bucket per host: RATE requests per second, in bursts of BURST at most
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = {} # host -> [tokens, time of the last update]
+
+    async def acquire(self, host):
+        if self.rate <= 0:
+            return
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            bucket = self.buckets.setdefault(host, [self.burst, now])
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return
+            await asyncio.sleep((1 - bucket[0]) / self.rate)
+
+class _PageParser(HTMLParser):
+    """Track the open elements, and collect the text of the elements captured by capture()
+    """
+    def __init__(self):
+        HTMLParser.__init__(self, convert_charrefs=True)
+        self.stack = [] # The open elements: [tag, capture key or None]
+        self.texts = {} # capture key -> [text of every captured element]
+
+    def capture(self, key):
+        """Collect the text of the element just started as a new item of KEY
+        """
+        self.stack[-1][1] = key
+        self.texts.setdefault(key, []).append([])
+
+    def handle_starttag(self, tag, attrs):
+        if tag not in VOID_TAGS:
+            self.stack.append([tag, None])
+        self.startElement(tag, dict(attrs))
+
+    def handle_startendtag(self, tag, attrs):
+        self.startElement(tag, dict(attrs))
+
+    def handle_endtag(self, tag):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == tag:
+                del self.stack[i:]
+                break
+
+    def handle_data(self, data):
+        for tag, key in self.stack:
+            if key != None:
+                self.texts[key][-1].append(data)
+
+    def text(self, key, i=0):
+        """The text of the I-th element captured as KEY, with the spaces collapsed, or None
+        """
+        items = self.texts.get(key, [])
+        if i >= len(items) or -i > len(items):
+            return None
+        return " ".join("".join(items[i]).split())
+
+    def count(self, key):
+        return len(self.texts.get(key, []))
+
+    def startElement(self, tag, attrs):
+        pass
+
+class DeckPageParser(_PageParser):
+    """Extract the fields of a deck page in a single pass
+    The same fields as Handler.detail_page() in hearthPwnCrawler.py.
+    """
+    def __init__(self):
+        _PageParser.__init__(self)
+        self.deckstring = None
+        self.inDetails = 0 # The depth of the deck-details list the parser is in, 0 if out of it
+
+    def startElement(self, tag, attrs):
+        cls = attrs.get("class")
+        if tag == "title":
+            self.capture("title")
+        elif cls == "deck-details":
+            self.inDetails = len(self.stack)
+        elif tag == "li" and self.inDetails and len(self.stack) == self.inDetails + 1:
+            self.capture("details")
+        elif cls == "deck-rating-form":
+            self.capture("rating")
+        elif cls == "is-std":
+            self.capture("std")
+        if self.deckstring == None and attrs.get("data-ga-click-event-tracking-label") == "Top":
+            self.deckstring = attrs.get("data-clipboard-text")
+
+    def handle_endtag(self, tag):
+        _PageParser.handle_endtag(self, tag)
+        if len(self.stack) < self.inDetails:
+            self.inDetails = 0
+
+    def record(self, url):
+        """Return the deck dict, or None if the page isn't a deck page
+        """
+        if self.deckstring == None or self.count("details") < 2:
+            return None
+        return {"url": url,
+                "title": self.text("title") or "",
+                "deckstring": self.deckstring,
+                "date": self.text("details", -1),
+                "deck-type": self.text("details", 0),
+                "archetype": self.text("details", 1),
+                "rating-sum": self.text("rating") or "",
+                "type": "Standard" if self.text("std") else "Wild"}
+
+def parseDeckPage(url, html):
+    """Return the deck dict of a deck page, or None
+    """
+    parser = DeckPageParser()
+    parser.feed(html)
+    parser.close()
+    return parser.record(url)
+
+class IndexPageParser(_PageParser):
+    """Extract the decks and the page links of an index page
+    """
+    def __init__(self, url):
+        _PageParser.__init__(self)
+        self.url = url
+        self.decks = [] # (deck url, update time or None), in the listed order
+        self.pages = {} # page number -> url
+        self.row = None # [deck url, update time] of the table row the parser is in
+
+    def startElement(self, tag, attrs):
+        if tag == "tr":
+            self.endRow()
+            self.row = [None, None]
+        elif tag == "a" and attrs.get("href"):
+            href = urljoin(self.url, attrs["href"])
+            path = urlsplit(href)
+            if path.path.rstrip('/') == "/decks":
+                match = re.search(r"(?:^|&)page=(\d+)", path.query)
+                self.pages[int(match.group(1)) if match != None else 1] = href
+            elif deckIdFromUrl(path.path) != None and path.path.startswith("/decks/") and self.row != None and self.row[0] == None:
+                self.row[0] = href
+        elif attrs.get("data-epoch") and self.row != None and self.row[1] == None:
+            try:
+                self.row[1] = int(attrs["data-epoch"])
+            except ValueError:
+                pass
+
+    def handle_endtag(self, tag):
+        _PageParser.handle_endtag(self, tag)
+        if tag == "tr":
+            self.endRow()
+
+    def endRow(self):
+        if self.row != None and self.row[0] != None:
+            self.decks.append(tuple(self.row))
+        self.row = None
+
+def parseIndexPage(url, html):
+    """Return the decks listed in an index page, and the url of the next page or None
+
+    Returns:
+      decks: A list of (deck url, update time or None)
+      nextPage: The url of the next index page, or None
+    """
+    parser = IndexPageParser(url)
+    parser.feed(html)
+    parser.close()
+    parser.endRow()
+    match = re.search(r"(?:^|&)page=(\d+)", urlsplit(url).query)
+    return parser.decks, parser.pages.get((int(match.group(1)) if match != None else 1) + 1)
+
+class AsyncCrawler:
+    """Crawl the hearthpwn deck index and the deck pages with asyncio
+    The detail pages are fetched concurrently (at most CONCURRENCY requests at
+    a time, RATE requests per second to a host), over pooled keep-alive
+    connections, and the failed requests are retried with exponential backoff.
+    With a CrawlCheckpoint, the crawl is incremental like hearthPwnCrawler.py.
+    """
+    def __init__(self, baseUrl="http://www.hearthpwn.com", concurrency=8, rate=4.0, burst=4, retries=4, backoff=0.5,
+                 checkpoint=None, maxPages=None, timeout=30):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          baseUrl: The site to crawl
+          concurrency: How many requests can be in flight
+          rate: Requests per second to a host, 0 for no limit
+          burst: How many requests can go to a host at once when it's idle
+          retries: How many times a failed request is retried
+          backoff: The first retry waits about this many seconds, doubled on every retry
+          checkpoint: A CrawlCheckpoint, or None to crawl everything
+          maxPages: Stop after this many index pages, or None
+          timeout: The timeout of a request in seconds
+        """
+        self.baseUrl = baseUrl.rstrip('/')
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.checkpoint = checkpoint
+        self.maxPages = maxPages
+        self.pool = ConnectionPool(concurrency, timeout)
+        self.limiter = RateLimiter(rate, burst)
+        self.semaphore = None # Created in the event loop by run()
+        self.stats = {"requests": 0, "retries": 0, "redirects": 0, "notModified": 0, "failed": 0, "decks": 0, "pages": 0}
+
+    async def fetch(self, url):
+        """GET URL, conditional on the checkpoint, with retries, following the redirects
+        A redirect is resolved against the url it's answered for, and can move
+        to another scheme or host: its requests go through the connections and
+        the rate limit of that host.
+
+        Returns:
+          response: The Response of the last url, its status is 200 or 304
+        Raises:
+          HTTPError: For another status, after the retries if it's worth retrying, or after MAX_REDIRECTS redirects
+        """
+        headers = self.checkpoint.conditionalHeaders(url) if self.checkpoint != None else {}
+        attempt = 0
+        redirects = 0
+        while True:
+            await self.limiter.acquire(urlsplit(url).netloc)
+            try:
+                async with self.semaphore:
+                    self.stats["requests"] += 1
+                    response = await self.pool.request(url, headers)
+                if response.status in (200, 304):
+                    return response
+                if response.status in REDIRECT_STATUS and response.headers.get("Location"):
+                    if redirects >= MAX_REDIRECTS:
+                        raise HTTPError(response.status, url)
+                    redirects += 1
+                    self.stats["redirects"] += 1
+                    url = urljoin(url, response.headers["Location"])
+                    continue
+                if response.status not in RETRY_STATUS:
+                    raise HTTPError(response.status, url)
+                error = HTTPError(response.status, url)
+                retryAfter = response.headers.get("Retry-After")
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+                retryAfter = None
+            if attempt >= self.retries:
+                raise error
+            delay = self.backoff * (2 ** attempt) * (0.5 + random.random())
+            if retryAfter != None and retryAfter.isdigit():
+                delay = max(delay, int(retryAfter))
+            attempt += 1
+            self.stats["retries"] += 1
+            await asyncio.sleep(delay)
+
+    async def crawlDeck(self, url, updated, output):
+        try:
+            response = await self.fetch(url)
+        except (HTTPError, OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+            self.stats["failed"] += 1
+            print ("failed:", url, e)
+            return # Still pending, it's tried again by the next crawl
+        if self.checkpoint != None:
+            self.checkpoint.pending.pop(url, None)
+        if response.status == 200:
+            record = parseDeckPage(url, response.body.decode("utf-8", "replace"))
+            if record == None:
+                self.stats["failed"] += 1
+                print ("not a deck page:", url)
+                return
+            output(record)
+            self.stats["decks"] += 1
+        else:
+            self.stats["notModified"] += 1
+        if self.checkpoint != None:
+            self.checkpoint.storeValidators(url, response.headers)
+            self.checkpoint.markSeen(deckIdFromUrl(url), updated)
+
+    async def run(self, output):
+        """Crawl from the first index page, calling OUTPUT with every deck dict
+        The index pages are followed one by one, while their decks are crawled concurrently.
+        With a checkpoint, the pending decks of the interrupted crawls are crawled
+        first, and when an index page lists nothing new the crawl goes on from the
+        frontier instead of stopping, until the frontier is used up.
+        """
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = []
+        frontier = []
+        if self.checkpoint != None:
+            frontier = list(self.checkpoint.frontier)
+            for deckUrl, updated in list(self.checkpoint.pending.items()):
+                tasks.append(asyncio.ensure_future(self.crawlDeck(deckUrl, updated, output)))
+        url = self.baseUrl + "/decks"
+        try:
+            while url != None and (self.maxPages == None or self.stats["pages"] < self.maxPages):
+                response = await self.fetch(url)
+                self.stats["pages"] += 1
+                if response.status == 304: # Not changed since the last crawl
+                    self.stats["notModified"] += 1
+                    decks, url = [], None
+                else:
+                    if self.checkpoint != None:
+                        self.checkpoint.storeValidators(url, response.headers)
+                    decks, url = parseIndexPage(response.url, response.body.decode("utf-8", "replace"))
+                if self.checkpoint != None:
+                    decks = [deck for deck in self.checkpoint.newDecks(decks) if deck[0] not in self.checkpoint.pending]
+                    if not decks: # The decks are listed newest first, the rest are known or pending
+                        url = frontier.pop(0) if frontier else None
+                    elif url == None: # The last index page, past the pages the earlier crawls stopped before
+                        frontier = []
+                    for deckUrl, updated in decks:
+                        self.checkpoint.pending[deckUrl] = updated
+                    self.checkpoint.frontier = ([url] if url != None else []) + frontier
+                for deckUrl, updated in decks:
+                    tasks.append(asyncio.ensure_future(self.crawlDeck(deckUrl, updated, output)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.pool.close()
+            if self.checkpoint != None:
+                self.checkpoint.save()
+        return self.stats
+
+def crawl(path, baseUrl="http://www.hearthpwn.com", checkpointPath=None, **kwargs):
+    """Crawl the decks and append them into the json file PATH
+
+    Args:
+      path: The json lines file to append the deck dicts into
+      baseUrl: The site to crawl
+      checkpointPath: The CrawlCheckpoint file, or None to crawl everything
+      kwargs: The other arguments of AsyncCrawler
+    Returns:
+      stats: The counters of the crawl
+    """
+    checkpoint = CrawlCheckpoint(checkpointPath) if checkpointPath != None else None
+    crawler = AsyncCrawler(baseUrl, checkpoint=checkpoint, **kwargs)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open (path, "at") as f:
+        def output(record):
+            json.dump(record, f)
+            f.write('\n')
+        return asyncio.run(crawler.run(output))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Crawl the hearthpwn decks into a json lines file")
+    parser.add_argument("--base-url", default="http://www.hearthpwn.com", help="the site to crawl")
+    parser.add_argument("--output", default="inputs/decks.json", help="the json file to append the decks into")
+    parser.add_argument("--checkpoint", default="cache/crawl_checkpoint.json",
+                        help="the checkpoint of the incremental crawl, empty to crawl everything")
+    parser.add_argument("--concurrency", type=int, default=8, help="the requests in flight at most")
+    parser.add_argument("--rate", type=float, default=4.0, help="the requests per second to a host, 0 for no limit")
+    parser.add_argument("--retries", type=int, default=4, help="how many times a failed request is retried")
+    parser.add_argument("--max-pages", type=int, default=None, help="stop after this many index pages")
+    args = parser.parse_args(argv)
+    stats = crawl(args.output, args.base_url, args.checkpoint or None, concurrency=args.concurrency,
+                  rate=args.rate, retries=args.retries, maxPages=args.max_pages)
+    print (stats)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+'''
+Vectorized lack/dust calculation over a whole deck corpus
+
+'''
+
+import numpy as np
+from hearthstone.enums import Rarity
+from carddb import CardDatabase
+
+# The same values as calcArcaneDust() in deckAdvisor.py
+DUST_OUT = {Rarity.COMMON: 5, Rarity.RARE: 20, Rarity.EPIC: 100, Rarity.LEGENDARY: 400}
+DUST_IN = {Rarity.COMMON: 40, Rarity.RARE: 100, Rarity.EPIC: 400, Rarity.LEGENDARY: 1600}
+
+class CardTable:
+    """Per-card lookup vectors indexed by dbf_id
+    """
+    def __init__(self, db_dbf):
+        """Constructor
+
+        Args:
+          db_dbf: The all-cards database
+        """
+        self.size = max(db_dbf) + 1 if db_dbf else 0
+        self.known = np.zeros(self.size, dtype=bool) # Is the dbf_id in the database
+        self.dustOut = np.zeros(self.size, dtype=np.int64) # Dust got from breaking down a card
+        self.dustIn = np.zeros(self.size, dtype=np.int64) # Dust needed to craft a card
+        if isinstance(db_dbf, CardDatabase):
+            # Straight from the numeric columns, without building a CardRecord for every card
+            self.known[db_dbf.dbfIds] = True
+            for rarity, enum in db_dbf.rarityEnums.items():
+                cards = db_dbf.dbfIds[db_dbf.rarities == rarity]
+                self.dustOut[cards] = DUST_OUT.get(enum, 0)
+                self.dustIn[cards] = DUST_IN.get(enum, 0)
+            return
+        for dbf_id, card in db_dbf.items():
+            self.known[dbf_id] = True
+            self.dustOut[dbf_id] = DUST_OUT.get(card.rarity, 0)
+            self.dustIn[dbf_id] = DUST_IN.get(card.rarity, 0)
+
+    def resized(self, size):
+        """Return (known, dustOut, dustIn) padded to at least SIZE entries
+        """
+        if size <= self.size:
+            return self.known, self.dustOut, self.dustIn
+        pad = size - self.size
+        return (np.concatenate((self.known, np.zeros(pad, dtype=bool))),
+                np.concatenate((self.dustOut, np.zeros(pad, dtype=np.int64))),
+                np.concatenate((self.dustIn, np.zeros(pad, dtype=np.int64))))
+
+class DeckMatrix:
+    """A sparse deck x card count matrix in CSR form
+    Row i holds the card pairs of deck i, in the order of deck.cards
+    """
+    def __init__(self, indptr, indices, counts):
+        """Constructor
+
+        Args:
+          indptr: Row i is indices[indptr[i]:indptr[i+1]]
+          indices: The dbf_id of every stored card pair
+          counts: The count of every stored card pair
+        """
+        self.indptr = indptr
+        self.indices = indices
+        self.counts = counts
+
+    @classmethod
+    def fromCardsList(cls, cardsList):
+        """Build the matrix from a list of decks
+
+        Args:
+          cardsList: A list of decks, each in format [(card id, count)]
+        """
+        indptr = np.zeros(len(cardsList) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(cards) for cards in cardsList])
+        total = int(indptr[-1])
+        indices = np.fromiter((cardPair[0] for cards in cardsList for cardPair in cards),
+                              dtype=np.int64, count=total)
+        counts = np.fromiter((cardPair[1] for cards in cardsList for cardPair in cards),
+                             dtype=np.int64, count=total)
+        return cls(indptr, indices, counts)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def rows(self):
+        """Return the deck index of every stored card pair
+        """
+        return np.repeat(np.arange(len(self), dtype=np.int64), np.diff(self.indptr))
+
+def collectionVector(collection, size):
+    """Convert a collection into dense vectors indexed by dbf_id
+
+    Args:
+      collection: The card collection
+      size: The length of the vectors, cards with a larger dbf_id are left out
+    Returns:
+      counts: How many copies of every card the collection has
+      present: Whether the card exists in collection.collect_db (even with a count of 0)
+    """
+    counts = np.zeros(size, dtype=np.int64)
+    present = np.zeros(size, dtype=bool)
+    if collection.collect_db:
+        cards = np.fromiter(collection.collect_db.keys(), dtype=np.int64)
+        cardCounts = np.fromiter(collection.collect_db.values(), dtype=np.int64)
+        inRange = cards < size
+        counts[cards[inRange]] = cardCounts[inRange]
+        present[cards[inRange]] = True
+    return counts, present
+
+class BatchLacks:
+    """The lacked/alreadyHave/dust results for every deck in a DeckMatrix
+    """
+    def __init__(self, matrix, lacked, have, haveMask, dustIn):
+        """Constructor
+
+        Args:
+          matrix: The DeckMatrix the results are calculated from
+          lacked: The lacked count of every stored card pair
+          have: The already-have count of every stored card pair
+          haveMask: Whether a card pair shows up in the alreadyHave list
+          dustIn: The dust needed to craft the lacked cards of every deck
+        """
+        self.matrix = matrix
+        self.lacked = lacked
+        self.have = have
+        self.haveMask = haveMask
+        self.dustIn = dustIn
+
+    def lackedPairs(self, i):
+        """Return the lacked card pairs of deck I, as Collection.calculateLacks() does
+        """
+        start, end = self.matrix.indptr[i], self.matrix.indptr[i+1]
+        lacked = self.lacked[start:end]
+        mask = lacked > 0
+        return list(zip(self.matrix.indices[start:end][mask].tolist(), lacked[mask].tolist()))
+
+    def alreadyHavePairs(self, i):
+        """Return the already-have card pairs of deck I, as Collection.calculateLacks() does
+        """
+        start, end = self.matrix.indptr[i], self.matrix.indptr[i+1]
+        mask = self.haveMask[start:end]
+        return list(zip(self.matrix.indices[start:end][mask].tolist(), self.have[start:end][mask].tolist()))
+
+def calculateBatchLacks(matrix, collection, table):
+    """Calculate the lacked cards and dust in need for every deck in MATRIX
+    The results are exactly the same as Collection.calculateLacks() and
+    calcArcaneDust() on every deck.
+
+    Args:
+      matrix: The DeckMatrix of the deck corpus
+      collection: Cards collection for calculation
+      table: The CardTable of the all-cards database
+    Returns:
+      A BatchLacks object
+    """
+    size = table.size
+    if len(matrix.indices):
+        size = max(size, int(matrix.indices.max()) + 1)
+    colCounts, present = collectionVector(collection, size)
+    known, _, dustIn = table.resized(len(colCounts))
+
+    indices = matrix.indices
+    counts = matrix.counts
+    have = np.minimum(colCounts[indices], counts)
+    lacked = counts - have
+    haveMask = present[indices]
+
+    missing = (lacked > 0) & ~known[indices]
+    if missing.any():
+        # calcArcaneDust() fails the same way on the unknown card
+        raise KeyError(int(indices[missing][0]))
+
+    dust = np.bincount(matrix.rows(), weights=np.where(lacked > 0, lacked * dustIn[indices], 0),
+                       minlength=len(matrix)).astype(np.int64)
+    return BatchLacks(matrix, lacked, have, haveMask, dust)
+
+def collectionMatrix(collections, cards):
+    """Convert collections into a dense collection x card matrix over the card ids CARDS
+
+    Args:
+      collections: A list of Collection
+      cards: The card ids of the columns, an int array
+    Returns:
+      counts: How many copies of every card every collection has
+      present: Whether the card exists in collection.collect_db (even with a count of 0)
+    """
+    column = dict((card, j) for j, card in enumerate(cards.tolist()))
+    counts = np.zeros((len(collections), len(cards)), dtype=np.int64)
+    present = np.zeros((len(collections), len(cards)), dtype=bool)
+    for i, collection in enumerate(collections):
+        for card, count in collection.collect_db.items():
+            j = column.get(card)
+            if j != None:
+                counts[i, j] = count
+                present[i, j] = True
+    return counts, present
+
+def calculateMultiLacks(matrix, collections, table, blockBytes=256 << 20):
+    """Calculate the lacked cards and dust in need for every deck in MATRIX, for many collections
+    The collections are stacked into a collection x card matrix over the cards
+    used by the corpus, and scored against all the stored card pairs at once,
+    as many collections at a time as fit in BLOCKBYTES. The result of every
+    collection is the same as calculateBatchLacks().
+
+    Args:
+      matrix: The DeckMatrix of the deck corpus
+      collections: A list of Collection
+      table: The CardTable of the all-cards database
+      blockBytes: The approximate memory of the arrays of a block of collections
+    Yields:
+      result: The BatchLacks of every collection, in the order of COLLECTIONS
+    """
+    cards, columns = np.unique(matrix.indices, return_inverse=True)
+    columns = columns.reshape(-1) # numpy 2.0 keeps the shape of the input in the inverse
+    size = max(table.size, int(cards[-1]) + 1) if len(cards) else table.size
+    known, _, dustIn = table.resized(size)
+    unknown = ~known[matrix.indices]
+    pairDust = dustIn[matrix.indices]
+    filled = np.diff(matrix.indptr) > 0
+    starts = matrix.indptr[:-1][filled] # Strictly increasing, as np.add.reduceat() needs
+    blockSize = max(1, blockBytes // (32 * max(1, len(matrix.indices))))
+
+    for first in range(0, len(collections), blockSize):
+        block = collections[first:first+blockSize]
+        colCounts, present = collectionMatrix(block, cards)
+        have = np.minimum(colCounts[:, columns], matrix.counts)
+        lacked = matrix.counts - have
+        haveMask = present[:, columns]
+
+        missing = ((lacked > 0) & unknown).any(axis=0)
+        if missing.any():
+            # calcArcaneDust() fails the same way on the unknown card
+            raise KeyError(int(matrix.indices[missing][0]))
+
+        dust = np.zeros((len(block), len(matrix)), dtype=np.int64)
+        if len(starts):
+            # The pairs of a deck are contiguous, sum every row segment of all the collections at once
+            dust[:, filled] = np.add.reduceat(np.where(lacked > 0, lacked * pairDust, 0), starts, axis=1)
+        for i in range(len(block)):
+            yield BatchLacks(matrix, lacked[i], have[i], haveMask[i], dust[i])
+
+def _splitPairs(matrix, mask, values):
+    """Return the (card id, value) pairs selected by MASK as one list per deck
+    Slicing one flat list is much faster than slicing the arrays deck by deck
+    """
+    pairs = list(zip(matrix.indices[mask].tolist(), values[mask].tolist()))
+    selected = np.zeros(len(mask) + 1, dtype=np.int64)
+    np.cumsum(mask, out=selected[1:])
+    ptr = selected[matrix.indptr].tolist()
+    return [pairs[ptr[i]:ptr[i+1]] for i in range(len(matrix))]
+
+def scoreDeckList(deckList, collection, db_dbf, table=None):
+    """Fill 'lacked', 'alreadyHave' and 'dust' of every item in deckList in one batch
+
+    Args:
+      deckList: A list of dict, each of which has a 'deck' field
+      collection: Cards collection for calculation
+      db_dbf: The all-cards database
+      table: The CardTable of db_dbf, built if it's None
+    Returns:
+      result: The BatchLacks object
+    """
+    if table is None:
+        table = CardTable(db_dbf)
+    matrix = DeckMatrix.fromCardsList([item['deck'].cards for item in deckList])
+    result = calculateBatchLacks(matrix, collection, table)
+    fillDeckList(deckList, result)
+    return result
+
+def fillDeckList(deckList, result):
+    """Fill 'lacked', 'alreadyHave' and 'dust' of every item in deckList from RESULT
+
+    Args:
+      deckList: A list of dict, each of which has a 'deck' field
+      result: The BatchLacks of the decks of deckList, in the same order
+    """
+    matrix = result.matrix
+    lackedLists = _splitPairs(matrix, result.lacked > 0, result.lacked)
+    haveLists = _splitPairs(matrix, result.haveMask, result.have)
+    dust = result.dustIn.tolist()
+    for i, item in enumerate(deckList):
+        item["lacked"] = lackedLists[i]
+        item["alreadyHave"] = haveLists[i]
+        item["dust"] = dust[i]
@@ -0,0 +1,211 @@
+'''
+Benchmark every stage of the advisor on a synthetic deck corpus
+
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+from hearthstone.utils import ElementTree # lxml if it is installed, the same as CardXML.to_xml()
+from hearthstone.cardxml import CardXML
+from hearthstone.deckstrings import Deck
+from hearthstone.enums import CardType, FormatType, GameTag, Rarity
+from collection import Collection
+import deckAdvisor
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench", "cards.csv")
+
+# card class -> the dbf id of its hero card in the fixture
+HEROES = {2: 241, 3: 242, 4: 243, 5: 244, 6: 245, 7: 246, 8: 247, 9: 248, 10: 249}
+NEUTRAL = 12
+
+def loadFixture(path=FIXTURE):
+    """Load the bundled card fixture
+
+    Args:
+      path: The csv file with a header: dbf_id,card_class,rarity,cost,card_set,card_type,name
+    Returns:
+      cards: A list of dict, one per card, the hero cards included
+    """
+    cards = []
+    with open (path, "rt") as f:
+        f.readline()
+        for line in f:
+            dbf_id, cardClass, rarity, cost, cardSet, cardType, name = line.rstrip('\n').split(',', 6)
+            cards.append({"dbf_id": int(dbf_id), "card_class": int(cardClass), "rarity": int(rarity),
+                          "cost": int(cost), "card_set": int(cardSet), "card_type": int(cardType), "name": name})
+    return cards
+
+def deckCards(cards):
+    """Return the fixture cards that can be put in a deck, ie. all but the heroes
+    """
+    return [card for card in cards if card["card_type"] != CardType.HERO]
+
+def writeCardDefs(cards, path):
+    """Write the fixture cards as a CardDefs.xml that hearthstone.cardxml can load
+    """
+    root = ElementTree.Element("CardDefs")
+    for card in cards:
+        xml = CardXML("BENCH_%03d" % card["dbf_id"])
+        xml.dbf_id = card["dbf_id"]
+        for locale in ("enUS", "zhCN"):
+            xml.strings[GameTag.CARDNAME][locale] = card["name"]
+        xml.tags[GameTag.CLASS] = card["card_class"]
+        xml.tags[GameTag.RARITY] = card["rarity"]
+        xml.tags[GameTag.COST] = card["cost"]
+        xml.tags[GameTag.CARD_SET] = card["card_set"]
+        xml.tags[GameTag.CARDTYPE] = card["card_type"]
+        root.append(xml.to_xml())
+    ElementTree.ElementTree(root).write(path, encoding="utf-8")
+
+def makeDeckstring(cards, rng):
+    """Build a valid 30-card deckstring of a random class from the fixture cards
+    """
+    cardClass = rng.choice(sorted(HEROES))
+    pool = [card for card in deckCards(cards) if card["card_class"] in (cardClass, NEUTRAL)]
+    rng.shuffle(pool)
+    deck = Deck()
+    deck.heroes = [HEROES[cardClass]]
+    deck.format = rng.choice([FormatType.FT_STANDARD, FormatType.FT_WILD])
+    total = 0
+    for card in pool:
+        count = 1 if card["rarity"] == Rarity.LEGENDARY else 2
+        count = min(count, 30 - total)
+        deck.cards.append((card["dbf_id"], count))
+        total += count
+        if total >= 30:
+            break
+    return deck.as_deckstring
+
+def generateDecksJSON(path, cards, count, seed=0):
+    """Write COUNT pyspider-shaped json lines into PATH
+    About a tenth of the lines repeat an earlier deckstring, like a real crawl does.
+    """
+    rng = random.Random(seed)
+    deckstrings = []
+    with open (path, "wt") as f:
+        for i in range(count):
+            if deckstrings and rng.random() < 0.1:
+                deckstring = rng.choice(deckstrings)
+            else:
+                deckstring = makeDeckstring(cards, rng)
+                if len(deckstrings) < 10000:
+                    deckstrings.append(deckstring)
+            url = "http://www.hearthpwn.com/decks/%d-bench-deck" % (i + 1)
+            result = {"url": url,
+                      "title": "Bench Deck %d - Hearthstone Decks" % (i + 1),
+                      "deckstring": deckstring,
+                      "date": "Created: %d/%d/%d (Bench)" % (rng.randint(1, 12), rng.randint(1, 28), rng.choice([2016, 2017, 2018])),
+                      "deck-type": "Deck Type: " + rng.choice(["Ranked Deck", "Ranked Deck", "Tavern Brawl", "Theorycraft"]),
+                      "archetype": "Deck Archetype: " + rng.choice(["Unknown", "Aggro", "Midrange", "Control"]),
+                      "rating-sum": str(rng.randint(-10, 100)),
+                      "type": rng.choice(["Standard", "Wild"])}
+            json.dump({"url": url, "updatetime": 1500000000.0 + i, "result": result, "taskid": "%032x" % i}, f)
+            f.write('\n')
+
+def makeCollection(cards, seed=0):
+    """Build a collection owning a random half of the fixture cards
+    """
+    rng = random.Random(seed)
+    collection = Collection()
+    cards = deckCards(cards)
+    for card in rng.sample(cards, len(cards) // 2):
+        collection.add((card["dbf_id"], rng.randint(1, 2)))
+    return collection
+
+class Timer:
+    """Collect the timing of every stage
+    """
+    def __init__(self):
+        self.results = []
+
+    def run(self, scale, stage, func, records=None):
+        """Time FUNC() as STAGE at SCALE, and return its result
+        """
+        start = time.perf_counter()
+        result = func()
+        seconds = time.perf_counter() - start
+        self.results.append({"scale": scale, "stage": stage, "seconds": seconds, "records": records})
+        print ("%8d  %-32s %10.4fs" % (scale, stage, seconds))
+        return result
+
+def benchScale(timer, cards, db, workdir, scale):
+    """Time every pipeline stage on a corpus of SCALE json lines
+    """
+    deckJSON = os.path.join(workdir, "decks_%d.json" % scale)
+    generateDecksJSON(deckJSON, cards, scale, seed=scale)
+    collection = makeCollection(cards)
+    dateLimit = "01/01/2017"
+    ratingLimit = 5
+
+    records = timer.run(scale, "json parse/filter", lambda: list(deckAdvisor.filterDecks(
+        deckAdvisor.decodeJSONLines(deckAdvisor.readLines(deckJSON)), dateLimit, ratingLimit)), scale)
+    timer.run(scale, "json prefilter/parse/filter", lambda: list(deckAdvisor.filterDecks(deckAdvisor.decodeJSONLines(
+        deckAdvisor.prefilterLines(deckAdvisor.readLines(deckJSON), dateLimit, ratingLimit)), dateLimit, ratingLimit)), scale)
+    pairs = timer.run(scale, "deckstring decode", lambda: list(deckAdvisor.checkDeckSize(
+        deckAdvisor.decodeDeckstrings(records))), len(records))
+    pairs = timer.run(scale, "fingerprint dedup", lambda: list(deckAdvisor.dedupDecks(pairs, db)), len(pairs))
+    deckList = list(deckAdvisor.buildDeckDicts(pairs, db))
+
+    def calculateLacks():
+        for item in deckList:
+            item["lacked"], item["alreadyHave"] = collection.calculateLacks(item["deck"].cards)
+    timer.run(scale, "Collection.calculateLacks", calculateLacks, len(deckList))
+
+    def calcArcaneDust():
+        for item in deckList:
+            _, item["dust"] = deckAdvisor.calcArcaneDust(item["lacked"], db)
+    timer.run(scale, "calcArcaneDust", calcArcaneDust, len(deckList))
+
+    timer.run(scale, "batch scoring", lambda: deckAdvisor.scoreDeckList(deckList, collection, db), len(deckList))
+
+    def doubleSort():
+        return sorted(reversed(sorted(deckList, key=lambda item: item['rating-sum'])), key=lambda item: item['dust'])
+    timer.run(scale, "sorting (double sort)", doubleSort, len(deckList))
+    timer.run(scale, "sorting (top-k query)", lambda: list(deckAdvisor.recommendDecks(
+        deckAdvisor.partitionDecks(deckList), top=20, cardClass=4)), len(deckList))
+
+    timer.run(scale, "theMostWantedCards", lambda: [list(x) for x in deckAdvisor.theMostWantedCards(deckList)], len(deckList))
+    timer.run(scale, "theUselessCards", lambda: deckAdvisor.theUselessCards(collection, deckList), len(deckList))
+    os.remove(deckJSON)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the deck advisor on synthetic corpora")
+    parser.add_argument("--scales", default="1000,10000,100000",
+                        help="comma separated corpus sizes, in json lines, eg. 1000,10000,100000,1000000")
+    parser.add_argument("--output", default="outputs/benchmark.json",
+                        help="the json file to write the results into")
+    args = parser.parse_args(argv)
+
+    cards = loadFixture()
+    timer = Timer()
+    workdir = tempfile.mkdtemp(prefix="deckAdvisor-bench-")
+    try:
+        xmlPath = os.path.join(workdir, "CardDefs.xml")
+        writeCardDefs(cards, xmlPath)
+        snapshotDir = os.path.join(workdir, "cache")
+        timer.run(0, "initDatabaseFromXml (xml)", lambda: deckAdvisor.initDatabaseFromXml(xmlPath, snapshotDir=None), len(cards))
+        timer.run(0, "initDatabaseFromXml (build)", lambda: deckAdvisor.initDatabaseFromXml(xmlPath, snapshotDir=snapshotDir), len(cards))
+        db = timer.run(0, "initDatabaseFromXml (snapshot)", lambda: deckAdvisor.initDatabaseFromXml(xmlPath, snapshotDir=snapshotDir), len(cards))
+        for scale in [int(x) for x in args.scales.split(',')]:
+            benchScale(timer, cards, db, workdir, scale)
+    finally:
+        shutil.rmtree(workdir)
+
+    directory = os.path.dirname(args.output)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open (args.output, "wt") as f:
+        json.dump({"time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "python": sys.version.split()[0],
+                   "platform": platform.platform(),
+                   "results": timer.results}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
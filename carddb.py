@@ -0,0 +1,343 @@
+'''
+Compiled snapshot of the DBF card database
+
+'''
+
+import os
+import pickle
+import hashlib
+import threading
+from array import array
+from collections.abc import Mapping
+import numpy as np
+from hearthstone.cardxml import load
+from hearthstone.enums import Rarity, CardClass
+
+SNAPSHOT_MAGIC = b"DADB"
+SNAPSHOT_VERSION = 2
+DISPLAY_MAGIC = b"DADN"
+FIELD_SEPARATOR = "\x1f" # Between the name and the text of a card in the display file
+
+class DisplayStore:
+    """The display data (name, text) of the cards, read from the display file on first access
+    The file holds the utf-8 records of all cards back to back, the offsets of
+    the records are kept in the numeric snapshot. Only the cards printed are
+    ever read and decoded, and they are cached.
+    The file is opened with the snapshot, so a rebuild replacing or removing it
+    later doesn't change the records read through the offsets.
+    """
+    def __init__(self, path, offsets):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          path: The display file written by writeDisplay()
+          offsets: Record i is the bytes [offsets[i], offsets[i+1]) of the file
+        Raises:
+          OSError: If the file can't be opened, or its size doesn't match the offsets
+        """
+        self.path = path
+        self.offsets = offsets
+        self.cache = {} # position -> (name, text)
+        self.file = open(path, "rb")
+        self.lock = threading.Lock()
+        if os.fstat(self.file.fileno()).st_size != offsets[-1]:
+            self.file.close()
+            raise OSError("the display file doesn't match the snapshot: %s" % path)
+
+    def lookup(self, position):
+        """Return (name, text) of the card at POSITION of the snapshot
+        """
+        fields = self.cache.get(position)
+        if fields != None:
+            return fields
+        with self.lock:
+            self.file.seek(self.offsets[position])
+            data = self.file.read(self.offsets[position + 1] - self.offsets[position])
+        name, text = data.decode("utf-8").split(FIELD_SEPARATOR, 1)
+        fields = (name, text)
+        self.cache[position] = fields
+        return fields
+
+    def __getstate__(self):
+        # Sent to the ingestion workers without the open file
+        return (self.path, self.offsets)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+class CardRecord:
+    """A light-weight card
+    Holds only the numeric fields of a hearthstone Card that the advisor uses,
+    the name and the text are resolved through a DisplayStore when asked for.
+    """
+    __slots__ = ("dbf_id", "card_class", "rarity", "cost", "card_set", "position", "display")
+
+    def __init__(self, dbf_id, card_class, rarity, cost, card_set, position, display):
+        self.dbf_id = dbf_id
+        self.card_class = card_class
+        self.rarity = rarity
+        self.cost = cost
+        self.card_set = card_set
+        self.position = position # The position of the card in the snapshot
+        self.display = display # The DisplayStore of the snapshot
+
+    @property
+    def name(self):
+        return self.display.lookup(self.position)[0]
+
+    @property
+    def description(self):
+        return self.display.lookup(self.position)[1]
+
+    def __repr__(self):
+        return "<%d: %r>" % (self.dbf_id, self.name)
+
+def _toEnum(enum, value):
+    """Convert an int back to ENUM, keep the int if it's an unknown value
+    """
+    try:
+        return enum(value)
+    except ValueError:
+        return value
+
+def snapshotPath(directory, locale):
+    """Return the snapshot file's path for LOCALE under DIRECTORY
+    """
+    return os.path.join(directory, "CardDefs.%s.snapshot" % locale)
+
+def displayPath(path, digest):
+    """Return the display file's path of the snapshot file PATH, compiled from the xml file of sha1 DIGEST
+    A rebuild from another xml file writes another display file, and never
+    replaces the file a running process reads.
+    """
+    return "%s.%s.display" % (os.path.splitext(path)[0], digest[:12])
+
+def fileDigest(path):
+    """Return the sha1 hex digest of the file PATH
+    """
+    sha1 = hashlib.sha1()
+    with open (path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def databaseDigest(db_dbf):
+    """Return a hex digest of the card fields the scores depend on: dbf_id, class, rarity, cost and set
+    The results cached against a collection are only valid for the same digest,
+    eg. the dust of a deck changes with the rarity of a card.
+
+    Args:
+      db_dbf: A CardDatabase, or a dbf_id -> hearthstone Card dict
+    """
+    sha1 = hashlib.sha1()
+    if isinstance(db_dbf, CardDatabase):
+        for column in db_dbf.columns:
+            sha1.update(bytes(column))
+            sha1.update(b";")
+        return sha1.hexdigest()
+    for dbf_id in sorted(db_dbf):
+        card = db_dbf[dbf_id]
+        sha1.update(("%d,%d,%d,%d,%d;" % (dbf_id, int(card.card_class), int(card.rarity), card.cost, int(card.card_set))).encode())
+    return sha1.hexdigest()
+
+def compileDatabase(xmlPath, locale):
+    """Parse CardDefs.xml and compile it into snapshot columns
+
+    Args:
+      xmlPath: The CardDefs.xml to parse
+      locale: The language setting for database
+    Returns:
+      columns: A tuple of int arrays (dbf_id, card_class, rarity, cost, card_set)
+      display: A list of (name, text), in the same order
+    """
+    db, xml = load(xmlPath, locale=locale)
+    columns = (array('i'), array('i'), array('i'), array('i'), array('i'))
+    display = []
+    for card in db.values():
+        columns[0].append(card.dbf_id)
+        columns[1].append(int(card.card_class))
+        columns[2].append(int(card.rarity))
+        columns[3].append(card.cost)
+        columns[4].append(int(card.card_set))
+        display.append((card.name or "", (card.description or "").replace(FIELD_SEPARATOR, " ")))
+    return columns, display
+
+def writeDisplay(path, display):
+    """Write the display file atomically
+
+    Args:
+      path: The display file to write
+      display: The list of (name, text) produced by compileDatabase()
+    Returns:
+      offsets: The offsets of the records in the file, an array of len(display) + 1
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    offsets = array('q', [len(DISPLAY_MAGIC)])
+    tmpPath = path + ".tmp"
+    with open (tmpPath, "wb") as f:
+        f.write(DISPLAY_MAGIC)
+        for name, text in display:
+            data = (name + FIELD_SEPARATOR + text).encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    os.replace(tmpPath, path)
+    return offsets
+
+def readSnapshot(path):
+    """Read a snapshot file
+
+    Args:
+      path: The snapshot file to read
+    Returns:
+      (key, columns, offsets), or None if the file is missing or not a valid snapshot
+    """
+    try:
+        with open (path, "rb") as f:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                return None
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+
+def writeSnapshot(path, key, columns, offsets):
+    """Write a snapshot file atomically
+
+    Args:
+      path: The snapshot file to write
+      key: The dict identifying the xml file and locale
+      columns: The columns produced by compileDatabase()
+      offsets: The offsets of the display file, returned by writeDisplay()
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmpPath = path + ".tmp"
+    with open (tmpPath, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        pickle.dump((key, columns, offsets), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmpPath, path)
+
+class CardDatabase(Mapping):
+    """The dbf_id -> CardRecord database over the numeric snapshot columns
+    It's a read-only dict to the callers. The columns are kept as int arrays,
+    and a CardRecord is only built the first time its card is looked up.
+    """
+    def __init__(self, columns, display):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          columns: The numeric columns of the snapshot, (dbf_id, card_class, rarity, cost, card_set)
+          display: The DisplayStore the names are resolved through
+        """
+        self.columns = columns # Kept for pickling
+        self.dbfIds = np.frombuffer(columns[0], dtype=np.int32) if len(columns[0]) else np.zeros(0, dtype=np.int32)
+        self.cardClasses = np.frombuffer(columns[1], dtype=np.int32) if len(columns[1]) else np.zeros(0, dtype=np.int32)
+        self.rarities = np.frombuffer(columns[2], dtype=np.int32) if len(columns[2]) else np.zeros(0, dtype=np.int32)
+        self.costs = np.frombuffer(columns[3], dtype=np.int32) if len(columns[3]) else np.zeros(0, dtype=np.int32)
+        self.cardSets = np.frombuffer(columns[4], dtype=np.int32) if len(columns[4]) else np.zeros(0, dtype=np.int32)
+        self.display = display
+        size = int(self.dbfIds.max()) + 1 if len(self.dbfIds) else 0
+        self.positions = np.full(size, -1, dtype=np.int32) # dbf_id -> position in the columns, -1 if unknown
+        self.positions[self.dbfIds] = np.arange(len(self.dbfIds), dtype=np.int32)
+        self.records = {} # dbf_id -> the CardRecord built
+        # Share one enum object for every value instead of converting card by card
+        self.classEnums = dict((value, _toEnum(CardClass, value)) for value in np.unique(self.cardClasses).tolist())
+        self.rarityEnums = dict((value, _toEnum(Rarity, value)) for value in np.unique(self.rarities).tolist())
+
+    def __getitem__(self, dbf_id):
+        record = self.records.get(dbf_id)
+        if record != None:
+            return record
+        if not isinstance(dbf_id, (int, np.integer)) or not 0 <= dbf_id < len(self.positions)\
+           or self.positions[dbf_id] < 0:
+            raise KeyError(dbf_id)
+        position = int(self.positions[dbf_id])
+        record = CardRecord(int(dbf_id), self.classEnums[int(self.cardClasses[position])],
+                            self.rarityEnums[int(self.rarities[position])], int(self.costs[position]),
+                            int(self.cardSets[position]), position, self.display)
+        self.records[dbf_id] = record
+        return record
+
+    def __contains__(self, dbf_id):
+        return isinstance(dbf_id, (int, np.integer)) and 0 <= dbf_id < len(self.positions) and self.positions[dbf_id] >= 0
+
+    def __iter__(self):
+        return iter(self.dbfIds.tolist())
+
+    def __len__(self):
+        return len(self.dbfIds)
+
+    def __getstate__(self):
+        # Sent to the ingestion workers without the records built
+        return (self.columns, self.display)
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+def columnsToDatabase(columns, display):
+    """Build the dbf_id -> CardRecord database from snapshot columns
+
+    Args:
+      columns: The numeric columns of the snapshot
+      display: The DisplayStore the names are resolved through
+    """
+    return CardDatabase(columns, display)
+
+def loadDatabase(xmlPath, locale, path, rebuild=False):
+    """Load the DBF database through the snapshot file PATH
+    The snapshot is keyed by the xml file's size, mtime and sha1 plus the locale.
+    It's rebuilt when the key doesn't match, eg. after hsdata is updated.
+    Only the numeric columns are loaded, the names and texts stay in the
+    display file next to it until a card's name is asked for.
+
+    Args:
+      xmlPath: The CardDefs.xml the snapshot is compiled from
+      locale: The language setting for database
+      path: The snapshot file
+      rebuild: If True, rebuild the snapshot even if it is up to date
+    Returns:
+      db_dbf: The all-cards database
+    """
+    stat = os.stat(xmlPath)
+    snapshot = None if rebuild else readSnapshot(path)
+    if snapshot != None and len(snapshot) == 3:
+        key, columns, offsets = snapshot
+        if key.get("version") == SNAPSHOT_VERSION and key.get("locale") == locale\
+           and key.get("size") == stat.st_size:
+            if key.get("mtime") != stat.st_mtime_ns:
+                # The file is touched, only trust the snapshot if the content is the same
+                if key.get("sha1") != fileDigest(xmlPath):
+                    snapshot = None
+                else:
+                    key["mtime"] = stat.st_mtime_ns
+                    writeSnapshot(path, key, columns, offsets)
+            if snapshot != None:
+                try:
+                    return columnsToDatabase(columns, DisplayStore(displayPath(path, key["sha1"]), offsets))
+                except OSError:
+                    pass # The display file is missing or removed, rebuild both
+
+    key = {"version": SNAPSHOT_VERSION,
+           "locale": locale,
+           "size": stat.st_size,
+           "mtime": stat.st_mtime_ns,
+           "sha1": fileDigest(xmlPath)}
+    columns, display = compileDatabase(xmlPath, locale)
+    displayFile = displayPath(path, key["sha1"])
+    offsets = writeDisplay(displayFile, display)
+    writeSnapshot(path, key, columns, offsets)
+    database = columnsToDatabase(columns, DisplayStore(displayFile, offsets))
+    # The display files of the older snapshots, the processes still reading them have them open
+    prefix = os.path.basename(os.path.splitext(path)[0]) + "."
+    directory = os.path.dirname(path) or "."
+    for name in os.listdir(directory):
+        if name.startswith(prefix) and name.endswith(".display") and name != os.path.basename(displayFile):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+    return database
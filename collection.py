@@ -3,6 +3,7 @@
 
 '''
 
+import hashlib
 from hearthstone.deckstrings import Deck
 
 # TODO: handle exceptions
@@ -17,6 +18,7 @@ class Collection:
         self.collect_db = {}  # The card collection database
         self.num_of_cards = 0 # How many kinds of cards
         self.total_num_cards = 0 # How many cards
+        self.listeners = [] # Called with the changed card ids after every change
        
     def writeToFiles(self, path):
         """Write the database into a file with path PATH
@@ -59,6 +61,7 @@ class Collection:
             self.collect_db[cardPair[0]] = cardPair[1]
             self.num_of_cards += 1
         self.total_num_cards += cardPair[1]
+        self.notify([cardPair[0]])
 
     def output(self):
         """Print the database and the statistic number
@@ -78,10 +81,53 @@ class Collection:
         """
         if max_card_count < 1:
             return
+        changed = []
         for card in self.collect_db:
             if self.collect_db[card] > max_card_count:
                 self.total_num_cards -= (self.collect_db[card] - max_card_count)
                 self.collect_db[card] = max_card_count
+                changed.append(card)
+        if changed:
+            self.notify(changed)
+
+    def addListener(self, listener):
+        """Register a listener of the database changes
+
+        Args:
+          listener: A callable, called with the list of changed card ids
+        """
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        """Unregister a listener added by addListener()
+        """
+        self.listeners.remove(listener)
+
+    def notify(self, cards):
+        """Tell the listeners that CARDS are changed
+
+        Args:
+          cards: A list of card ids
+        """
+        for listener in self.listeners:
+            listener(cards)
+
+    def __getstate__(self):
+        # Sent to the ingestion workers without the listeners, eg. an IncrementalScorer and its matrix
+        state = self.__dict__.copy()
+        state["listeners"] = []
+        return state
+
+    def fingerprint(self):
+        """Return a hex digest of the collection's content
+        Two collections with the same cards and counts get the same fingerprint.
+        The cards kept with a count of 0 are included: calculateLacks() reports
+        them as already had with 0 copies, and the useless card report lists them.
+        """
+        sha1 = hashlib.sha1()
+        for card, count in sorted(self.collect_db.items()):
+            sha1.update(("%d,%d;" % (card, count)).encode())
+        return sha1.hexdigest()
 
     def ows(self, card):
         """Return the count of card
@@ -95,16 +141,20 @@ class Collection:
         else:
             return self.collect_db[card]
 
-    def initFromDeckStringFile(self, path):
+    def initFromDeckStringFile(self, path, deckCache=None):
         """Init the database from a deckstring file
         The file should contain a set of deckstrings, every string in a line
 
         Args:
           path: The deckstring file's path
+          deckCache: A DeckCache to decode the deckstrings through, or None
         """
         with open (path, "rt") as f:
             for line in f.readlines():
-                deck = Deck.from_deckstring(line)
+                if deckCache != None:
+                    deck = deckCache.decode(line)
+                else:
+                    deck = Deck.from_deckstring(line)
                 for cardPair in deck.cards:
                     self.add(cardPair)
 
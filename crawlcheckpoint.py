@@ -0,0 +1,153 @@
+'''
+Checkpoint of an incremental hearthpwn crawl
+
+'''
+
+import os
+import re
+import json
+
+CHECKPOINT_VERSION = 1
+
+DECK_URL = re.compile(r"/decks/(\d+)")
+
+def deckIdFromUrl(url):
+    """Return the deck id in a deck url, eg. 816143 in http://www.hearthpwn.com/decks/816143-mid-paladins
+    or None if it isn't a deck url
+    """
+    match = DECK_URL.search(url)
+    return int(match.group(1)) if match != None else None
+
+class CrawlCheckpoint:
+    """What the previous crawls have seen, persisted as a json file
+    A deck is known if it was crawled and hasn't been updated since, so only the
+    new and the updated decks are fetched, and the index pages are followed
+    only until a page lists nothing but known decks.
+    An interrupted crawl is resumed: the decks listed but not crawled yet are
+    kept as pending, and the index pages the crawl stopped before as the
+    frontier, so the next crawl picks them up after the pages that changed.
+    Only the decks within WINDOW ids of the highest deck id crawled keep their
+    update times, the older ones are known by their id only, so the
+    checkpoint stays bounded however long the crawls go on.
+    """
+    def __init__(self, path, saveEvery=100, window=100000):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          path: The json file the checkpoint is kept in
+          saveEvery: Save after this many decks are marked by markSeen()
+          window: The decks with an id within it below maxDeckId keep their update times, see prune()
+        """
+        self.path = path
+        self.saveEvery = saveEvery
+        self.window = window
+        self.maxDeckId = 0 # The highest deck id crawled
+        self.floorDeckId = 0 # The decks up to it are known, their dates are pruned
+        self.decks = {} # deck id -> the last update time (epoch) the deck is crawled at, 0 if unknown
+        self.validators = {} # url -> {"etag": ..., "lastModified": ...} of the last response
+        self.pending = {} # deck url -> update time or None, the decks listed but not crawled yet
+        self.frontier = [] # The index page urls the interrupted crawls stopped before, the latest crawl first
+        self.unsaved = 0 # How many marks are not saved yet
+        if os.path.exists(path):
+            with open (path, "rt") as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("version") == CHECKPOINT_VERSION:
+                self.maxDeckId = checkpoint["maxDeckId"]
+                self.floorDeckId = checkpoint["floorDeckId"]
+                self.decks = dict((int(deckId), updated) for deckId, updated in checkpoint["decks"].items())
+                self.validators = checkpoint["validators"]
+                self.pending = checkpoint.get("pending", {})
+                self.frontier = checkpoint.get("frontier", [])
+
+    def isKnown(self, deckId, updated=None):
+        """Return whether deck DECKID is crawled already and not updated since
+
+        Args:
+          deckId: The deck id
+          updated: The update time (epoch) the index page shows for the deck, or None
+        """
+        if deckId in self.decks:
+            return updated == None or updated <= self.decks[deckId]
+        return deckId <= self.floorDeckId
+
+    def markSeen(self, deckId, updated=None):
+        """Record that deck DECKID is crawled, at update time UPDATED if it's known
+        """
+        self.decks[deckId] = max(updated or 0, self.decks.get(deckId, 0))
+        self.maxDeckId = max(self.maxDeckId, deckId)
+        self.unsaved += 1
+        if self.unsaved >= self.saveEvery:
+            self.save()
+
+    def newDecks(self, decks):
+        """Return the decks of an index page still to be crawled
+
+        Args:
+          decks: A list of (url, updated), updated is the update time (epoch) or None
+        Returns:
+          decks: The (url, updated) of the unknown decks
+        """
+        return [(url, updated) for url, updated in decks
+                if deckIdFromUrl(url) != None and not self.isKnown(deckIdFromUrl(url), updated)]
+
+    def conditionalHeaders(self, url):
+        """Return the headers making a request of URL conditional on the last response
+        """
+        headers = {}
+        validator = self.validators.get(url)
+        if validator != None:
+            if validator.get("etag"):
+                headers["If-None-Match"] = validator["etag"]
+            if validator.get("lastModified"):
+                headers["If-Modified-Since"] = validator["lastModified"]
+        return headers
+
+    def storeValidators(self, url, headers):
+        """Keep the ETag and Last-Modified of a response of URL for the next request
+
+        Args:
+          url: The url requested
+          headers: The response headers, a dict-like object
+        """
+        etag = headers.get("ETag")
+        lastModified = headers.get("Last-Modified")
+        if etag or lastModified:
+            self.validators[url] = {"etag": etag, "lastModified": lastModified}
+
+    def prune(self):
+        """Forget the update times, the validators and the pending crawls of the decks more than WINDOW ids below maxDeckId
+        The forgotten decks are still known, but their updates are not noticed any more.
+        """
+        floor = self.maxDeckId - self.window
+        if floor <= self.floorDeckId:
+            return
+        self.floorDeckId = floor
+        for deckId in [deckId for deckId in self.decks if deckId <= floor]:
+            del self.decks[deckId]
+        for url in list(self.validators):
+            deckId = deckIdFromUrl(url)
+            if deckId != None and deckId <= floor:
+                del self.validators[url]
+        for url in list(self.pending):
+            if deckIdFromUrl(url) <= floor:
+                del self.pending[url]
+
+    def save(self):
+        """Prune the checkpoint and write it into the checkpoint file
+        """
+        self.prune()
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmpPath = self.path + ".tmp"
+        with open (tmpPath, "wt") as f:
+            json.dump({"version": CHECKPOINT_VERSION,
+                       "maxDeckId": self.maxDeckId,
+                       "floorDeckId": self.floorDeckId,
+                       "decks": self.decks,
+                       "validators": self.validators,
+                       "pending": self.pending,
+                       "frontier": self.frontier}, f)
+        os.replace(tmpPath, self.path)
+        self.unsaved = 0
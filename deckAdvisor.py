@@ -4,32 +4,419 @@
 '''
 
 import os
+import re
+import time
 import json
+import argparse
+import heapq
 import operator
+import functools
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime as dt
 from hearthstone.deckstrings import Deck
-from hearthstone.enums import FormatType
 from hearthstone.cardxml import load
-from hearthstone.enums import Locale,Rarity,CardClass
+from hearthstone.enums import Rarity,CardClass
 from collection import Collection
+import carddb
+from batch import CardTable, DeckMatrix, scoreDeckList, calculateMultiLacks, fillDeckList
+from deckcache import DeckCache
+from planner import planCrafts, outputCraftPlan
+from resultstore import writeResultStore
+from stats import Stats
+from fingerprint import deckFingerprint, deckClass, dedupByFingerprint
+from filtercache import FilterCache
+from similarity import SimilarityIndex, collapseNearDuplicates
+from deckindex import DeckIndex
+from heavyhitters import CardReports
+from deckcorpus import PartitionedCorpus
+from followstate import FollowState
+from archetypes import ArchetypeModel, chunked
 
-def initDatabaseFromXml(path, locale="zhCN"):
+def initDatabaseFromXml(path, locale="zhCN", snapshotDir="cache", rebuild=False):
     """Load card database from CardDefs.xml
     and use it to initialize DBF database
 
     Args:
       path: The xml file to load for init
       locale: The language setting for database
+      snapshotDir: Where the compiled database snapshot is kept.
+        If it's None, parse the xml file directly.
+      rebuild: Force rebuilding the snapshot
     Returns:
       db_dbf: The all-cards database
     """
+    if snapshotDir != None:
+        return carddb.loadDatabase(path, locale, carddb.snapshotPath(snapshotDir, locale), rebuild)
     db, xml = load(path, locale=locale)
     db_dbf = {}
     for card in db:
         db_dbf[db[card].dbf_id] = db[card]
     return db_dbf
 
-def calculateLacksFromFile(path, collection, db_dbf):
+def readLines(path):
+    """Yield the lines of file PATH one by one
+
+    Args:
+      path: The file to read
+    """
+    with open (path, "rt") as f:
+        for line in f:
+            yield line
+
+# The fields prefilterLines() looks at, without decoding the json line
+DATE_FIELD = re.compile(r'"date"\s*:\s*"([^"\\]*)"')
+RATING_FIELD = re.compile(r'"rating-sum"\s*:\s*"?\s*(-?\d+)\s*"?\s*[,}]')
+
+@functools.lru_cache(maxsize=65536)
+def parseDate(text):
+    """Parse the date of a deck, eg. "Created: 7/5/2017 (Patch)", into an int YYYYMMDD
+    It's what dt.strptime(text.split(' ')[1], "%m/%d/%Y") accepts, but much cheaper.
+
+    Args:
+      text: The 'date' field of a deck dict
+    Returns:
+      date: The int YYYYMMDD, or None if it can't be parsed, leave it to dt.strptime() then
+    """
+    fields = text.split(' ')
+    if len(fields) < 2:
+        return None
+    parts = fields[1].split('/')
+    if len(parts) != 3 or not all(part.isdigit() for part in parts):
+        return None
+    month, day, year = int(parts[0]), int(parts[1]), int(parts[2])
+    if len(parts[0]) > 2 or len(parts[1]) > 2 or len(parts[2]) != 4 or not (1 <= month <= 12 and 1 <= day <= 31):
+        return None
+    return year * 10000 + month * 100 + day
+
+def dateLimitKey(dateLimit):
+    """Convert a M/D/YYYY date limit into an int YYYYMMDD
+    """
+    date = dt.strptime(dateLimit, "%m/%d/%Y")
+    return date.year * 10000 + date.month * 100 + date.day
+
+def prefilterLines(lines, dateLimit="07/01/2017", ratingLimit=20, stats=None):
+    """Drop the json lines of old and low rated decks before decoding them
+    Only the 'date' and 'rating-sum' fields are picked out of the line. A line
+    they can't be found in passes through, filterByDate() and filterByRating()
+    make the final decision on the decoded dicts.
+
+    Args:
+      lines: An iterable of json lines
+      dateLimit: A date string, we only consider the decks newer than that
+      ratingLimit: An int, drop the decks who's 'rating-sum' is smaller than it
+      stats: A Stats to count the dropped decks in, or None
+    """
+    limit = dateLimitKey(dateLimit)
+    searchDate = DATE_FIELD.search
+    searchRating = RATING_FIELD.search
+    for line in lines:
+        match = searchDate(line)
+        if match == None:
+            yield line
+            continue
+        date = parseDate(match.group(1))
+        if date == None:
+            yield line
+            continue
+        if date < limit:
+            if stats != None:
+                stats.drop("too old")
+            continue
+        match = searchRating(line)
+        if match != None and int(match.group(1)) < ratingLimit:
+            if stats != None:
+                stats.drop("low rating")
+            continue
+        yield line
+
+def decodeJSONLines(lines):
+    """Decode every json line into a deck dict
+
+    Args:
+      lines: An iterable of json lines
+    Yields:
+      data: The deck dict, unwrapped if the line is produced by pyspider directly
+    """
+    for line in lines:
+        linedict = json.loads(line)
+        if linedict.get('result') != None: # A json file produced by pyspider directly
+            yield linedict['result']
+        else:
+            yield linedict
+
+def filterByDate(records, dateLimit="07/01/2017", stats=None):
+    """Drop the decks older than dateLimit
+
+    Args:
+      records: An iterable of deck dicts produced by decodeJSONLines()
+      dateLimit: A date string, we only consider the decks newer than that
+      stats: A Stats to count the dropped decks in, or None
+    """
+    limit = dateLimitKey(dateLimit)
+    for data in records:
+        deckCreatedDate = parseDate(data['date'])
+        if deckCreatedDate == None:
+            deckCreatedDate = dateLimitKey(data['date'].split(' ')[1])
+        if limit > deckCreatedDate: # Ignore old decks
+            if stats != None:
+                stats.drop("too old")
+            continue
+        yield data
+
+def filterByRating(records, ratingLimit=20, stats=None):
+    """Drop the decks with small rank points
+
+    Args:
+      records: An iterable of deck dicts
+      ratingLimit: An int, ignore the decks who's 'rating-sum' is smaller than it
+      stats: A Stats to count the dropped decks in, or None
+    """
+    for data in records:
+        deckRating = int(data['rating-sum'])
+        if ratingLimit > deckRating: # Ignore decks with small rank points
+            if stats != None:
+                stats.drop("low rating")
+            continue
+        yield data
+
+def filterDecks(records, dateLimit="07/01/2017", ratingLimit=20, stats=None):
+    """Drop the old and low rated decks, the duplicates are dropped by dedupDecks() after decoding
+    Unlike the old single loop, which marked a deckstring seen before its rating was checked, a copy
+    dropped here (or by checkDeckSize()) doesn't hide a later copy of the same deck that passes.
+
+    Args:
+      records: An iterable of deck dicts produced by decodeJSONLines()
+      dateLimit: A date string, we only consider the decks newer than that
+      ratingLimit: An int, ignore the decks who's 'rating-sum' is smaller than it
+      stats: A Stats to count the dropped decks in, or None
+    Yields:
+      data: The deck dicts that pass the filter
+    """
+    return filterByRating(filterByDate(records, dateLimit, stats), ratingLimit, stats)
+
+def decodeDeckstrings(records, deckCache=None, stats=None):
+    """Decode the deckstring of every deck dict
+
+    Args:
+      records: An iterable of dicts with a 'deckstring' field
+      deckCache: A DeckCache to look the deckstrings up first, or None
+      stats: A Stats to count the dropped decks in, or None
+    Yields:
+      (data, deck): The dict and its decoded Deck, the undecodable ones are dropped
+    """
+    decode = deckCache.decode if deckCache != None else Deck.from_deckstring
+    for data in records:
+        try:
+            deck = decode(data['deckstring'])
+        except:
+            print("exception catched, dechstring:", data['deckstring'])
+            if stats != None:
+                stats.drop("undecodable")
+            continue
+        yield data, deck
+
+def checkDeckSize(pairs, size=30, stats=None):
+    """Drop the decks containing less than SIZE cards
+
+    Args:
+      pairs: An iterable of (data, deck) produced by decodeDeckstrings()
+      size: The minimal number of cards in a deck
+      stats: A Stats to count the dropped decks in, or None
+    """
+    for data, deck in pairs:
+        cardsInDeck = 0
+        for cardPair in deck.cards:
+            cardsInDeck += cardPair[1]
+        if cardsInDeck < size:
+            if stats != None:
+                stats.drop("too few cards")
+            continue
+        yield data, deck
+
+def dedupDecks(pairs, db_dbf, keep="first", stats=None, fingerprints=None):
+    """Drop the copies of the same deck by its canonical fingerprint
+    The deckstrings of a deck differing in hero, card order or format are copies.
+
+    Args:
+      pairs: An iterable of (data, deck) produced by decodeDeckstrings()
+      db_dbf: The database of all cards
+      keep: "first" or "best" (the highest 'rating-sum'), see fingerprint.dedupByFingerprint()
+      stats: A Stats to count the dropped decks in, or None
+      fingerprints: A list to append the fingerprint of every deck kept into, or None
+    """
+    triples = ((deckFingerprint(deck.cards, deckClass(deck, db_dbf)), data, deck) for data, deck in pairs)
+    for fingerprint, data, deck in dedupByFingerprint(triples, operator.itemgetter(0),
+                                                      lambda triple: int(triple[1]['rating-sum']), keep, stats):
+        if fingerprints != None:
+            fingerprints.append(fingerprint)
+        yield data, deck
+
+def writeFilteredJSON(pairs, path):
+    """Store the deck dicts passing through into the json file PATH
+
+    Args:
+      pairs: An iterable of (data, deck)
+      path: The json file to write
+    """
+    with open (path, "wt") as JSONOut:
+        for data, deck in pairs:
+            json.dump(data, JSONOut)
+            JSONOut.write('\n')
+            yield data, deck
+
+def buildDeckDicts(pairs, db_dbf):
+    """Build the result dicts, without the lacked cards calculated
+
+    Args:
+      pairs: An iterable of (data, deck)
+      db_dbf: The database of all cards
+    """
+    for data, deck in pairs:
+        newdict = {}
+        newdict["name"] = data['title'].split('-')[0]
+        newdict["url"] = data['url']
+        newdict["date"] = data['date'].split(' ')[1]
+        newdict["type"] = data['type']
+        newdict["rating-sum"] = int(data['rating-sum'])
+        newdict["deck-type"] = data['deck-type'].split(':')[1]
+        newdict["archetype"] = data['archetype'].split(':')[1]
+        newdict["deck"] = deck
+        newdict["deckstring"] = data['deckstring']
+        newdict["cardclass"] = calcCardClass(deck.cards, db_dbf)
+        newdict["power"] = 1
+        yield newdict
+
+def scoreDecks(records, collection, db_dbf):
+    """Calculate the lacked cards and dust in need of every result dict
+
+    Args:
+      records: An iterable of result dicts
+      collection: Cards collection for calculation
+      db_dbf: The database of all cards
+    """
+    for newdict in records:
+        newdict["lacked"], newdict["alreadyHave"] = collection.calculateLacks(newdict["deck"].cards)
+        _, newdict["dust"] = calcArcaneDust(newdict["lacked"], db_dbf)
+        yield newdict
+
+def scoreDecksBatched(records, collection, db_dbf, chunkSize=4096):
+    """The same as scoreDecks(), but score CHUNKSIZE decks at a time with batch.scoreDeckList()
+
+    Args:
+      records: An iterable of result dicts
+      collection: Cards collection for calculation
+      db_dbf: The database of all cards
+      chunkSize: How many decks to score in one batch
+    """
+    table = CardTable(db_dbf)
+    chunk = []
+    for newdict in records:
+        chunk.append(newdict)
+        if len(chunk) >= chunkSize:
+            scoreDeckList(chunk, collection, db_dbf, table)
+            yield from chunk
+            chunk = []
+    if chunk:
+        scoreDeckList(chunk, collection, db_dbf, table)
+        yield from chunk
+
+def scoreCollections(deckList, collections, db_dbf):
+    """Score the decks of deckList for many collections in one pass, with batch.calculateMultiLacks()
+    The deck list is decoded and filtered once, for instance by
+    calculateLacksFromJSONFile() with no collection.
+
+    Args:
+      deckList: A list of unscored result dicts
+      collections: A list of Collection
+      db_dbf: The database of all cards
+    Yields:
+      newlist: The results of every collection in order, shallow copies of the dicts of deckList
+    """
+    matrix = DeckMatrix.fromCardsList([item['deck'].cards for item in deckList])
+    for result in calculateMultiLacks(matrix, collections, CardTable(db_dbf)):
+        newlist = [dict(item) for item in deckList]
+        fillDeckList(newlist, result)
+        yield newlist
+
+def buildUnknownDeckDicts(pairs):
+    """Build the result dicts of bare deckstrings, all the other fields are "Unknown"
+
+    Args:
+      pairs: An iterable of (data, deck)
+    """
+    for data, deck in pairs:
+        newdict = {}
+        newdict["name"] = "Deck name"
+        newdict["url"] = "Unknown"
+        newdict["date"] = "Unknown"
+        newdict["type"] = "Unknown"
+        newdict["rating-sum"] = "Unknown"
+        newdict["deck-type"] = "Unknown"
+        newdict["rarchetype"] = "Unknown"
+        newdict["deck"] = deck
+        newdict["deckstring"] = data["deckstring"]
+        newdict["power"] = 1
+        yield newdict
+
+def indexDecks(records, index):
+    """Add every scored result dict passing through into a DeckIndex
+    The deck id is the position of the deck in the stream.
+
+    Args:
+      records: An iterable of scored result dicts
+      index: The DeckIndex to fill
+    """
+    for newdict in records:
+        index.add(index.num_of_decks, newdict["deck"].cards, newdict["lacked"])
+        yield newdict
+
+def indexSimilarDecks(records, similarityIndex):
+    """Add every result dict passing through into a SimilarityIndex
+    The deck id is the position of the deck in the stream.
+
+    Args:
+      records: An iterable of result dicts
+      similarityIndex: The SimilarityIndex to fill
+    """
+    for newdict in records:
+        similarityIndex.add(newdict["deck"].cards)
+        yield newdict
+
+def countCardReports(records, reports):
+    """Count the cards of every scored result dict passing through into a heavyhitters.CardReports
+    """
+    for newdict in records:
+        reports.add(newdict)
+        yield newdict
+
+def labelArchetypes(records, model, update=False):
+    """Set the archetype cluster 'cluster' of every result dict passing through
+    The decks are vectorized a batch of model.batchSize at a time.
+
+    Args:
+      records: An iterable of result dicts
+      model: The archetypes.ArchetypeModel
+      update: Fit the batches into the model with partialFit(), so new decks move
+        the clusters too, or only assign them to the closest cluster
+    """
+    for chunk in chunked(records, model.batchSize):
+        cardsList = [newdict["deck"].cards for newdict in chunk]
+        clusters = model.partialFit(cardsList) if update else model.assign(cardsList)[0]
+        for newdict, cluster in zip(chunk, clusters):
+            newdict["cluster"] = int(cluster)
+            yield newdict
+
+def iterLacksFromFile(path, collection, db_dbf, deckCache=None):
+    """The streaming version of calculateLacksFromFile()
+
+    Yields:
+      newdict: The result for a deck
+    """
+    pairs = checkDeckSize(decodeDeckstrings(({"deckstring": line} for line in readLines(path)), deckCache))
+    return scoreDecks(buildUnknownDeckDicts(pairs), collection, db_dbf)
+
+def calculateLacksFromFile(path, collection, db_dbf, deckCache=None):
     """Calculate the lacked cards from decks stored in file PATH.
     The file should contain a set of deckstrings, every string in a line.
     This may will be removed in the future,
@@ -39,103 +426,366 @@ def calculateLacksFromFile(path, collection, db_dbf):
       path: The file that contains the deckstrings
       collection: Cards collection for calculation
       db_dbf: The all-cards database
+      deckCache: A DeckCache to decode the deckstrings through, or None
     Returns:
       newlist: A list of dict, each of which contains the results for a deck
     """
-    newlist = []
-    with open (path, "rt") as f:
-        for line in f.readlines():
-            cardsInDeck = 0
-            deck = Deck.from_deckstring(line)
-            for cardPair in deck.cards:
-                cardsInDeck += cardPair[1]
-            if cardsInDeck < 30:
-                # Ignore the decks containing less than 30 cards
-                continue
-            newdict = {}
-            newdict["name"] = "Deck name"
-            newdict["url"] = "Unknown"
-            newdict["date"] = "Unknown"
-            newdict["type"] = "Unknown"
-            newdict["rating-sum"] = "Unknown"
-            newdict["deck-type"] = "Unknown"
-            newdict["rarchetype"] = "Unknown"
-            newdict["deck"] = deck
-            newdict["deckstring"] = line
-            newdict["lacked"], newdict["alreadyHave"] = collection.calculateLacks(deck.cards)
-            _, newdict["dust"] = calcArcaneDust(newdict["lacked"], db_dbf)
-            newdict["power"] = 1
-            newlist.append(newdict)
-    return newlist
+    return list(iterLacksFromFile(path, collection, db_dbf, deckCache))
+
+def splitByteRanges(path, chunks):
+    """Split file PATH into about CHUNKS byte ranges on line boundaries
+
+    Args:
+      path: The file to split
+      chunks: The number of ranges wanted
+    Returns:
+      ranges: A list of (start, end), every line starting in [start, end) belongs to the range
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open (path, "rb") as f:
+        for i in range(1, chunks):
+            f.seek(size * i // chunks)
+            f.readline() # Skip to the start of the next line
+            pos = f.tell()
+            if bounds[-1] < pos < size:
+                bounds.append(pos)
+    bounds.append(size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+_ingestWorker = {} # The arguments shared by all the tasks of an ingestion worker process
+
+def _initIngestWorker(collection, db_dbf, dateLimit, ratingLimit, batch, deckCachePath, withStats=False, keep="first"):
+    _ingestWorker["collection"] = collection
+    _ingestWorker["db_dbf"] = db_dbf
+    _ingestWorker["dateLimit"] = dateLimit
+    _ingestWorker["ratingLimit"] = ratingLimit
+    _ingestWorker["batch"] = batch
+    _ingestWorker["withStats"] = withStats
+    _ingestWorker["keep"] = keep
+    # Read only, the decodes of the workers are not saved
+    _ingestWorker["deckCache"] = DeckCache(deckCachePath) if deckCachePath != None else None
+
+def _ingestRange(task):
+    """Parse, filter and score the lines of a byte range in a worker process
+
+    Args:
+      task: (path, start, end)
+    Returns:
+      passed: The deck dicts passing the filters before the dedup, to write the filtered json
+      fingerprints: The fingerprints of the results, deduplicated in the range
+      results: The scored result dicts
+      stats: A Stats with the drop counters of the range, or None
+    """
+    path, start, end = task
+    with open (path, "rb") as f:
+        f.seek(start)
+        lines = f.read(end - start).decode("utf-8").splitlines()
+    w = _ingestWorker
+    stats = Stats() if w["withStats"] else None
+    fingerprints = []
+    lines = prefilterLines(lines, w["dateLimit"], w["ratingLimit"], stats)
+    records = filterDecks(decodeJSONLines(lines), w["dateLimit"], w["ratingLimit"], stats)
+    pairs = list(checkDeckSize(decodeDeckstrings(records, w["deckCache"], stats), stats=stats))
+    passed = [pair[0] for pair in pairs]
+    pairs = list(dedupDecks(pairs, w["db_dbf"], w["keep"], stats, fingerprints))
+    newdicts = buildDeckDicts(pairs, w["db_dbf"])
+    if w["collection"] == None:
+        results = list(newdicts)
+    elif w["batch"]:
+        results = list(scoreDecksBatched(newdicts, w["collection"], w["db_dbf"]))
+    else:
+        results = list(scoreDecks(newdicts, w["collection"], w["db_dbf"]))
+    return passed, fingerprints, results, stats
+
+def iterLacksFromJSONFileParallel(path, collection, db_dbf, dateLimit="07/01/2017", ratingLimit=20, filteredJSONFile=None, batch=False, workers=2, deckCachePath=None, chunkBytes=16 << 20, stats=None, keep="first"):
+    """The process pool version of the ingestion in iterLacksFromJSONFile()
+    The file is split into byte ranges on line boundaries, and every range is
+    parsed, filtered, deduplicated and scored in a worker. The ranges are merged
+    in file order with a global fingerprint dedup, so the output is the same as
+    the single process path.
+
+    Args:
+      workers: The number of worker processes
+      deckCachePath: The DeckCache file the workers look the deckstrings up in, or None
+      chunkBytes: The approximate size of a byte range
+      stats: A Stats to merge the drop counters of the workers into, or None
+      The others are the same as calculateLacksFromJSONFile()
+    Yields:
+      newdict: The result for a deck
+    """
+    chunks = max(workers, os.path.getsize(path) // chunkBytes + 1)
+    tasks = [(path, start, end) for start, end in splitByteRanges(path, chunks)]
+    JSONOut = open(filteredJSONFile, "wt") if filteredJSONFile != None else None
+    try:
+        with ProcessPoolExecutor(workers, initializer=_initIngestWorker,
+                                 initargs=(collection, db_dbf, dateLimit, ratingLimit, batch, deckCachePath, stats != None, keep)) as pool:
+            def merged():
+                for passed, fingerprints, results, rangeStats in pool.map(_ingestRange, tasks):
+                    if stats != None:
+                        stats.merge(rangeStats)
+                    if JSONOut != None:
+                        for data in passed:
+                            json.dump(data, JSONOut)
+                            JSONOut.write('\n')
+                    yield from zip(fingerprints, results)
+            # The decks kept in the previous ranges block their copies in this range
+            for fingerprint, newdict in dedupByFingerprint(merged(), operator.itemgetter(0),
+                                                           lambda pair: pair[1]['rating-sum'], keep, stats):
+                yield newdict
+    finally:
+        if JSONOut != None:
+            JSONOut.close()
+
+def iterLacksFromJSONFile(path, collection, db_dbf, dateLimit="07/01/2017", ratingLimit=20, filteredJSONFile=None, batch=False, deckCache=None, index=None, workers=1, stats=None, keep="first", similarityIndex=None, reports=None):
+    """The streaming version of calculateLacksFromJSONFile()
+    Chains the stages: line reader -> date/rating prefilter -> json decode -> date/rating filter
+    -> deckstring decode -> 30-card check -> fingerprint dedup -> lack scoring.
+    Nothing is read before the first result is pulled.
+
+    Yields:
+      newdict: The result for a deck
+    """
+    if workers > 1:
+        results = iterLacksFromJSONFileParallel(path, collection, db_dbf, dateLimit, ratingLimit, filteredJSONFile, batch,
+                                                workers, deckCache.path if deckCache != None else None, stats=stats, keep=keep)
+        if stats != None: # The workers score the decks as well
+            results = stats.probe(results, "ingestion")
+    else:
+        lines = prefilterLines(readLines(path), dateLimit, ratingLimit, stats)
+        records = filterDecks(decodeJSONLines(lines), dateLimit, ratingLimit, stats)
+        pairs = checkDeckSize(decodeDeckstrings(records, deckCache, stats), stats=stats)
+        if filteredJSONFile != None:
+            pairs = writeFilteredJSON(pairs, filteredJSONFile)
+        pairs = dedupDecks(pairs, db_dbf, keep, stats)
+        newdicts = buildDeckDicts(pairs, db_dbf)
+        if stats != None:
+            newdicts = stats.probe(newdicts, "ingestion")
+        if collection == None:
+            results = newdicts
+        else:
+            if batch:
+                results = scoreDecksBatched(newdicts, collection, db_dbf)
+            else:
+                results = scoreDecks(newdicts, collection, db_dbf)
+            if stats != None:
+                results = stats.probe(results, "scoring", upstream="ingestion")
+    if index != None:
+        results = indexDecks(results, index)
+    if similarityIndex != None:
+        results = indexSimilarDecks(results, similarityIndex)
+    if reports != None and collection != None:
+        results = countCardReports(results, reports)
+    return results
 
-def calculateLacksFromJSONFile(path, collection, db_dbf, dateLimit="07/01/2017", ratingLimit=20, filteredJSONFile=None):
+def calculateLacksFromJSONFile(path, collection, db_dbf, dateLimit="07/01/2017", ratingLimit=20, filteredJSONFile=None, batch=False, deckCache=None, index=None, workers=1, stats=None, keep="first", similarityIndex=None, reports=None):
     """Calculate the lacked cards from a json file
 
     Args:
       path: The path of the input json file (which contains decks produced by pyspider)
-      collection: My card collection
+      collection: My card collection, or None to leave the decks unscored, see scoreCollections()
       db_dbf: The database of all cards
       dateLimit: A date string, we only consider the decks newer than that
       ratingLimit: An int, ignore the decks who's 'rating-sum' is smaller than it
-      filteredJSONFile: If it isn't None, store the filted JSON into it.
+      filteredJSONFile: If it isn't None, store the decks passing the filters into it,
+        before the dedup, so a stricter filter can be run on it later with the same result.
+      batch: If True, score the decks in batches with batch.scoreDeckList()
+        instead of calling collection.calculateLacks() on every deck.
+      deckCache: A DeckCache to decode the deckstrings through, or None
+      index: A DeckIndex to add the decks into, the deck id is the position in newlist
+      workers: If it's larger than 1, ingest the file with this number of processes
+      stats: A Stats to collect the stage timings and drop counters in, or None
+      keep: Which copy of a duplicated deck to keep: "first", or "best" for the
+        highest rated one, which holds the decks until the file is read through
+      similarityIndex: A SimilarityIndex to add the decks into, the deck id is the position in newlist
+      reports: A heavyhitters.CardReports to count the lacked and already-have cards in as the decks are scored
     Returns:
       newlist: a list of dict, each of which is the result for a deck
     """
+    return list(iterLacksFromJSONFile(path, collection, db_dbf, dateLimit, ratingLimit, filteredJSONFile, batch, deckCache, index, workers, stats, keep, similarityIndex, reports))
+
+def loadResultsJSON(path, deckCache=None):
+    """Load the results written by outputDictListToJSON(), the 'deck' field is decoded again
+
+    Args:
+      path: The json file
+      deckCache: A DeckCache to decode the deckstrings through, or None
+    Returns:
+      newlist: A list of dict, each of which is the result for a deck
+    """
+    decode = deckCache.decode if deckCache != None else Deck.from_deckstring
     newlist = []
-    deckstringSet = set()
-    date = dt.strptime(dateLimit, "%m/%d/%Y")
     with open (path, "rt") as f:
-        if filteredJSONFile != None:
-            JSONOut = open(filteredJSONFile, "wt")
-        for line in f.readlines():
-            cardsInDeck = 0
-            linedict = json.loads(line)
-            if linedict.get('result') != None: # A json file produced by pyspider directly
-                data = linedict['result']
-            else:
-                data = linedict
-            deckCreatedDate = dt.strptime(data['date'].split(' ')[1], "%m/%d/%Y")
-            if date > deckCreatedDate: # Ignore old decks
-                continue
-            if data['deckstring'] in deckstringSet: # The deckstring has already processed
-                continue
-            deckstringSet.add(data['deckstring'])
-            deckRating = int(data['rating-sum'])
-            if ratingLimit > deckRating: # Ignore decks with small rank points
-                continue
-            try:
-                deck = Deck.from_deckstring(data['deckstring'])
-            except:
-                print("exception catched, dechstring:", data['deckstring'])
-            for cardPair in deck.cards:
-                cardsInDeck += cardPair[1]
-            if cardsInDeck < 30:
-                # Ignore the decks containing less than 30 cards
-                continue
-            newdict = {}
-            newdict["name"] = data['title'].split('-')[0]
-            newdict["url"] = data['url']
-            newdict["date"] = data['date'].split(' ')[1]
-            newdict["type"] = data['type']
-            newdict["rating-sum"] = int(data['rating-sum'])
-            newdict["deck-type"] = data['deck-type'].split(':')[1]
-            newdict["archetype"] = data['archetype'].split(':')[1]
-            newdict["deck"] = deck
-            newdict["deckstring"] = data['deckstring']
-            newdict["cardclass"] = calcCardClass(deck.cards, db_dbf)
-            newdict["lacked"], newdict["alreadyHave"] = collection.calculateLacks(deck.cards)
-            _, newdict["dust"] = calcArcaneDust(newdict["lacked"], db_dbf)
-            newdict["power"] = 1
+        for line in f:
+            newdict = json.loads(line)
+            newdict["deck"] = decode(newdict["deckstring"])
             newlist.append(newdict)
-            if filteredJSONFile != None:
-                json.dump(data, JSONOut)
-                JSONOut.write('\n')
+    return newlist
 
-        if filteredJSONFile != None:
-            JSONOut.close()
+def calculateLacksCached(path, collection, db_dbf, cache, dateLimit="07/01/2017", ratingLimit=20, batch=False, deckCache=None, workers=1, stats=None, keep="first", reports=None):
+    """The same as calculateLacksFromJSONFile(), through a FilterCache
+    The results scored with the same source, filters, collection, card
+    database and dedup policy are loaded directly. Otherwise the decks are read from the cached
+    filtered file of the same source with these or looser filters if there is
+    one, or from PATH. The filtered decks and the results are cached then.
 
+    Args:
+      cache: The FilterCache
+      The others are the same as calculateLacksFromJSONFile()
+    Returns:
+      newlist: a list of dict, each of which is the result for a deck
+    """
+    collectionFingerprint = collection.fingerprint()
+    dbDigest = carddb.databaseDigest(db_dbf)
+    entry, exact = cache.lookup(path, dateLimit, ratingLimit)
+    if exact:
+        resultsFile = cache.resultsPath(entry, collectionFingerprint, dbDigest, keep)
+        if resultsFile != None:
+            cache.save()
+            newlist = loadResultsJSON(resultsFile, deckCache)
+            if reports != None:
+                reports.addAll(newlist)
+            return newlist
+        newlist = calculateLacksFromJSONFile(cache.filePath(entry["filtered"]), collection, db_dbf, dateLimit, ratingLimit,
+                                             None, batch, deckCache, workers=workers, stats=stats, keep=keep, reports=reports)
+    else:
+        source = cache.filePath(entry["filtered"]) if entry != None else path
+        newEntry = cache.newEntry(path, dateLimit, ratingLimit)
+        newlist = calculateLacksFromJSONFile(source, collection, db_dbf, dateLimit, ratingLimit,
+                                             cache.filePath(newEntry["filtered"]), batch, deckCache, workers=workers, stats=stats, keep=keep,
+                                             reports=reports)
+        cache.add(newEntry)
+        entry = newEntry
+    outputDictListToJSON(cache.resultsPath(entry, collectionFingerprint, dbDigest, keep, create=True), newlist)
+    cache.save()
     return newlist
 
+def iterLacksFromCorpus(corpus, collection, db_dbf, decktype=None, cardClass=None, batch=False, deckCache=None, stats=None, reports=None):
+    """Score the decks of the partitions of a PartitionedCorpus matching decktype and cardClass only
+    The decks are filtered and deduplicated when the corpus is built.
+
+    Args:
+      corpus: The deckcorpus.PartitionedCorpus
+      decktype, cardClass: The format and the class of the decks, see matchDeck()
+      The others are the same as calculateLacksFromJSONFile()
+    Yields:
+      newdict: The result for a deck, in the order of the whole corpus
+    """
+    decode = deckCache.decode if deckCache != None else Deck.from_deckstring
+    def decoded():
+        for newdict in corpus.read(decktype, cardClass):
+            newdict["deck"] = decode(newdict["deckstring"])
+            yield newdict
+    newdicts = decoded()
+    if stats != None:
+        newdicts = stats.probe(newdicts, "partition read")
+    if batch:
+        results = scoreDecksBatched(newdicts, collection, db_dbf)
+    else:
+        results = scoreDecks(newdicts, collection, db_dbf)
+    if stats != None:
+        results = stats.probe(results, "scoring", upstream="partition read")
+    if reports != None:
+        results = countCardReports(results, reports)
+    return results
+
+def calculateLacksPartitioned(path, collection, db_dbf, corpus, dateLimit="07/01/2017", ratingLimit=20, decktype=None, cardClass=None, batch=False, deckCache=None, workers=1, stats=None, keep="first", reports=None):
+    """The same as calculateLacksFromJSONFile(), but only the decks of format decktype and class cardClass are scored
+    The decks passing the filters and the dedup are split into a
+    PartitionedCorpus by format and class first, unless it's built from the
+    same source, filters and dedup policy already. Only the matching
+    partitions are read and scored then.
+
+    Args:
+      corpus: The deckcorpus.PartitionedCorpus
+      decktype, cardClass: The format and the class of the decks, see matchDeck()
+      The others are the same as calculateLacksFromJSONFile()
+    Returns:
+      newlist: a list of dict, each of which is the result for a deck
+    """
+    dbDigest = carddb.databaseDigest(db_dbf)
+    if not corpus.isBuiltFrom(path, dateLimit, ratingLimit, keep, dbDigest):
+        corpus.build(path, iterLacksFromJSONFile(path, None, db_dbf, dateLimit, ratingLimit, deckCache=deckCache,
+                                                 workers=workers, stats=stats, keep=keep),
+                     dateLimit, ratingLimit, keep, dbDigest)
+    return list(iterLacksFromCorpus(corpus, collection, db_dbf, decktype, cardClass, batch, deckCache, stats, reports))
+
+def followJSONFile(path, collection, db_dbf, state, dateLimit="07/01/2017", ratingLimit=20, top=20, dustLimit=-1, decktype=None, cardClass=None, deckCache=None, stats=None):
+    """Process only the lines appended to a deck json file since the last run
+    The new decks are filtered, deduplicated against all the decks kept
+    before, and scored. The results are appended to the state's results file,
+    and merged into the top recommended decks and the card counters of the
+    state, so a refresh costs in proportion to the new lines. The duplicates
+    are dropped as with keep="first".
+
+    Args:
+      state: The followstate.FollowState, saved before returning
+      top, dustLimit, decktype, cardClass: The filters of the recommended decks, see recommendDecks()
+      The others are the same as calculateLacksFromJSONFile()
+    Returns:
+      newlist: The results of the new decks
+      recommended: The top recommended result dicts of all the decks followed
+      reports: The heavyhitters.CardReports of all the decks followed
+    """
+    key = {"dateLimit": dateLimit, "ratingLimit": ratingLimit, "collection": collection.fingerprint(),
+           "db": carddb.databaseDigest(db_dbf)}
+    offset = state.startOffset(path, key)
+    lines, offset = state.readNewLines(path, offset)
+
+    lines = prefilterLines(lines, dateLimit, ratingLimit, stats)
+    records = filterDecks(decodeJSONLines(lines), dateLimit, ratingLimit, stats)
+    pairs = checkDeckSize(decodeDeckstrings(records, deckCache, stats), stats=stats)
+    def dedup(pairs):
+        for data, deck in pairs:
+            if state.seen.add(deckFingerprint(deck.cards, deckClass(deck, db_dbf))):
+                yield data, deck
+            elif stats != None:
+                stats.drop("duplicate")
+    newdicts = buildDeckDicts(dedup(pairs), db_dbf)
+    if stats != None:
+        newdicts = stats.probe(newdicts, "ingestion")
+    results = scoreDecksBatched(newdicts, collection, db_dbf)
+    if stats != None:
+        results = stats.probe(results, "scoring", upstream="ingestion")
+    reports = CardReports(collection)
+    if state.reports != None:
+        reports.setState(state.reports)
+    newlist = list(countCardReports(results, reports))
+
+    # The top decks of all the decks are among the last top decks and the new ones
+    topKey = {"top": top, "dustLimit": dustLimit, "decktype": decktype,
+              "cardClass": int(cardClass) if cardClass != None else None}
+    if state.topKey == topKey:
+        candidates = state.top
+    else: # The filters changed, select from all the results kept
+        candidates = loadResultsJSON(state.resultsPath, deckCache) if os.path.exists(state.resultsPath) else []
+        for seq, item in enumerate(candidates):
+            item["seq"] = seq
+    # Partitioned as partitionDecks() does, by the position in all the decks followed,
+    # which recommendDecks() breaks the ties by
+    seqs = {} # id of a candidate -> its position
+    partitions = {}
+    for seq, item in [(item["seq"], item) for item in candidates] + list(enumerate(newlist, state.count)):
+        seqs[id(item)] = seq
+        partitions.setdefault((item.get('cardclass'), item['type']), []).append((seq, item))
+    recommended = recommendDecks(partitions, top, dustLimit, decktype, cardClass)
+
+    state.appendResults(newlist)
+    state.top = []
+    for item in recommended:
+        saved = dict((field, value) for field, value in item.items() if field != 'deck')
+        saved["seq"] = seqs[id(item)]
+        state.top.append(saved)
+    state.topKey = topKey
+    state.count += len(newlist)
+    state.reports = reports.getState()
+    state.advance(path, offset)
+    state.save()
+    for item in recommended:
+        if item.get('deck') == None:
+            item['deck'] = Deck.from_deckstring(item['deckstring'])
+    return newlist, recommended, reports
+
 def calcCardClass(cards, db_dbf):
     for cardPair in cards:
         card = db_dbf[cardPair[0]]
@@ -175,7 +825,96 @@ def calcArcaneDust(cards, db_dbf):
             dustIn += 1600 * cardPair[1]
     return dustOut, dustIn
 
-def outputRecommend(db, deckList, top=20, dustLimit=-1, decktype=None, cardClass=None, keywordList=[]):
+def matchDeck(item, dustLimit=-1, decktype=None, cardClass=None, deckgoaltype='Ranked'):
+    """Return whether a result dict passes the recommendation filters
+
+    Args:
+      item: The result dict
+      dustLimit: If this value > 0, filter decks that need more dust than it.
+      decktype: The type of decks. Value: standard, wild or None(standard and wild).
+      cardClass: The class of decks, or None for all classes
+      deckgoaltype: The deck type to keep, eg. 'Ranked', or None for all
+    """
+    if decktype == 'standard':
+        decktype = 'Standard'
+    if decktype == 'wild':
+        decktype = 'Wild'
+    if cardClass and item['cardclass'] != cardClass:
+        return False
+    if decktype and not (decktype in item['type']) and item['type'] != "Unknown": # Let "Unknown" go.
+        return False
+    if deckgoaltype and not (deckgoaltype in item['deck-type']):
+        return False
+    if dustLimit > 0 and item['dust'] > dustLimit:
+        return False
+    return True
+
+def partitionDecks(deckList):
+    """Split the result dicts into partitions by card class and type
+    It can be fed by the ingestion pipeline directly.
+
+    Args:
+      deckList: A list (or any iterable) of result dicts
+    Returns:
+      partitions: A dict (cardclass, type) -> list of (position in deckList, result dict)
+    """
+    partitions = {}
+    for seq, item in enumerate(deckList):
+        key = (item.get('cardclass'), item['type'])
+        if partitions.get(key) == None:
+            partitions[key] = [(seq, item)]
+        else:
+            partitions[key].append((seq, item))
+    return partitions
+
+def recommendDecks(partitions, top=20, dustLimit=-1, decktype=None, cardClass=None, deckgoaltype='Ranked', perArchetype=False):
+    """Select the top recommended decks
+    Only the partitions matching cardClass and decktype are read, the rest of
+    the filters are applied before ranking, and the top decks are picked by a
+    bounded heap on (dust, -rating) instead of sorting everything.
+    The order is the same as sorting by rating then stably by dust, as main() did:
+    ties go to the deck that comes later in the deck list.
+
+    Args:
+      partitions: The partitions produced by partitionDecks()
+      top: The number of decks to select, or None to rank all of them lazily
+      dustLimit, decktype, cardClass, deckgoaltype: The filters, see matchDeck()
+      perArchetype: Select only the best deck of every archetype cluster, see labelArchetypes()
+    Returns:
+      deckList: The selected result dicts, best first, an iterator if TOP is None:
+        the decks are heapified once and popped one by one as they are read
+    """
+    if decktype == 'standard':
+        decktype = 'Standard'
+    if decktype == 'wild':
+        decktype = 'Wild'
+    def rank(pair):
+        seq, item = pair
+        rating = item['rating-sum'] if isinstance(item['rating-sum'], int) else 0
+        return (item['dust'], -rating, -seq)
+    candidates = (pair
+                  for (itemClass, itemType), pairs in partitions.items()
+                  if not (cardClass and itemClass != cardClass)
+                  and not (decktype and not (decktype in itemType) and itemType != "Unknown")
+                  for pair in pairs
+                  if matchDeck(pair[1], dustLimit, None, None, deckgoaltype))
+    if perArchetype:
+        best = {} # cluster -> the best (seq, item) of it
+        for pair in candidates:
+            cluster = pair[1]['cluster']
+            if best.get(cluster) == None or rank(pair) < rank(best[cluster]):
+                best[cluster] = pair
+        candidates = best.values()
+    if top == None:
+        heap = [(rank(pair), pair[1]) for pair in candidates] # The ranks are unique by seq
+        heapq.heapify(heap)
+        def ranked():
+            while heap:
+                yield heapq.heappop(heap)[1]
+        return ranked()
+    return [item for seq, item in heapq.nsmallest(top, candidates, key=rank)]
+
+def outputRecommend(db, deckList, top=20, dustLimit=-1, decktype=None, cardClass=None, keywordList=[], collapseThreshold=None, archetypeNames=None):
     """Output recommend deck list
 
     Args:
@@ -185,27 +924,21 @@ def outputRecommend(db, deckList, top=20, dustLimit=-1, decktype=None, cardClass
       dustLimit: If this value > 0, filter decks that need more dust than it.
       decktype: The type of decks to output. Value: standard, wild or None(standard and wild).
       keywordList: A keyword list for output range
+      collapseThreshold: If it isn't None, skip the decks whose cards are at least this
+        similar (Jaccard) to a deck output already, see similarity.collapseNearDuplicates()
+      archetypeNames: If it isn't None, a dict cluster -> name, the archetype cluster of every deck is output
     """
-    step = 0
-    if decktype == 'standard':
-        decktype = 'Standard'
-    if decktype == 'wild':
-        decktype = 'Wild'
     deckgoaltype = 'Ranked'
     print (type(deckList), len(deckList))
-    for item in deckList:
-        if cardClass and item['cardclass'] != cardClass:
-            continue
-        #if decktype and item['type'] != decktype and item['type'] != "Unknown": # Let "Unknown" go.
-        if decktype and not (decktype in item['type']) and item['type'] != "Unknown": # Let "Unknown" go.
-            continue
-        if deckgoaltype and not (deckgoaltype in item['deck-type']):
-            continue
-        if dustLimit > 0 and item['dust'] > dustLimit:
-            continue
+    deckList = [item for item in deckList if matchDeck(item, dustLimit, decktype, cardClass, deckgoaltype)]
+    if collapseThreshold != None:
+        deckList = collapseNearDuplicates(deckList, collapseThreshold)
+    for item in deckList[:top]:
         print ("========")
         print ("Name:",item['name'], ",  type:",item['type'],  ",  date:", item['date'], ",  dust in need:",item['dust'])
         print ("Deck type:", item['deck-type'], ",  Archetype:", item['archetype'], ",  Rating:",item['rating-sum'], )
+        if archetypeNames != None:
+            print ("Cluster:", item['cluster'], archetypeNames[item['cluster']])
         print ("Deckstring:", item['deckstring'])
         print ("URL:",item['url'])
         if len(item['lacked']) > 0:
@@ -218,17 +951,56 @@ def outputRecommend(db, deckList, top=20, dustLimit=-1, decktype=None, cardClass
         for cardPair in item['alreadyHave']:
             card = db[cardPair[0]]
             print (cardPair[1], 'x ('+str(card.cost)+')', card.name, ":", card.rarity)
-        step += 1
-        if step >= top:
-            break
     print ("========")
 
+def outputSimilarDecks(similar, deckList, title):
+    """Output the decks found by a SimilarityIndex query
+
+    Args:
+      similar: A list of (deck id, score) returned by the query
+      deckList: The deck list the index is built from
+      title: The title of the list
+    """
+    print ("========")
+    print (title)
+    for deckId, score in similar:
+        item = deckList[deckId]
+        print ("%.2f" % score, item['name'], ",  dust in need:", item['dust'], ",  url:", item['url'])
+        print ("     ", item['deckstring'])
+
+def outputArchetypes(model, deckList, db):
+    """Output the archetype clusters, largest first
+
+    Args:
+      model: The archetypes.ArchetypeModel
+      deckList: The result dicts labelled by labelArchetypes()
+      db: The all cards' database
+    Returns:
+      archetypeNames: A dict cluster -> name, the names of its heaviest cards
+    """
+    archetypeNames = dict((cluster, model.label(cluster, db)) for cluster in range(len(model)))
+    members = {} # cluster -> [decks, {scraped archetype -> decks}]
+    for item in deckList:
+        member = members.setdefault(item['cluster'], [0, {}])
+        member[0] += 1
+        scraped = item['archetype'].strip() if item['archetype'] != None else ""
+        if scraped != "" and scraped != "Unknown":
+            member[1][scraped] = member[1].get(scraped, 0) + 1
+    print ("========")
+    print ("The archetypes:")
+    for cluster, (decks, scraped) in sorted(members.items(), key=lambda pair: -pair[1][0]):
+        common = max(scraped.items(), key=operator.itemgetter(1))[0] if scraped else "Unknown"
+        print ("Cluster:", cluster, ",  decks:", decks, ",  scraped archetype:", common, ",  cards:", archetypeNames[cluster])
+    return archetypeNames
+
 def outputDictListToJSON(path, deckList, ignore='deck'):
     """Write the deck list into a json file with path PATH.
+    It's an export format, resultstore.writeResultStore() writes the results
+    in a form that can be reloaded without parsing.
 
     Args:
       path: The output json file
-      deckList: A list of dict to be written into json file.
+      deckList: A list (or any iterable) of dict to be written into json file.
       ignore: ignore this field in the dict when output
     TODO: check if path already exists, mkdir if not.
     """
@@ -320,19 +1092,152 @@ def outputCardsFromList(cardPairList, db, top=10):
         if step >= top:
             break
     
-def main():
+def parseCraft(text):
+    """Parse a --craft argument, CARD or CARD:COUNT with CARD a dbf id, into a card pair
+    The count is 2 if it's left out.
+    """
+    card, _, count = text.partition(':')
+    return (int(card), int(count) if count else 2)
+
+def outputCraftUnlocks(index, crafts, deckList, db, top=20):
+    """Output what crafting cards unlocks: the decks using them, and the decks they complete
+
+    Args:
+      index: The DeckIndex of deckList
+      crafts: The crafted cards in format [(card id, count)]
+      deckList: The indexed result dicts
+      db: The all cards database
+      top: The number of completed decks to output
+    """
+    print ("========")
+    print ("Crafting:")
+    for cardPair in crafts:
+        card = db[cardPair[0]]
+        print (cardPair[1], 'x ('+str(card.cost)+')', card.name, ": used by", len(index.decksContaining(cardPair[0])),
+               "decks, the only card lacked by", len(index.decksLackingOnly(cardPair[0])), "decks")
+    completed = index.decksCompletedBy(crafts)
+    print ("Decks completed by crafting them:", len(completed))
+    def rating(deckId):
+        return deckList[deckId]['rating-sum'] if isinstance(deckList[deckId]['rating-sum'], int) else 0
+    for deckId in sorted(completed, key=lambda deckId: -rating(deckId))[:top]:
+        item = deckList[deckId]
+        print ("Name:", item['name'], ",  type:", item['type'], ",  Rating:", item['rating-sum'], ",  url:", item['url'])
+
+def loadCollection(path, deckCache=None):
+    """Load a card collection from a mycards.csv file, or from a file of deckstrings otherwise
+
+    Args:
+      path: The collection file
+      deckCache: A DeckCache to decode the deckstrings through, or None
+    """
+    col = Collection()
+    if path.endswith(".csv"):
+        col.loadFromFile(path)
+    else:
+        col.initFromDeckStringFile(path, deckCache)
+    col.limitTo(2)
+    return col
+
+def outputCollectionReport(path, db, collection, deckList, top=20, dustLimit=-1, decktype=None, cardClass=None):
+    """Write the recommend decks, the unused cards and the most wanted cards of a collection into a text file
+
+    Args:
+      path: The report file
+      db: The all cards' database
+      collection: The card collection
+      deckList: The results of the collection
+      The others are the same as outputRecommend()
+    """
+    recommended = recommendDecks(partitionDecks(deckList), top=top, dustLimit=dustLimit, decktype=decktype, cardClass=cardClass)
+    with open (path, "wt") as f, contextlib.redirect_stdout(f):
+        outputRecommend(db, recommended, top=top, dustLimit=dustLimit, decktype=decktype, cardClass=cardClass)
+        print ("========")
+        print ("The unused cards:")
+        outputCardsFromList(theUselessCards(collection, deckList), db)
+        print ("========")
+        print ("The most wanted cards:")
+        _, _, timetotal = theMostWantedCards(deckList)
+        outputCardsFromList(timetotal, db)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="HearthStone deck advisor")
+    parser.add_argument("--rebuild-db", action="store_true",
+                        help="rebuild the compiled card database snapshot")
+    parser.add_argument("--craft-budget", type=int, default=0, metavar="DUST",
+                        help="plan the cards to craft within DUST that complete the most decks")
+    parser.add_argument("--craft", nargs="+", type=parseCraft, metavar="CARD[:COUNT]",
+                        help="output the decks that use these cards (dbf ids, 2 copies by default), "
+                             "and the decks crafting them completes")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="the number of processes to ingest the deck json file with")
+    parser.add_argument("--keep-duplicate", choices=["first", "best"], default="first",
+                        help="which copy of a duplicated deck to keep: the first one or the highest rated one")
+    parser.add_argument("--collapse-similar", type=float, default=None, metavar="THRESHOLD",
+                        help="skip the recommended decks at least THRESHOLD (0-1) similar to one output already")
+    parser.add_argument("--similar-to", metavar="DECKSTRING",
+                        help="list the decks most similar to DECKSTRING")
+    parser.add_argument("--closest-owned", action="store_true",
+                        help="list the decks your collection owns the largest part of")
+    parser.add_argument("--collections", nargs="+", metavar="FILE",
+                        help="score many collections (mycards.csv or deckstring files) against the decks in one run, "
+                             "the reports are written under outputs/collections/")
+    parser.add_argument("--card-reports", choices=["exact", "approx"], default="exact",
+                        help="count the wanted and unused cards exactly, or approximately in bounded memory")
+    parser.add_argument("--weight-by-rating", action="store_true",
+                        help="weight the decks by their rating in the wanted and unused cards")
+    parser.add_argument("--class", dest="card_class", metavar="CLASS",
+                        help="recommend the decks of CLASS only, eg. MAGE (default: MAGE)")
+    parser.add_argument("--format", choices=["standard", "wild"],
+                        help="recommend the decks of this format only")
+    parser.add_argument("--partitioned", action="store_true",
+                        help="split the decks by format and class under cache/partitions/, and only read and score "
+                             "the decks of --class and --format; the card reports and the output files cover these decks only then")
+    parser.add_argument("--follow", action="store_true",
+                        help="only read the decks appended to the deck json file since the last --follow run, "
+                             "and merge them into the recommendations kept under cache/follow/")
+    parser.add_argument("--follow-interval", type=float, default=0, metavar="SECONDS",
+                        help="with --follow, keep running and check the deck json file every SECONDS")
+    parser.add_argument("--archetypes", type=int, default=0, metavar="K",
+                        help="cluster the decks into K archetypes by their cards, and output the clusters")
+    parser.add_argument("--one-per-archetype", action="store_true",
+                        help="with --archetypes, recommend only the best deck of every archetype")
+    parser.add_argument("--result-store", action="store_true",
+                        help="also write the results into the memory-mapped store outputs/recommend.rstore, see resultstore.ResultStore")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the time of every stage and the reasons decks are dropped")
+    parser.add_argument("--stats-json", metavar="PATH",
+                        help="write the stats report into the json file PATH")
+    args = parser.parse_args(argv)
+    if args.follow and args.keep_duplicate != "first":
+        parser.error("--follow keeps the first copy of a duplicated deck only")
+    if args.one_per_archetype and args.archetypes <= 0:
+        parser.error("--one-per-archetype needs --archetypes")
+    if args.follow and args.one_per_archetype:
+        parser.error("--follow keeps the top decks only, it can't pick one per archetype")
+    if args.follow and (args.card_reports != "exact" or args.weight_by_rating):
+        parser.error("--follow keeps the exact unweighted card counters only")
+    # The main stages are timed anyway, the pipeline is only instrumented if asked
+    stats = Stats()
+    pipelineStats = stats if args.stats or args.stats_json else None
+
     cardDefs = os.path.join("hsdata","CardDefs.xml")
     collectionFile = "inputs/mycards.csv"
     collectionDeckstringFile = "inputs/mycards"
     deckFile = "inputs/decks"
     deckJSONFile = "inputs/decks.json"
     recommendJSONFile = "outputs/recommend.json"
+    recommendStoreFile = "outputs/recommend.rstore"
+    collectionsOutputDir = "outputs/collections"
     dateLimit = "01/05/2015"
     ratingLimit = 5
     outputCounts = 20
     dustLimitation = 0
     typeLimitation = None
-    filteredDeckJSON = "inputs/decks_db.json"
+    filterCacheDir = "cache/filtered"
+    deckCacheFile = "cache/deckstrings.cache"
+    partitionsDir = "cache/partitions"
+    followDir = "cache/follow"
+    followArchetypesFile = "cache/follow/archetypes.npz"
     
     '''
     CardClass
@@ -351,9 +1256,14 @@ def main():
     NEUTRAL = 12
     '''
     classLimitation = CardClass.MAGE
+    if args.card_class:
+        classLimitation = CardClass[args.card_class.upper()]
+    if args.format:
+        typeLimitation = args.format
 
     # Cereate and init the database
-    db = initDatabaseFromXml(cardDefs)
+    with stats.stage("db load"):
+        db = initDatabaseFromXml(cardDefs, rebuild=args.rebuild_db)
 
     # test start
     '''
@@ -365,51 +1275,147 @@ def main():
     '''
     #test end
 
+    deckCache = DeckCache(deckCacheFile)
+
+    if args.collections:
+        # Decode and filter the decks once, then score all the collections together
+        with stats.stage("collection load"):
+            collections = [loadCollection(path, deckCache) for path in args.collections]
+        deckList = calculateLacksFromJSONFile(deckJSONFile, None, db, dateLimit, ratingLimit, deckCache=deckCache,
+                                              workers=args.workers, stats=pipelineStats, keep=args.keep_duplicate)
+        deckCache.save()
+        names = set()
+        with stats.stage("multi scoring", len(deckList) * len(collections)):
+            for path, col, deckLacks in zip(args.collections, collections, scoreCollections(deckList, collections, db)):
+                name = os.path.splitext(os.path.basename(path))[0]
+                while name in names:
+                    name += "_"
+                names.add(name)
+                directory = os.path.join(collectionsOutputDir, name)
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+                outputDictListToJSON(os.path.join(directory, "recommend.json"), deckLacks)
+                outputCollectionReport(os.path.join(directory, "report.txt"), db, col, deckLacks, top=outputCounts,
+                                       dustLimit=dustLimitation, decktype=typeLimitation, cardClass=classLimitation)
+                print ("Written", directory)
+        if args.stats:
+            stats.output()
+        if args.stats_json:
+            stats.writeJSON(args.stats_json)
+        return
+
     # Create and init my card collections
-    col = Collection()
-    if os.path.exists(collectionFile):
-        col.loadFromFile(collectionFile)
-        col.limitTo(2)
-    else:
-        col.initFromDeckStringFile(collectionDeckstringFile)
-        col.limitTo(2)
-        col.writeToFiles(collectionFile)
+    with stats.stage("collection load"):
+        col = Collection()
+        if os.path.exists(collectionFile):
+            col.loadFromFile(collectionFile)
+            col.limitTo(2)
+        else:
+            col.initFromDeckStringFile(collectionDeckstringFile, deckCache)
+            col.limitTo(2)
+            col.writeToFiles(collectionFile)
 
     #test start
     col.output()
     #test end
 
 
+    if args.follow:
+        state = FollowState(followDir)
+        while True:
+            with stats.stage("follow"):
+                newlist, recommended, reports = followJSONFile(deckJSONFile, col, db, state, dateLimit, ratingLimit, outputCounts,
+                                                               dustLimitation, typeLimitation, classLimitation, deckCache, pipelineStats)
+            deckCache.save()
+            archetypeNames = None
+            if args.archetypes > 0:
+                # The new decks are fit into the clusters of the decks followed before
+                with stats.stage("archetypes", len(newlist)):
+                    model = ArchetypeModel(args.archetypes)
+                    if state.count == len(newlist) or not model.load(followArchetypesFile):
+                        model.fit([item['deck'].cards for item in newlist])
+                        newlist = list(labelArchetypes(newlist, model))
+                    else:
+                        newlist = list(labelArchetypes(newlist, model, update=True))
+                    if len(model) > 0:
+                        model.save(followArchetypesFile)
+                        recommended = list(labelArchetypes(recommended, model))
+                        archetypeNames = dict((cluster, model.label(cluster, db)) for cluster in range(len(model)))
+            print ("========")
+            print ("New decks:", len(newlist), ",  decks followed:", state.count)
+            if newlist or args.follow_interval <= 0:
+                outputRecommend(db, recommended, top=outputCounts, dustLimit=dustLimitation, decktype=typeLimitation, cardClass=classLimitation,
+                                archetypeNames=archetypeNames)
+                print ("========")
+                print ("The unused cards:")
+                outputCardsFromList(reports.useless(10), db)
+                print ("========")
+                print ("The most wanted cards:")
+                outputCardsFromList(reports.mostWanted(10)[2], db)
+            if args.follow_interval <= 0:
+                break
+            time.sleep(args.follow_interval)
+        if args.stats:
+            stats.output()
+        if args.stats_json:
+            stats.writeJSON(args.stats_json)
+        return
+
+
     # Calculate the lacked cards from deckFile
     #deckLacks0 = calculateLacksFromFile(deckFile, col, db)
-    if os.path.exists(filteredDeckJSON):
-        deckLacks = calculateLacksFromJSONFile(filteredDeckJSON, col, db, dateLimit, ratingLimit, None)
+    # The filtered decks and the results are cached by the content of deckJSONFile,
+    # the filters and the collection
+    # The wanted and unused cards are counted while the decks are scored
+    reports = CardReports(col, args.card_reports, "rating" if args.weight_by_rating else None)
+    if args.partitioned:
+        deckLacks = calculateLacksPartitioned(deckJSONFile, col, db, PartitionedCorpus(partitionsDir), dateLimit, ratingLimit,
+                                              typeLimitation, classLimitation, batch=True, deckCache=deckCache, workers=args.workers,
+                                              stats=pipelineStats, keep=args.keep_duplicate, reports=reports)
     else:
-        deckLacks = calculateLacksFromJSONFile(deckJSONFile, col, db, dateLimit, ratingLimit, filteredDeckJSON)
-
-    def dust(a):
-        return a['dust']
-    def rate(a):
-        return a['rating-sum']
-    sortedLacks_tmp = reversed(sorted(deckLacks, key=rate))
-    #outputRecommend(db, list(sortedLacks_tmp), top=outputCounts, dustLimit=dustLimitation, decktype=typeLimitation)
-    sortedLacks = sorted(sortedLacks_tmp, key=dust)
-    
+        deckLacks = calculateLacksCached(deckJSONFile, col, db, FilterCache(filterCacheDir), dateLimit, ratingLimit,
+                                         batch=True, deckCache=deckCache, workers=args.workers, stats=pipelineStats, keep=args.keep_duplicate,
+                                         reports=reports)
+    deckCache.save()
+
+    archetypeNames = None
+    if args.archetypes > 0 and deckLacks:
+        with stats.stage("archetypes", len(deckLacks)):
+            model = ArchetypeModel(args.archetypes)
+            model.fit([item['deck'].cards for item in deckLacks])
+            deckLacks = list(labelArchetypes(deckLacks, model))
+            archetypeNames = outputArchetypes(model, deckLacks, db)
+
+    # Select the top decks by (dust, -rating) from the matching partitions only
+    with stats.stage("sorting", len(deckLacks)):
+        partitions = partitionDecks(deckLacks)
+        perArchetype = args.one_per_archetype and archetypeNames != None
+        if args.collapse_similar == None:
+            recommended = recommendDecks(partitions, top=outputCounts, dustLimit=dustLimitation, decktype=typeLimitation, cardClass=classLimitation,
+                                         perArchetype=perArchetype)
+        else:
+            # Read the ranked decks until outputCounts of them are not near duplicates of each other
+            recommended = collapseNearDuplicates(recommendDecks(partitions, top=None, dustLimit=dustLimitation, decktype=typeLimitation,
+                                                                cardClass=classLimitation, perArchetype=perArchetype),
+                                                 args.collapse_similar, outputCounts)
+
     #test start
     #print (deckLacks)
-    #print (sortedLacks)
     #outputRecommend(db, deckLacks0)
     #test end
 
     # Output recommend decks in detail
-    outputRecommend(db, sortedLacks, top=outputCounts, dustLimit=dustLimitation, decktype=typeLimitation, cardClass = classLimitation)
-    #outputRecommend(db, list(sortedLacks_tmp), top=outputCounts, dustLimit=dustLimitation, decktype=typeLimitation)
+    with stats.stage("output", len(deckLacks)):
+        outputRecommend(db, recommended, top=outputCounts, dustLimit=dustLimitation, decktype=typeLimitation, cardClass = classLimitation,
+                        archetypeNames=archetypeNames)
 
-    outputDictListToJSON(recommendJSONFile, sortedLacks)
+        if args.result_store:
+            writeResultStore(recommendStoreFile, deckLacks)
+        outputDictListToJSON(recommendJSONFile, deckLacks)
 
     #test start
-    unused = theUselessCards(col, sortedLacks)
-    time1, time2, timetotal = theMostWantedCards(sortedLacks)
+    unused = reports.useless(10)
+    time1, time2, timetotal = reports.mostWanted(10)
 
     print ("========")
     print ("The unused cards:")
@@ -419,6 +1425,29 @@ def main():
     print ("The most wanted cards:")
     outputCardsFromList(timetotal, db)
     #test end
+
+    if args.similar_to or args.closest_owned:
+        similarityIndex = SimilarityIndex()
+        for item in deckLacks:
+            similarityIndex.add(item['deck'].cards)
+        if args.similar_to:
+            outputSimilarDecks(similarityIndex.similarToDeckstring(args.similar_to), deckLacks, "The most similar decks:")
+        if args.closest_owned:
+            outputSimilarDecks(similarityIndex.closestToCollection(col), deckLacks, "The decks you own the most of:")
+
+    if args.craft:
+        index = DeckIndex()
+        with stats.stage("indexing", len(deckLacks)):
+            deckLacks = list(indexDecks(deckLacks, index))
+        outputCraftUnlocks(index, args.craft, deckLacks, db, outputCounts)
+
+    if args.craft_budget > 0:
+        outputCraftPlan(planCrafts(deckLacks, db, args.craft_budget), db, deckLacks)
+
+    if args.stats:
+        stats.output()
+    if args.stats_json:
+        stats.writeJSON(args.stats_json)
     
 if __name__ == "__main__":
     main()
@@ -1,60 +1,38 @@
 import os
 import json
+import pickle
+import random
+import pytest
 from hearthstone.deckstrings import Deck
 from hearthstone.enums import FormatType
 from hearthstone.cardxml import load
-from hearthstone.enums import Locale,Rarity
+from hearthstone.enums import Rarity
 from collection import Collection
-
-# Create a deck from a deckstring
-deck = Deck()
-deck.heroes = [7]  # Garrosh Hellscream
-deck.format = FormatType.FT_WILD
-# Nonsense cards, but the deckstring doesn't validate.
-deck.cards = [(1, 3), (2, 3), (3, 3), (4, 3)]  # id, count pairs
-print(deck.as_deckstring)  # "AAEBAQcAAAQBAwIDAwMEAw=="
-
-# Import a deck from a deckstring
-deck = Deck.from_deckstring("AAEBAf0ECMAB5gT7BPsFigbYE5KsAv2uAgucArsClQONBKsEtAThBJYF7Ae8CImsAgA=")
-print (deck.cards)
-
-
-# load card database from CardDefs.xml and use it to initialize DBF database
-db, xml = load(os.path.join("hsdata","CardDefs.xml"), locale="zhCN")
-
-db_dbf={}
-for card in db:
-    #print (card)
-    db_dbf[db[card].dbf_id] = db[card]
-
-#print (db)
-for cardPair in deck.cards:
-#    print (cardPair[0])
-    card = db_dbf[cardPair[0]]
-    print (cardPair[1],"x(", card.cost,")", card.name, card.rarity)
-
-#print (type(deck.cards))
-
-
-#col = Collection()
-#for cardPair in deck.cards:
-#    col.add(cardPair)
-#col.output()
-
-#col.writeToFiles("inputs/mycards.csv")
-
-col2 = Collection()
-col2.loadFromFile("inputs/mycards.csv")
-
-col2.output()
-#col2.limitTo(1)
-#col2.output()
-
-#col3 = Collection()
-#col3.initFromDeckStringFile("initdeck")
-#col3.output()
-
-
+import benchmark
+import deckAdvisor
+from incremental import IncrementalScorer
+from deckindex import DeckIndex
+from stats import Stats
+from resultstore import writeResultStore, ResultStore
+from filtercache import FilterCache
+from crawlcheckpoint import CrawlCheckpoint
+from heavyhitters import CardReports
+from deckcache import DeckCache
+from deckcorpus import PartitionedCorpus
+from followstate import FollowState
+from archetypes import ArchetypeModel
+from batch import DUST_IN, CardTable, DeckMatrix, calculateBatchLacks, calculateMultiLacks
+from planner import planCrafts, deckWeight
+from advisorDaemon import AdvisorState, AdvisorServer
+import threading
+import multiprocessing
+import urllib.request
+import urllib.error
+from similarity import collapseNearDuplicates, multisetJaccard
+from fixtureserver import FixtureServer
+from asyncCrawler import AsyncCrawler, HTTPError
+import asyncio
+import numpy as np
 
 def calculateLacksFromJSONFile(path, collection, db_dbf):
     newlist = []
@@ -105,12 +83,747 @@ def calcArcaneDust(cards, db_dbf):
             dustIn += 1600
     return dustOut, dustIn
 
-#print (calculateLacksFromFile("deck1.txt", col2, db_dbf))
+def demo():
+    # Create a deck from a deckstring
+    deck = Deck()
+    deck.heroes = [7]  # Garrosh Hellscream
+    deck.format = FormatType.FT_WILD
+    # Nonsense cards, but the deckstring doesn't validate.
+    deck.cards = [(1, 3), (2, 3), (3, 3), (4, 3)]  # id, count pairs
+    print(deck.as_deckstring)  # "AAEBAQcAAAQBAwIDAwMEAw=="
+
+    # Import a deck from a deckstring
+    deck = Deck.from_deckstring("AAEBAf0ECMAB5gT7BPsFigbYE5KsAv2uAgucArsClQONBKsEtAThBJYF7Ae8CImsAgA=")
+    print (deck.cards)
+
+
+    # load card database from CardDefs.xml and use it to initialize DBF database
+    db, xml = load(os.path.join("hsdata","CardDefs.xml"), locale="zhCN")
+
+    db_dbf={}
+    for card in db:
+        #print (card)
+        db_dbf[db[card].dbf_id] = db[card]
+
+    #print (db)
+    for cardPair in deck.cards:
+    #    print (cardPair[0])
+        card = db_dbf[cardPair[0]]
+        print (cardPair[1],"x(", card.cost,")", card.name, card.rarity)
+
+    #print (type(deck.cards))
+
+
+    #col = Collection()
+    #for cardPair in deck.cards:
+    #    col.add(cardPair)
+    #col.output()
+
+    #col.writeToFiles("inputs/mycards.csv")
+
+    col2 = Collection()
+    col2.loadFromFile("inputs/mycards.csv")
+
+    col2.output()
+    #col2.limitTo(1)
+    #col2.output()
+
+    #col3 = Collection()
+    #col3.initFromDeckStringFile("initdeck")
+    #col3.output()
+
+    #print (calculateLacksFromFile("deck1.txt", col2, db_dbf))
+
+
+    with open ('t3.json', 'r') as f:
+        for line in f.readlines():
+            data = json.loads(line)['result']
+        print (data)
+
+    print (calculateLacksFromJSONFile('t3.json', col2, db_dbf))
+
+
+# The tests below run on the bench fixture cards and a generated corpus,
+# without hsdata: python -m pytest deck_test.py
+
+@pytest.fixture(scope="module")
+def cards():
+    return benchmark.loadFixture()
+
+@pytest.fixture(scope="module")
+def db(cards, tmp_path_factory):
+    xmlPath = str(tmp_path_factory.mktemp("hsdata") / "CardDefs.xml")
+    benchmark.writeCardDefs(cards, xmlPath)
+    return deckAdvisor.initDatabaseFromXml(xmlPath, snapshotDir=None)
+
+@pytest.fixture(scope="module")
+def deckJSON(cards, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("inputs") / "decks.json")
+    benchmark.generateDecksJSON(path, cards, 3000, seed=7)
+    return path
+
+def scoredFields(deckList):
+    return [(item['deckstring'], sorted(map(tuple, item['lacked'])), sorted(map(tuple, item['alreadyHave'])), item['dust'])
+            for item in deckList]
+
+def test_batch_scoring_equals_calculateLacks(cards, db, deckJSON):
+    collection = benchmark.makeCollection(cards, seed=3)
+    collection.add((cards[0]["dbf_id"], 0)) # A card kept with a count of 0
+    reference = deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, db, "01/01/2016", -100)
+    fast = deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, db, "01/01/2016", -100, batch=True)
+    assert len(reference) > 1000
+    assert scoredFields(fast) == scoredFields(reference)
+    for item in reference:
+        assert item['dust'] == deckAdvisor.calcArcaneDust(item['lacked'], db)[1]
+
+def test_collection_pickles_without_listeners(cards, db, deckJSON):
+    collection = benchmark.makeCollection(cards, seed=3)
+    deckList = deckAdvisor.calculateLacksFromJSONFile(deckJSON, None, db, "01/01/2016", -100)
+    scorer = IncrementalScorer(collection, db, deckList)
+    copy = pickle.loads(pickle.dumps(collection))
+    assert copy.listeners == [] and copy.collect_db == collection.collect_db
+    assert collection.listeners == [scorer.rescoreCards]
+    # The workers of a parallel ingestion get the collection in their initargs
+    results = deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, db, "01/01/2016", -100, workers=2)
+    assert scoredFields(results) == scoredFields(scorer.deckList)
+
+def test_craft_queries_equal_a_scan(cards, db, deckJSON, capsys):
+    rng = random.Random(5)
+    collection = Collection()
+    for card in cards:
+        if rng.random() < 0.9:
+            collection.add((card["dbf_id"], 2))
+    index = DeckIndex()
+    deckList = deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, db, "01/01/2016", -100, batch=True, index=index)
+    crafts = [deckAdvisor.parseCraft(text) for text in ("%d" % cards[10]["dbf_id"], "%d:1" % cards[20]["dbf_id"])]
+    assert crafts[0][1] == 2 and crafts[1][1] == 1
+    for card, count in crafts:
+        assert index.decksContaining(card) == [deckId for deckId, item in enumerate(deckList)
+                                               if card in dict(item['deck'].cards)]
+        assert index.decksLackingOnly(card) == [deckId for deckId, item in enumerate(deckList)
+                                                if [cardPair[0] for cardPair in item['lacked']] == [card]]
+    completed = [deckId for deckId, item in enumerate(deckList)
+                 if item['lacked'] and all(count <= dict(crafts).get(card, 0) for card, count in item['lacked'])]
+    assert completed and index.decksCompletedBy(crafts) == completed
+    deckAdvisor.outputCraftUnlocks(index, crafts, deckList, db)
+    assert "Decks completed by crafting them: %d" % len(completed) in capsys.readouterr().out
+
+@pytest.mark.parametrize("keep", ["first", "best"])
+def test_parallel_ingestion_equals_single_process(db, deckJSON, tmp_path, keep):
+    collection = Collection()
+    stats = Stats()
+    single = deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, db, "01/01/2017", 5, str(tmp_path / "single.json"),
+                                                    batch=True, stats=stats, keep=keep)
+    parallelStats = Stats()
+    # Small byte ranges, so the copies of a deck fall in other ranges
+    parallel = list(deckAdvisor.iterLacksFromJSONFileParallel(deckJSON, collection, db, "01/01/2017", 5, str(tmp_path / "parallel.json"),
+                                                              batch=True, workers=3, chunkBytes=32 << 10, stats=parallelStats, keep=keep))
+    assert scoredFields(parallel) == scoredFields(single)
+    assert [item['rating-sum'] for item in parallel] == [item['rating-sum'] for item in single]
+    assert parallelStats.drops == stats.drops and stats.drops["duplicate"] > 0
+    with open (str(tmp_path / "single.json"), "rt") as f, open (str(tmp_path / "parallel.json"), "rt") as g:
+        assert f.read() == g.read()
+
+def test_result_store_reads_back(cards, db, deckJSON, tmp_path):
+    deckList = deckAdvisor.calculateLacksFromJSONFile(deckJSON, benchmark.makeCollection(cards), db, "01/01/2016", -100, batch=True)
+    path = str(tmp_path / "recommend.rstore")
+    writeResultStore(path, deckList)
+    with ResultStore(path) as store:
+        assert len(store) == len(deckList)
+        assert store.dust.tolist() == [item['dust'] for item in deckList]
+        assert store.rating.tolist() == [item['rating-sum'] for item in deckList]
+        for i in (0, len(deckList) // 2, len(deckList) - 1):
+            assert store.deckstring(i) == deckList[i]['deckstring'].strip()
+            assert store.lacked(i) == [tuple(cardPair) for cardPair in deckList[i]['lacked']]
+
+def referenceDedup(pairs, db, keep):
+    """Deduplicate (data, deck) pairs by the exact (class, sorted cards) key"""
+    kept = []
+    position = {}
+    for data, deck in pairs:
+        hero = deck.heroes[0]
+        key = (int(db[hero].card_class) if hero in db else 0, tuple(sorted(deck.cards)))
+        if key not in position:
+            position[key] = len(kept)
+            kept.append((data, deck))
+        elif keep == "best" and int(data['rating-sum']) > int(kept[position[key]][0]['rating-sum']):
+            kept[position[key]] = (data, deck)
+    return kept
+
+@pytest.mark.parametrize("keep", ["first", "best"])
+def test_fingerprint_dedup_equals_exact_keys(db, deckJSON, keep):
+    records = deckAdvisor.filterDecks(deckAdvisor.decodeJSONLines(deckAdvisor.readLines(deckJSON)), "01/01/2016", -100)
+    pairs = list(deckAdvisor.checkDeckSize(deckAdvisor.decodeDeckstrings(records)))
+    # Copies with the cards reordered and the other format are the same deck
+    rng = random.Random(9)
+    for data, deck in rng.sample(pairs, 200):
+        copy = Deck()
+        copy.heroes = list(deck.heroes)
+        copy.format = FormatType.FT_STANDARD if deck.format == FormatType.FT_WILD else FormatType.FT_WILD
+        copy.cards = list(reversed(deck.cards))
+        pairs.insert(rng.randrange(len(pairs)), (dict(data, **{'rating-sum': str(rng.randint(-10, 100))}), copy))
+    stats = Stats()
+    fast = list(deckAdvisor.dedupDecks(pairs, db, keep, stats))
+    reference = referenceDedup(pairs, db, keep)
+    assert [id(pair[1]) for pair in fast] == [id(pair[1]) for pair in reference]
+    assert stats.drops["duplicate"] == len(pairs) - len(reference)
+
+@pytest.mark.parametrize("keep, url", [("first", "copy-3"), ("best", "copy-5")])
+def test_dedup_keeps_a_copy_passing_the_filters(db, deckJSON, tmp_path, keep, url):
+    """The copies dropped by the date, rating or 30-card filters don't hide a later copy that passes them"""
+    with open (deckJSON, "rt") as f:
+        result = json.loads(f.readline())["result"]
+    deck = Deck.from_deckstring(result["deckstring"])
+    reordered = Deck()
+    reordered.heroes = list(deck.heroes)
+    reordered.format = deck.format
+    reordered.cards = list(reversed(deck.cards))
+    short = Deck()
+    short.heroes = list(deck.heroes)
+    short.format = deck.format
+    short.cards = deck.cards[1:]
+    copies = [("Created: 1/1/2017 (Bench)", "0", result["deckstring"]), # Rated too low
+              ("Created: 1/1/2015 (Bench)", "90", result["deckstring"]), # Too old
+              ("Created: 1/1/2017 (Bench)", "90", short.as_deckstring), # Too few cards, a different deck
+              ("Created: 1/1/2017 (Bench)", "10", result["deckstring"]),
+              ("Created: 1/1/2017 (Bench)", "10", reordered.as_deckstring),
+              ("Created: 1/1/2017 (Bench)", "50", reordered.as_deckstring),
+              ("Created: 1/1/2017 (Bench)", "50", result["deckstring"])]
+    path = str(tmp_path / "copies.json")
+    with open (path, "wt") as f:
+        for i, (date, rating, deckstring) in enumerate(copies):
+            json.dump({"result": dict(result, url="copy-%d" % i, date=date, deckstring=deckstring, **{"rating-sum": rating})}, f)
+            f.write('\n')
+    deckList = deckAdvisor.calculateLacksFromJSONFile(path, None, db, "01/01/2016", 5, keep=keep)
+    assert [item['url'] for item in deckList] == [url]
+
+def filteredOutcome(lines, dateLimit, ratingLimit, prefilter):
+    """The decks filterDecks() keeps out of LINES, or the type of the exception it raises"""
+    if prefilter:
+        lines = deckAdvisor.prefilterLines(lines, dateLimit, ratingLimit)
+    try:
+        return list(deckAdvisor.filterDecks(deckAdvisor.decodeJSONLines(lines), dateLimit, ratingLimit))
+    except Exception as e:
+        return type(e)
+
+@pytest.mark.parametrize("dateLimit, ratingLimit", [("01/01/2016", -100), ("07/15/2017", 20), ("12/31/2018", 90)])
+def test_prefilter_keeps_what_the_filters_keep(deckJSON, dateLimit, ratingLimit):
+    lines = list(deckAdvisor.readLines(deckJSON))
+    assert filteredOutcome(lines, dateLimit, ratingLimit, True) == filteredOutcome(lines, dateLimit, ratingLimit, False)
+    result = json.loads(lines[0])["result"]
+    edges = [dict(result, title='An "escaped" title'),
+             dict(result, title='"date": "Created: 1/1/2010 (Old)", "rating-sum": "-99",'),
+             dict(result, archetype='Deck Archetype: \\"date\\": \\"Created: 1/1/2010\\"'),
+             dict(result, date='Created: 8/1/2017 "Patch"'),
+             dict(result, date='Created: 8/1/2017\\'),
+             dict(result, date='Created: 2017-08-01 (Patch)'),
+             dict(result, date='Created: 2/30/2017 (Patch)'),
+             dict((key, value) for key, value in result.items() if key != 'date'),
+             dict((key, value) for key, value in result.items() if key != 'rating-sum'),
+             dict(result, **{'rating-sum': 'n/a'}),
+             dict(result, **{'rating-sum': '12a'}),
+             dict(result, **{'rating-sum': '1e3'}),
+             dict(result, **{'rating-sum': '-'}),
+             dict(result, **{'rating-sum': ' 95 '}),
+             dict(result, **{'rating-sum': '+95'}),
+             dict(result, **{'rating-sum': 95}),
+             dict(result, **{'rating-sum': '٩٥'})]
+    for edge in edges:
+        for line in (json.dumps({"result": edge}), json.dumps(edge), json.dumps(edge, ensure_ascii=False, separators=(',', ':'))):
+            assert filteredOutcome([line], dateLimit, ratingLimit, True) == filteredOutcome([line], dateLimit, ratingLimit, False), line
+
+@pytest.mark.parametrize("cardClass, decktype, dustLimit", [(None, None, -1), (4, None, -1), (None, "standard", -1),
+                                                            (None, "wild", 3000), (7, "standard", 4000)])
+def test_recommended_decks_equal_the_double_sort(cards, db, deckJSON, cardClass, decktype, dustLimit):
+    deckList = deckAdvisor.calculateLacksFromJSONFile(deckJSON, benchmark.makeCollection(cards), db, "01/01/2016", -100)
+    for item in deckList: # Coarse values, so there are many ties on both keys
+        item['dust'] = item['dust'] // 1000 * 1000
+        item['rating-sum'] = item['rating-sum'] // 25
+    expected = [item for item in sorted(reversed(sorted(deckList, key=lambda item: item['rating-sum'])), key=lambda item: item['dust'])
+                if deckAdvisor.matchDeck(item, dustLimit, decktype, cardClass)]
+    assert len(expected) > 20
+    assert len(set((item['dust'], item['rating-sum']) for item in expected)) < len(expected) // 2
+    partitions = deckAdvisor.partitionDecks(deckList)
+    for top in (1, 20, len(expected) + 1):
+        assert deckAdvisor.recommendDecks(partitions, top, dustLimit, decktype, cardClass) == expected[:top]
+    assert list(deckAdvisor.recommendDecks(partitions, None, dustLimit, decktype, cardClass)) == expected
+
+def test_multi_lacks_equal_one_collection_at_a_time(cards, db, deckJSON):
+    deckList = deckAdvisor.calculateLacksFromJSONFile(deckJSON, None, db, "01/01/2016", -100)
+    cardsList = [item['deck'].cards for item in deckList]
+    cardsList.insert(100, []) # An empty deck row, in the middle and at the end
+    cardsList.append([])
+    matrix = DeckMatrix.fromCardsList(cardsList)
+    table = CardTable(db)
+    collections = [benchmark.makeCollection(cards, seed) for seed in range(5)] + [Collection()]
+    collections[1].add((cards[0]["dbf_id"], 0)) # A card kept with a count of 0
+    collections[2].add((10000, 2)) # A card no deck uses
+    for blockBytes in (256 << 20, 64 * len(matrix.indices), 1):
+        results = list(calculateMultiLacks(matrix, collections, table, blockBytes))
+        assert len(results) == len(collections)
+        for collection, result in zip(collections, results):
+            expected = calculateBatchLacks(matrix, collection, table)
+            for field in ('lacked', 'have', 'haveMask', 'dustIn'):
+                assert np.array_equal(getattr(result, field), getattr(expected, field)), field
+            assert [result.lackedPairs(i) for i in (99, 100, len(matrix) - 1)] == [expected.lackedPairs(i) for i in (99, 100, len(matrix) - 1)]
+            assert result.dustIn[100] == 0 and result.lackedPairs(100) == [] and result.alreadyHavePairs(100) == []
+    for collection, newlist in zip(collections, deckAdvisor.scoreCollections(deckList, collections, db)):
+        assert scoredFields(newlist) == scoredFields(deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, db, "01/01/2016", -100))
+
+def withoutDeck(deckList):
+    return [(dict((key, value) for key, value in item.items() if key != 'deck'), item['deck'].cards) for item in deckList]
+
+@pytest.mark.parametrize("keep", ["first", "best"])
+def test_partitioned_corpus_equals_the_filtered_run(cards, db, deckJSON, tmp_path, keep):
+    collection = benchmark.makeCollection(cards, seed=4)
+    corpus = PartitionedCorpus(str(tmp_path / "corpus"))
+    unlimited = deckAdvisor.calculateLacksFromJSONFile(deckJSON, None, db, "01/01/2016", -100, keep=keep)
+    # The dates of every partition spread over 2016-2018, so the limits fall inside each of them
+    for dateLimit, ratingLimit in (("07/15/2017", 20), ("03/02/2018", 20), ("03/02/2018", 60)):
+        full = deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, db, dateLimit, ratingLimit, keep=keep)
+        assert len(full) > 100
+        for decktype, cardClass in ((None, None), ("standard", None), ("wild", 4), (None, 9)):
+            partitioned = deckAdvisor.calculateLacksPartitioned(deckJSON, collection, db, corpus, dateLimit, ratingLimit,
+                                                                decktype, cardClass, keep=keep)
+            expected = [item for item in full if deckAdvisor.matchDeck(item, -1, decktype, cardClass, None)]
+            assert withoutDeck(partitioned) == withoutDeck(expected)
+            dates = set(deckAdvisor.dateLimitKey(item['date']) >= deckAdvisor.dateLimitKey(dateLimit)
+                        for item in unlimited if deckAdvisor.matchDeck(item, -1, decktype, cardClass, None))
+            assert dates == {False, True} and expected
+        assert corpus.manifest["dateLimit"] == dateLimit and corpus.manifest["decks"] == len(full)
+
+def followed(path, collection, db, stateDir, cardClass=None):
+    """Follow PATH once with a freshly loaded state, as a new run of the CLI does"""
+    newlist, recommended, reports = deckAdvisor.followJSONFile(path, collection, db, FollowState(stateDir), "01/01/2017", 20,
+                                                               top=20, decktype="standard", cardClass=cardClass)
+    return newlist, [(item['url'], item['dust'], item['rating-sum']) for item in recommended], reports
+
+def oneRun(path, collection, db, cardClass=None):
+    """The results, the top decks and the card reports of reading PATH through in one run"""
+    reports = CardReports(collection)
+    deckList = deckAdvisor.calculateLacksFromJSONFile(path, collection, db, "01/01/2017", 20, batch=True, reports=reports)
+    recommended = deckAdvisor.recommendDecks(deckAdvisor.partitionDecks(deckList), 20, -1, "standard", cardClass)
+    return deckList, [(item['url'], item['dust'], item['rating-sum']) for item in recommended], reports
+
+def test_follow_equals_one_run(cards, db, deckJSON, tmp_path):
+    collection = benchmark.makeCollection(cards, seed=6)
+    with open (deckJSON, "rt") as f:
+        lines = f.readlines()
+    path = str(tmp_path / "decks.json")
+    stateDir = str(tmp_path / "follow")
+    half = len(lines) // 2
+    with open (path, "wt") as f: # The crawler is still writing a line
+        f.write("".join(lines[:half]) + lines[half][:40])
+    first, _, _ = followed(path, collection, db, stateDir)
+    with open (path, "at") as f:
+        f.write(lines[half][40:] + "".join(lines[half+1:]))
+    second, top, reports = followed(path, collection, db, stateDir)
+    deckList, expectedTop, expectedReports = oneRun(path, collection, db)
+    assert first and second
+    assert withoutDeck(first + second) == withoutDeck(deckList)
+    assert top == expectedTop
+    assert reports.getState() == expectedReports.getState()
+    assert reports.mostWanted(20) == expectedReports.mostWanted(20) and reports.useless(20) == expectedReports.useless(20)
+    # Nothing new, or other recommendation filters: the top decks are selected again from the results kept
+    assert followed(path, collection, db, stateDir)[:2] == ([], expectedTop)
+    assert followed(path, collection, db, stateDir, cardClass=4)[:2] == ([], oneRun(path, collection, db, cardClass=4)[1])
+
+    # Truncated in place, then rotated to a new file: read from the start again
+    with open (path, "r+t") as f:
+        f.truncate(len("".join(lines[:half // 2])))
+    truncated, top, _ = followed(path, collection, db, stateDir)
+    deckList, expectedTop, _ = oneRun(path, collection, db)
+    assert withoutDeck(truncated) == withoutDeck(deckList) and top == expectedTop
+    rotated = str(tmp_path / "decks.json.new")
+    with open (rotated, "wt") as f:
+        f.write("".join(lines[half // 2:]))
+    os.replace(rotated, path)
+    rotatedList, top, _ = followed(path, collection, db, stateDir)
+    deckList, expectedTop, _ = oneRun(path, collection, db)
+    assert withoutDeck(rotatedList) == withoutDeck(deckList) and top == expectedTop
+
+def twoArchetypeDecks(cards, seed, decks=120):
+    """Result dicts of two clearly separated archetypes of Mage decks, with 'truth' the archetype of every deck
+    A deck is the core of its archetype with three cards swapped for cards of a shared pool.
+    """
+    rng = random.Random(seed)
+    mage = [card['dbf_id'] for card in benchmark.deckCards(cards) if card['card_class'] == 4]
+    neutral = [card['dbf_id'] for card in benchmark.deckCards(cards) if card['card_class'] == benchmark.NEUTRAL]
+    cores = [mage[:10] + neutral[:5], mage[10:] + neutral[5:10]]
+    deckList = []
+    for i in range(decks):
+        truth = rng.randrange(2)
+        core = list(cores[truth])
+        for position, card in zip(rng.sample(range(len(core)), 3), rng.sample(neutral[20:], 3)):
+            core[position] = card
+        deck = Deck()
+        deck.heroes = [benchmark.HEROES[4]]
+        deck.format = FormatType.FT_STANDARD
+        deck.cards = [(card, 2) for card in core]
+        deckList.append({"truth": truth, "deck": deck, "url": "deck-%d" % i, "cardclass": 4, "type": "Standard",
+                         "deck-type": "Ranked Deck", "dust": rng.randrange(0, 4000, 100), "rating-sum": rng.randint(0, 50)})
+    return deckList
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_archetypes_separate_two_clear_clusters(cards, seed):
+    deckList = twoArchetypeDecks(cards, seed)
+    model = ArchetypeModel(2, batchSize=32, seed=seed)
+    model.fit([item['deck'].cards for item in deckList])
+    labeled = list(deckAdvisor.labelArchetypes(deckList, model))
+    assert labeled == deckList
+    assert [item['cluster'] for item in deckList] == [int(cluster) for cluster in model.assign([item['deck'].cards for item in deckList])[0]]
+    labels = [set(item['cluster'] for item in deckList if item['truth'] == truth) for truth in (0, 1)]
+    assert len(labels[0]) == 1 and len(labels[1]) == 1 and labels[0] != labels[1]
+    # The decks fit in later with update=True land in the clusters of their archetypes too
+    again = ArchetypeModel(2, batchSize=32, seed=seed)
+    again.fit([item['deck'].cards for item in deckList[:60]])
+    earlier = list(deckAdvisor.labelArchetypes([dict(item) for item in deckList[:60]], again))
+    later = list(deckAdvisor.labelArchetypes([dict(item) for item in deckList[60:]], again, update=True))
+    labels = [set(item['cluster'] for item in earlier + later if item['truth'] == truth) for truth in (0, 1)]
+    assert len(labels[0]) == 1 and len(labels[1]) == 1 and labels[0] != labels[1]
+
+    partitions = deckAdvisor.partitionDecks(deckList)
+    kept = deckAdvisor.recommendDecks(partitions, top=20, perArchetype=True)
+    ranked = deckAdvisor.recommendDecks(partitions, top=None)
+    best = {}
+    for item in ranked:
+        best.setdefault(item['cluster'], item)
+    assert len(kept) == 2 and sorted(item['cluster'] for item in kept) == sorted(best)
+    assert [id(item) for item in kept] == [id(item) for item in sorted(best.values(), key=lambda item: (item['dust'], -item['rating-sum']))]
+
+def test_cached_results_follow_the_collection_and_the_card_database(cards, db, deckJSON, tmp_path):
+    collection = benchmark.makeCollection(cards, seed=3)
+    cache = FilterCache(str(tmp_path / "filtered"))
+    first = deckAdvisor.calculateLacksCached(deckJSON, collection, db, cache, "01/01/2016", -100, batch=True)
+    assert scoredFields(deckAdvisor.calculateLacksCached(deckJSON, collection, db, cache, "01/01/2016", -100, batch=True)) == scoredFields(first)
+    # A card kept with 0 copies is already had with 0 copies, not only lacked
+    card = first[0]['lacked'][0][0]
+    collection.add((card, 0))
+    rescored = deckAdvisor.calculateLacksCached(deckJSON, collection, db, cache, "01/01/2016", -100, batch=True)
+    assert (card, 0) in [tuple(cardPair) for cardPair in rescored[0]['alreadyHave']]
+    # The same cards with another rarity need another amount of dust
+    changed = [dict(fixture, rarity=1 if fixture["rarity"] == 5 else 5) if fixture["dbf_id"] == card else fixture for fixture in cards]
+    xmlPath = str(tmp_path / "CardDefs.xml")
+    benchmark.writeCardDefs(changed, xmlPath)
+    newDb = deckAdvisor.initDatabaseFromXml(xmlPath, snapshotDir=None)
+    updated = deckAdvisor.calculateLacksCached(deckJSON, collection, newDb, cache, "01/01/2016", -100, batch=True)
+    assert scoredFields(updated) == scoredFields(deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, newDb, "01/01/2016", -100))
+    assert scoredFields(updated) != scoredFields(rescored)
+
+def test_checkpoint_keeps_a_window_of_update_times(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    checkpoint = CrawlCheckpoint(path, saveEvery=1000, window=100)
+    for deckId in range(1, 301):
+        checkpoint.markSeen(deckId, 1000 + deckId)
+        checkpoint.storeValidators("http://www.hearthpwn.com/decks/%d-deck" % deckId, {"ETag": '"%d"' % deckId})
+    checkpoint.storeValidators("http://www.hearthpwn.com/decks", {"ETag": '"index"'})
+    checkpoint.save()
+    checkpoint = CrawlCheckpoint(path, window=100)
+    assert checkpoint.maxDeckId == 300 and checkpoint.floorDeckId == 200
+    assert sorted(checkpoint.decks) == list(range(201, 301))
+    assert len(checkpoint.validators) == 101 and "http://www.hearthpwn.com/decks" in checkpoint.validators
+    # The pruned decks are known whatever their update time, the others by their update time
+    assert checkpoint.isKnown(150, 99999)
+    assert checkpoint.isKnown(250, 1250) and not checkpoint.isKnown(250, 1251)
+    assert not checkpoint.isKnown(301)
+
+def crawlFixtures(crawler):
+    records = []
+    stats = asyncio.run(crawler.run(records.append))
+    return records, stats
+
+def test_crawler_follows_redirects_to_another_host():
+    with FixtureServer() as site, FixtureServer() as moved:
+        moved.redirects["/decks"] = site.baseUrl + "/decks"
+        crawler = AsyncCrawler(moved.baseUrl, rate=0)
+        records, stats = crawlFixtures(crawler)
+        # The requests after the redirect go through the connections of the other host
+        assert sorted(crawler.pool.slots) == sorted(("http", "127.0.0.1", server.server_address[1]) for server in (site, moved))
+        assert len(records) == 12 and stats["redirects"] == 1 and stats["failed"] == 0
+        assert all(record["url"].startswith(site.baseUrl) for record in records)
+        assert moved.hits == {} and site.hits["/decks"] == 1
+
+        # A redirect loop stops after MAX_REDIRECTS hops
+        moved.redirects["/decks"] = "/decks"
+        with pytest.raises(HTTPError):
+            crawlFixtures(AsyncCrawler(moved.baseUrl, rate=0))
+
+def test_crawler_retries_and_reruns_incrementally(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    with FixtureServer() as server:
+        server.failures["/decks?page=2"] = 2
+        server.failures["/decks/816740-quest-shaman"] = 1
+        records, stats = crawlFixtures(AsyncCrawler(server.baseUrl, rate=0, backoff=0.01, checkpoint=CrawlCheckpoint(path)))
+        assert len(records) == 12 and stats["retries"] == 3 and stats["failed"] == 0
+        assert server.hits["/decks?page=2"] == 3 and server.hits["/decks/816740-quest-shaman"] == 2
+        assert [status for page, status, at in server.log].count(503) == 3
+
+        # Nothing has changed: the first index page is answered with 304, and the crawl stops there
+        logged = len(server.log)
+        records, stats = crawlFixtures(AsyncCrawler(server.baseUrl, rate=0, checkpoint=CrawlCheckpoint(path)))
+        assert records == [] and stats["decks"] == 0 and stats["notModified"] == 1 and stats["requests"] == 1
+        assert server.log[logged:][0][:2] == ("/decks", 304)
+
+def test_crawler_resumes_from_the_checkpoint(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    WINDOW = 200000 # The fixture decks span 128000 ids
+    with FixtureServer() as server:
+        # Stopped after the first index page, with a deck page failing every retry
+        server.failures["/decks/863058-arena-16-july-8-0-so-far"] = 2
+        records, stats = crawlFixtures(AsyncCrawler(server.baseUrl, rate=0, retries=1, backoff=0.01,
+                                                    checkpoint=CrawlCheckpoint(path, window=WINDOW), maxPages=1))
+        assert len(records) == 3 and stats["failed"] == 1
+        checkpoint = CrawlCheckpoint(path, window=WINDOW)
+        assert list(checkpoint.pending) == [server.baseUrl + "/decks/863058-arena-16-july-8-0-so-far"]
+        assert checkpoint.frontier == [server.baseUrl + "/decks?page=2"]
+
+        # The first index page is not modified, the crawl goes on with the pending deck and from the frontier
+        resumed, stats = crawlFixtures(AsyncCrawler(server.baseUrl, rate=0, checkpoint=CrawlCheckpoint(path, window=WINDOW)))
+        assert len(resumed) == 9 and stats["failed"] == 0 and stats["pages"] == 3
+        assert sorted(record["url"] for record in records + resumed) == sorted(set(record["url"] for record in records + resumed))
+        checkpoint = CrawlCheckpoint(path, window=WINDOW)
+        assert checkpoint.pending == {} and checkpoint.frontier == [] and len(checkpoint.decks) == 12
+
+        records, stats = crawlFixtures(AsyncCrawler(server.baseUrl, rate=0, checkpoint=CrawlCheckpoint(path, window=WINDOW)))
+        assert records == [] and stats["requests"] == 1
+
+@pytest.mark.parametrize("mode", ["exact", "approx"])
+def test_card_reports_weigh_the_decks_as_the_planner(mode):
+    reports = CardReports(mode=mode, weight="rating")
+    reports.add({'rating-sum': 3, 'lacked': [(1, 1), (2, 2)], 'alreadyHave': [(3, 2)]})
+    reports.add({'rating-sum': -50, 'lacked': [(1, 1), (2, 2), (4, 1)], 'alreadyHave': [(3, 2)]})
+    reports.add({'rating-sum': "Unknown", 'lacked': [(4, 1)], 'alreadyHave': []})
+    lackedOne, lackedTwo, totalLacked = reports.mostWanted()
+    assert lackedOne == [(1, 3), (4, 1)] and lackedTwo == [(2, 3)] and totalLacked[0] == (2, 6)
+    assert reports.decks == 3
+
+def nearDuplicateDecks(cards, seed, bases=40, copies=2):
+    """Result dicts of BASES decks, with up to 6 variants of every deck and up to COPIES exact copies of a variant
+    """
+    rng = random.Random(seed)
+    ids = [card['dbf_id'] for card in benchmark.deckCards(cards)]
+    deckList = []
+    for base in range(bases):
+        deck = dict((card, rng.randint(1, 2)) for card in rng.sample(ids, 18))
+        for variant in range(rng.randint(1, 6)):
+            cardPairs = dict(deck)
+            for card in rng.sample(sorted(cardPairs), rng.randint(0, 6)):
+                del cardPairs[card]
+                cardPairs[rng.choice(ids)] = 1
+            for copy in range(rng.randint(1, copies)):
+                item = {'deck': Deck(), 'cardclass': None, 'type': "Standard", 'deck-type': "Ranked Deck",
+                        'dust': base * 10 + variant, 'rating-sum': rng.randint(0, 50)}
+                item['deck'].cards = sorted(cardPairs.items())
+                deckList.append(item)
+    rng.shuffle(deckList)
+    return deckList
+
+@pytest.mark.parametrize("threshold", [0.6, 0.8])
+def test_collapse_near_duplicates(cards, threshold):
+    deckList = nearDuplicateDecks(cards, threshold)
+    kept = collapseNearDuplicates(deckList, threshold)
+    keptIds = set(map(id, kept))
+    assert 40 <= len(kept) < len(deckList) and kept == [item for item in deckList if id(item) in keptIds]
+    # Every deck dropped is a near duplicate of an earlier deck kept
+    for i, item in enumerate(deckList):
+        if id(item) not in keptIds:
+            assert any(multisetJaccard(item['deck'].cards, other['deck'].cards) >= threshold
+                       for other in deckList[:i] if id(other) in keptIds)
+    # The copies of a deck are always merged, and the LSH bands (32 of 2 rows) find the near duplicates
+    assert len(set(tuple(item['deck'].cards) for item in kept)) == len(kept)
+    assert all(multisetJaccard(a['deck'].cards, b['deck'].cards) < threshold for i, a in enumerate(kept) for b in kept[:i])
+
+def test_collapse_reads_the_ranking_until_top_decks_are_kept(cards):
+    deckList = nearDuplicateDecks(cards, 1, copies=6)
+    partitions = deckAdvisor.partitionDecks(deckList)
+    ranked = list(deckAdvisor.recommendDecks(partitions, top=None))
+    assert ranked == deckAdvisor.recommendDecks(partitions, top=len(deckList))
+    # The variants of a deck are ranked together: 5 * top ranked decks hold fewer than top representatives
+    assert len(collapseNearDuplicates(ranked[:5 * 20], 0.5)) < 20
+    kept = collapseNearDuplicates(deckAdvisor.recommendDecks(partitions, top=None), 0.5, 20)
+    assert len(kept) == 20 and kept == collapseNearDuplicates(ranked, 0.5)[:20]
+
+def test_display_names_survive_a_rebuild(cards, tmp_path):
+    xmlPath = str(tmp_path / "CardDefs.xml")
+    snapshotDir = str(tmp_path / "cache")
+    benchmark.writeCardDefs(cards, xmlPath)
+    loaded = deckAdvisor.initDatabaseFromXml(xmlPath, snapshotDir=snapshotDir)
+    assert deckAdvisor.initDatabaseFromXml(xmlPath, snapshotDir=snapshotDir).display.path == loaded.display.path
+
+    # Another process rebuilds the database from a changed xml file, before a name is read here
+    # (hearthstone.cardxml.load() caches the cards of a path, the new ones are written into another)
+    renamed = [dict(card, name="A much longer name of " + card["name"]) for card in cards]
+    xmlPath = str(tmp_path / "CardDefs.new.xml")
+    benchmark.writeCardDefs(renamed, xmlPath)
+    rebuilt = deckAdvisor.initDatabaseFromXml(xmlPath, snapshotDir=snapshotDir, rebuild=True)
+    assert rebuilt.display.path != loaded.display.path and not os.path.exists(loaded.display.path)
+    assert [loaded[card["dbf_id"]].name for card in cards] == [card["name"] for card in cards]
+    assert [rebuilt[card["dbf_id"]].name for card in cards] == [card["name"] for card in renamed]
+    assert len([name for name in os.listdir(snapshotDir) if name.endswith(".display")]) == 1
+
+def test_deck_cache_appends_the_new_decodes(deckJSON, tmp_path):
+    with open (deckJSON, "rt") as f:
+        deckstrings = list(dict.fromkeys(json.loads(line)["result"]["deckstring"] for line in f))[:300]
+    path = str(tmp_path / "deckstrings.cache")
+    cache = DeckCache(path)
+    for deckstring in deckstrings[:100]:
+        cache.decode(deckstring)
+    cache.save()
+    with open (path, "rb") as f:
+        first = f.read()
+    inode = os.stat(path).st_ino
+    recordsEnd = cache._indexOffset
+
+    # The records written before stay where they are, the new ones are appended
+    cache = DeckCache(path)
+    for deckstring in deckstrings[50:200]:
+        cache.decode(deckstring)
+    assert cache.hits == 50 and cache.misses == 100
+    cache.save()
+    with open (path, "rb") as f:
+        second = f.read()
+    assert os.stat(path).st_ino == inode and second[24:recordsEnd] == first[24:recordsEnd] and len(second) > len(first)
+
+    # Only hits: the stamps are updated in place
+    cache = DeckCache(path)
+    for deckstring in deckstrings[:10]:
+        cache.decode(deckstring)
+    cache.save()
+    assert os.path.getsize(path) == len(second) and os.stat(path).st_ino == inode
+    cache = DeckCache(path)
+    assert sorted(cache._index["stamp"].tolist()) == [1] * 40 + [2] * 150 + [3] * 10
+
+    for deckstring in deckstrings[:200]:
+        assert cache.decode(deckstring).cards == Deck.from_deckstring(deckstring).cards
+    assert cache.misses == 0
+
+    # Over the limit, the least recently used entries are evicted in a rewrite
+    cache = DeckCache(path, maxEntries=150)
+    for deckstring in deckstrings[200:250]:
+        cache.decode(deckstring)
+    cache.save()
+    assert os.stat(path).st_ino != inode and len(cache) == 150
+    assert all(cache.decode(deckstring) != None for deckstring in deckstrings[:10] + deckstrings[200:250]) and cache.misses == 50
+
+def referenceGreedy(deckList, db, budget):
+    """The greedy plan by a full scan: craft what the deck of the best completed weight / dust needs, again and again
+    """
+    crafts = {}
+    dust = 0
+    completed = []
+    def missing(item):
+        return dict((card, count - crafts.get(card, 0)) for card, count in item['lacked'] if crafts.get(card, 0) < count)
+    candidates = [deckId for deckId, item in enumerate(deckList) if item['lacked'] and deckWeight(item) > 0]
+    while True:
+        best = None
+        for deckId in candidates:
+            lacked = missing(deckList[deckId])
+            if not lacked:
+                continue
+            cost = sum(DUST_IN.get(db[card].rarity, 0) * count for card, count in lacked.items())
+            if cost > budget - dust:
+                continue
+            target = dict(crafts)
+            target.update((card, crafts.get(card, 0) + count) for card, count in lacked.items())
+            gain = sum(deckWeight(deckList[other]) for other in candidates if missing(deckList[other])
+                       and all(target.get(card, 0) >= count for card, count in deckList[other]['lacked']))
+            key = (-(gain / cost if cost > 0 else float("inf")), deckId)
+            if best == None or key < best[0]:
+                best = (key, deckId, cost, target)
+        if best == None:
+            break
+        key, deckId, cost, target = best
+        completed += [other for other in candidates if missing(deckList[other])
+                      and all(target.get(card, 0) >= count for card, count in deckList[other]['lacked'])]
+        crafts = target
+        dust += cost
+    return crafts, dust, sorted(completed)
+
+@pytest.mark.parametrize("budget", [400, 3000, 20000])
+def test_craft_plan_equals_a_greedy_scan(cards, db, deckJSON, budget):
+    collection = benchmark.makeCollection(cards, seed=3)
+    deckList = deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, db, "01/01/2016", -100)[:400]
+    plan = planCrafts(deckList, db, budget)
+    crafts, dust, completed = referenceGreedy(deckList, db, budget)
+    assert (plan.crafts, plan.dust, sorted(plan.completed)) == (crafts, dust, completed)
+    assert plan.weight == sum(deckWeight(deckList[deckId]) for deckId in completed)
+
+def query(server, path, data=None):
+    request = urllib.request.Request(server.baseUrl + path, data=json.dumps(data).encode() if data != None else None)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+def test_daemon_answers_as_the_cli(cards, deckJSON, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    xmlPath = str(tmp_path / "CardDefs.xml")
+    benchmark.writeCardDefs(cards, xmlPath)
+    collectionFile = str(tmp_path / "mycards.csv")
+    benchmark.makeCollection(cards, seed=3).writeToFiles(collectionFile)
+    state = AdvisorState(xmlPath, deckJSON, collectionFile, None, "01/01/2016", -100,
+                         filterCacheDir=str(tmp_path / "filtered"), deckCacheFile=str(tmp_path / "deckstrings.cache"))
+    server = AdvisorServer(state, port=0, poll=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        def expected(collection):
+            deckList = deckAdvisor.calculateLacksFromJSONFile(deckJSON, collection, state.db, "01/01/2016", -100)
+            wanted = [list(cardPair) for cardPair in list(deckAdvisor.theMostWantedCards(deckList)[2])[:40]]
+            useless = [list(cardPair) for cardPair in deckAdvisor.theUselessCards(collection, deckList)[:40]]
+            recommended = [item['deckstring'] for item in deckAdvisor.recommendDecks(deckAdvisor.partitionDecks(deckList), 10, 2000, "standard", None)]
+            return wanted, useless, recommended
+        def answered():
+            wanted = [[card["card"], card["count"]] for card in query(server, "/wanted?top=40")[1]["result"]]
+            useless = [[card["card"], card["count"]] for card in query(server, "/useless?top=40")[1]["result"]]
+            recommended = [item["deckstring"] for item in query(server, "/recommend?format=standard&dust=2000&top=10")[1]["result"]]
+            return wanted, useless, recommended
+        assert answered() == expected(deckAdvisor.loadCollection(collectionFile))
+        assert query(server, "/status")[1]["result"]["decks"] == len(state.scorer.deckList)
+
+        # Update the collection: the decks containing the cards are re-scored, and it's saved
+        changes = [[cards[0]["dbf_id"], 2], [cards[1]["dbf_id"], -2], [cards[2]["dbf_id"], 1]]
+        status, body = query(server, "/collection", {"add": changes})
+        assert status == 200 and body["result"]["rescored"] == len(state.scorer.index.decksContainingAny([card for card, count in changes]))
+        assert answered() == expected(deckAdvisor.loadCollection(collectionFile))
+
+        assert query(server, "/recommend?class=NOTACLASS")[0] == 400
+        assert query(server, "/wanted?top=many")[0] == 400
+        assert query(server, "/collection", {"remove": changes})[0] == 400
+        assert query(server, "/nothing")[0] == 404
+    finally:
+        server.shutdown()
+        server.server_close()
+        state.scorer.close()
 
+def saveDecodes(path, deckstrings, rounds, barrier):
+    for i in range(rounds):
+        cache = DeckCache(path)
+        for deckstring in deckstrings[i::rounds]:
+            cache.decode(deckstring)
+        barrier.wait()
+        cache.save()
+        cache.close()
 
-with open ('t3.json', 'r') as f:
-    for line in f.readlines():
-        data = json.loads(line)['result']
-    print (data)
+def test_deck_cache_concurrent_savers(deckJSON, tmp_path):
+    with open (deckJSON, "rt") as f:
+        deckstrings = list(dict.fromkeys(json.loads(line)["result"]["deckstring"] for line in f))[:600]
+    path = str(tmp_path / "deckstrings.cache")
+    context = multiprocessing.get_context("fork")
+    barrier = context.Barrier(3)
+    # Three savers, overlapping on a third of their decks, saving at the same time every round
+    savers = [context.Process(target=saveDecodes, args=(path, deckstrings[i * 150:i * 150 + 300], 5, barrier)) for i in range(3)]
+    for saver in savers:
+        saver.start()
+    for saver in savers:
+        saver.join(120)
+        assert saver.exitcode == 0
+    cache = DeckCache(path)
+    assert len(cache) == 600 and len(set(cache._index["hash"].tolist())) == 600
+    for deckstring in deckstrings:
+        assert cache.decode(deckstring).cards == Deck.from_deckstring(deckstring).cards
+    assert cache.misses == 0
 
-print (calculateLacksFromJSONFile('t3.json', col2, db_dbf))
+if __name__ == "__main__":
+    demo()
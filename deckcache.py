@@ -0,0 +1,319 @@
+'''
+On-disk cache of decoded deckstrings
+
+'''
+
+import os
+import mmap
+import fcntl
+import struct
+import hashlib
+import numpy as np
+from hearthstone.deckstrings import Deck
+from hearthstone.enums import FormatType
+
+CACHE_MAGIC = b"DADC"
+CACHE_VERSION = 2
+
+# magic, version, number of entries, generation, offset of the index
+HEADER = struct.Struct("<4sIIIQ")
+# Every index entry: hash of the deckstring, offset and length of the record,
+# and the generation (save count) it's used the last time, for LRU eviction.
+INDEX_DTYPE = np.dtype([("hash", "<u8"), ("offset", "<u8"), ("length", "<u4"), ("stamp", "<u4")])
+
+# Record head: key length, format, number of heroes, cards and sideboard cards
+RECORD_HEAD = struct.Struct("<HBBHH")
+
+def deckstringHash(key):
+    """Return the 64-bit hash of the deckstring KEY (bytes)
+    """
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+def encodeDeck(key, deck):
+    """Encode a deckstring and its decoded deck into a compact binary record
+    Layout: head, key, hero ids, card ids, card counts, then the sideboard
+    card ids, counts and owners.
+
+    Args:
+      key: The deckstring, as bytes
+      deck: The decoded Deck
+    Returns:
+      record: The record bytes
+    """
+    sideboards = getattr(deck, "sideboards", None) or []
+    numCards = len(deck.cards)
+    numSideboards = len(sideboards)
+    return b"".join((
+        RECORD_HEAD.pack(len(key), int(deck.format), len(deck.heroes), numCards, numSideboards),
+        key,
+        struct.pack("<%dI" % len(deck.heroes), *deck.heroes),
+        struct.pack("<%dI" % numCards, *[cardPair[0] for cardPair in deck.cards]),
+        bytes(cardPair[1] for cardPair in deck.cards),
+        struct.pack("<%dI" % numSideboards, *[triple[0] for triple in sideboards]),
+        bytes(triple[1] for triple in sideboards),
+        struct.pack("<%dI" % numSideboards, *[triple[2] for triple in sideboards])))
+
+def recordKey(buf, offset):
+    """Return the deckstring (bytes) of the record starting at OFFSET in BUF
+    """
+    keyLen = RECORD_HEAD.unpack_from(buf, offset)[0]
+    start = offset + RECORD_HEAD.size
+    return buf[start:start+keyLen]
+
+def decodeRecord(buf, offset):
+    """Decode a record produced by encodeDeck()
+
+    Args:
+      buf: The buffer holding the record
+      offset: Where the record starts in BUF
+    Returns:
+      deck: The Deck
+    """
+    keyLen, deckFormat, numHeroes, numCards, numSideboards = RECORD_HEAD.unpack_from(buf, offset)
+    offset += RECORD_HEAD.size + keyLen
+    heroes = list(struct.unpack_from("<%dI" % numHeroes, buf, offset))
+    offset += 4 * numHeroes
+    cardIds = struct.unpack_from("<%dI" % numCards, buf, offset)
+    offset += 4 * numCards
+    cards = list(zip(cardIds, buf[offset:offset+numCards]))
+    offset += numCards
+
+    deck = Deck()
+    deck.cards = cards
+    deck.heroes = heroes
+    deck.format = FormatType(deckFormat)
+    if numSideboards:
+        sideboardIds = struct.unpack_from("<%dI" % numSideboards, buf, offset)
+        offset += 4 * numSideboards
+        counts = buf[offset:offset+numSideboards]
+        offset += numSideboards
+        owners = struct.unpack_from("<%dI" % numSideboards, buf, offset)
+        deck.sideboards = list(zip(sideboardIds, counts, owners))
+    return deck
+
+class DeckCache:
+    """Map deckstring -> decoded Deck, persisted in a single binary file
+    The file holds the records followed by an index sorted by deckstring hash.
+    The index is memory-mapped and binary searched, so opening the cache reads nothing.
+    New decodes are kept in memory until save(), which appends them after the
+    records and writes the new index after them, leaving the old index behind
+    as dead bytes; a save with nothing new only updates the stamps of the index
+    in place. The file is rewritten only to evict the least recently used
+    entries when the cache grows over its limits, or when the dead bytes
+    outgrow the records.
+    """
+    def __init__(self, path, maxEntries=1000000, maxBytes=256 << 20):
+        """Constructor
+
+        Args:
+          path: The cache file, created on save() if it doesn't exist
+          maxEntries: Keep at most this number of decks in the cache
+          maxBytes: Keep at most this size of records in the cache
+        """
+        self.path = path
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.pending = {}  # deckstring bytes -> record, decoded in this run
+        self.touched = set() # index positions hit in this run
+        self.hits = 0
+        self.misses = 0
+        self._file = None
+        self._mm = None
+        self._index = np.zeros(0, dtype=INDEX_DTYPE)
+        self._indexOffset = 0 # Where the index starts in the file
+        self._liveBytes = 0 # The bytes of the records in the index
+        self._generation = 0
+        self._open()
+
+    def _open(self):
+        """Map the cache file, an invalid file is treated as an empty cache
+        """
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < HEADER.size:
+            return
+        self._file = open(self.path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, generation, indexOffset = HEADER.unpack_from(self._mm, 0)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or indexOffset < HEADER.size\
+           or indexOffset + count * INDEX_DTYPE.itemsize > len(self._mm):
+            self.close()
+            return
+        self._index = np.frombuffer(self._mm, dtype=INDEX_DTYPE, count=count, offset=indexOffset)
+        self._indexOffset = indexOffset
+        self._liveBytes = int(self._index["length"].sum(dtype=np.uint64))
+        self._generation = generation
+
+    def close(self):
+        """Unmap the cache file, without saving
+        """
+        self._index = np.zeros(0, dtype=INDEX_DTYPE)
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __len__(self):
+        return len(self._index) + len(self.pending)
+
+    def _find(self, key):
+        """Return the index position of deckstring KEY (bytes), or -1
+        """
+        hashes = self._index["hash"]
+        h = np.uint64(deckstringHash(key))
+        pos = int(hashes.searchsorted(h))
+        while pos < len(hashes) and hashes[pos] == h:
+            if recordKey(self._mm, int(self._index["offset"][pos])) == key:
+                return pos
+            pos += 1 # A hash collision
+        return -1
+
+    def decode(self, deckstring):
+        """Return the Deck of DECKSTRING, decoding it only if it isn't cached
+
+        Args:
+          deckstring: The deckstring to decode
+        Returns:
+          deck: The decoded Deck
+        """
+        key = deckstring.strip().encode()
+        record = self.pending.get(key)
+        if record is not None:
+            self.hits += 1
+            return decodeRecord(record, 0)
+        pos = self._find(key)
+        if pos >= 0:
+            self.hits += 1
+            self.touched.add(pos)
+            return decodeRecord(self._mm, int(self._index["offset"][pos]))
+        self.misses += 1
+        deck = Deck.from_deckstring(deckstring)
+        self.pending[key] = encodeDeck(key, deck)
+        return deck
+
+    def save(self):
+        """Write the new decodes and the stamps into the cache file
+        They are appended, unless entries have to be evicted, or the dead bytes
+        outgrow the records: then the file is rewritten. The savers of a cache
+        file take turns on an exclusive lock of PATH.lock, and if another one
+        has saved since the file is mapped, the file is mapped again first and
+        the decodes it holds already are left out.
+        """
+        if not self.pending and not self.touched:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open (self.path + ".lock", "ab") as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.path) if self._mm is None else not self._isMapped():
+                    self._remap()
+                generation = self._generation + 1
+                stamps = self._index["stamp"].copy()
+                stamps[sorted(self.touched)] = generation
+                pendingBytes = sum(len(record) for record in self.pending.values())
+                if self._mm is None\
+                   or len(self._index) + len(self.pending) > self.maxEntries\
+                   or self._liveBytes + pendingBytes > self.maxBytes\
+                   or len(self._mm) - HEADER.size - self._index.nbytes - self._liveBytes > self._liveBytes:
+                    self._rewrite(generation, stamps)
+                else:
+                    self._append(generation, stamps)
+                self.close()
+                self.pending = {}
+                self.touched = set()
+                self._open()
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    def _remap(self):
+        """Map the cache file again after another saver has changed it, keeping the decodes and hits of this run
+        """
+        touchedKeys = [recordKey(self._mm, int(self._index["offset"][pos])) for pos in self.touched]
+        self.close()
+        self._open()
+        self.touched = set(pos for pos in map(self._find, touchedKeys) if pos >= 0)
+        if self._mm is not None:
+            self.pending = dict((key, record) for key, record in self.pending.items() if self._find(key) < 0)
+
+    def _isMapped(self):
+        """Return whether the cache file is still the file mapped, with the same size
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        mapped = os.fstat(self._file.fileno())
+        return (stat.st_dev, stat.st_ino, stat.st_size) == (mapped.st_dev, mapped.st_ino, len(self._mm))
+
+    def _append(self, generation, stamps):
+        """Append the pending records and the new index to the cache file, then point the header to the index
+        Without pending records, the stamps are updated in the index in place.
+        """
+        index = np.zeros(len(self._index) + len(self.pending), dtype=INDEX_DTYPE)
+        index[:len(self._index)] = self._index
+        index["stamp"][:len(self._index)] = stamps
+        with open (self.path, "r+b") as f:
+            if not self.pending:
+                indexOffset = self._indexOffset
+            else:
+                offset = len(self._mm)
+                f.seek(offset)
+                for i, (key, record) in enumerate(self.pending.items()):
+                    index[len(self._index) + i] = (deckstringHash(key), offset, len(record), generation)
+                    f.write(record)
+                    offset += len(record)
+                index = index[np.argsort(index["hash"], kind="stable")]
+                indexOffset = offset
+            f.seek(indexOffset)
+            f.write(index.tobytes())
+            f.seek(0)
+            f.write(HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(index), generation, indexOffset))
+
+    def _rewrite(self, generation, stamps):
+        """Write the cache file anew, evicting the least recently used entries if needed
+        """
+        entries = [] # (stamp, hash, record)
+        for pos, entry in enumerate(self._index):
+            start = int(entry["offset"])
+            record = bytes(self._mm[start:start+int(entry["length"])])
+            entries.append((int(stamps[pos]), int(entry["hash"]), record))
+        for key, record in self.pending.items():
+            entries.append((generation, deckstringHash(key), record))
+
+        # Keep the most recently used ones
+        entries.sort(key=lambda entry: entry[0], reverse=True)
+        kept = []
+        totalBytes = 0
+        for entry in entries:
+            if len(kept) >= self.maxEntries or totalBytes + len(entry[2]) > self.maxBytes:
+                break
+            kept.append(entry)
+            totalBytes += len(entry[2])
+        kept.sort(key=lambda entry: entry[1])
+
+        index = np.zeros(len(kept), dtype=INDEX_DTYPE)
+        offset = HEADER.size
+        for i, (stamp, h, record) in enumerate(kept):
+            index[i] = (h, offset, len(record), stamp)
+            offset += len(record)
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        tmpPath = self.path + ".tmp"
+        with open (tmpPath, "wb") as f:
+            f.write(HEADER.pack(CACHE_MAGIC, CACHE_VERSION, len(kept), generation, offset))
+            for stamp, h, record in kept:
+                f.write(record)
+            f.write(index.tobytes())
+        self.close()
+        os.replace(tmpPath, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.save()
+        self.close()
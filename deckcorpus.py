@@ -0,0 +1,162 @@
+'''
+The filtered deck corpus partitioned by format and card class on disk
+
+'''
+
+import os
+import re
+import json
+import heapq
+import shutil
+from carddb import fileDigest
+
+CORPUS_VERSION = 1
+
+def partitionName(decktype, cardClass):
+    """Return the file name of a partition, eg. standard-4.json
+    """
+    return "%s-%s.json" % (re.sub(r"[^a-z0-9]+", "_", str(decktype).lower()),
+                           int(cardClass) if cardClass != None else "none")
+
+class PartitionedCorpus:
+    """The decks of a deck json file passing the filters and the dedup, split into format x class partitions
+    Every partition is a json lines file of unscored result dicts, see
+    deckAdvisor.buildDeckDicts(), each with its position "seq" in the whole
+    corpus. The manifest records the source file, the filters, the dedup
+    policy and the card database the corpus is built with, and the partitions.
+    A query restricted by format or class reads only the matching partitions,
+    merged back into the corpus order.
+    """
+    def __init__(self, directory):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          directory: Where the manifest and the partitions are kept
+        """
+        self.directory = directory
+        self.manifestPath = os.path.join(directory, "manifest.json")
+        self.manifest = None # The manifest dict, None if there isn't a valid corpus
+        try:
+            with open (self.manifestPath, "rt") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == CORPUS_VERSION:
+                self.manifest = manifest
+        except (OSError, ValueError):
+            pass
+
+    def filePath(self, name):
+        return os.path.join(self.directory, name)
+
+    def isBuiltFrom(self, path, dateLimit, ratingLimit, keep, dbDigest):
+        """Return whether the corpus is built from the current content of PATH with these filters, dedup policy and card database
+        The sha1 of PATH is only computed if its size is the same but its mtime isn't.
+        The card database decides the class of a deck, see carddb.databaseDigest().
+        """
+        manifest = self.manifest
+        if manifest == None or (manifest["dateLimit"], manifest["ratingLimit"], manifest["keep"], manifest.get("db")) != (dateLimit, ratingLimit, keep, dbDigest):
+            return False
+        if manifest["source"] != os.path.abspath(path):
+            return False
+        stat = os.stat(path)
+        if stat.st_size != manifest["size"]:
+            return False
+        if stat.st_mtime_ns != manifest["mtime"]:
+            if fileDigest(path) != manifest["sha1"]:
+                return False
+            manifest["mtime"] = stat.st_mtime_ns # Touched only
+            self.save()
+        for partition in manifest["partitions"].values():
+            if not os.path.exists(self.filePath(partition["file"])):
+                return False
+        return True
+
+    def build(self, path, records, dateLimit, ratingLimit, keep, dbDigest):
+        """Write the corpus of deck json file PATH
+
+        Args:
+          path: The source deck json file
+          records: The unscored result dicts of the decks passing the filters and the dedup, in file order
+          dateLimit, ratingLimit, keep: The filters and the dedup policy RECORDS are produced with
+          dbDigest: carddb.databaseDigest() of the card database RECORDS are produced with
+        Returns:
+          count: The number of decks written
+        """
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        stat = os.stat(path)
+        partitions = {} # "type/class" -> {"type", "cardclass", "file", "decks"}
+        files = {}
+        seq = 0
+        try:
+            for newdict in records:
+                cardClass = int(newdict['cardclass']) if newdict['cardclass'] != None else None
+                key = "%s/%s" % (newdict['type'], cardClass)
+                if key not in partitions:
+                    name = partitionName(newdict['type'], cardClass)
+                    partitions[key] = {"type": newdict['type'], "cardclass": cardClass, "file": name, "decks": 0}
+                    files[key] = open(self.filePath(name), "wt")
+                deck = newdict.pop('deck')
+                newdict['seq'] = seq
+                json.dump(newdict, files[key])
+                files[key].write('\n')
+                newdict.pop('seq')
+                newdict['deck'] = deck
+                partitions[key]["decks"] += 1
+                seq += 1
+        finally:
+            for f in files.values():
+                f.close()
+        self.manifest = {"version": CORPUS_VERSION,
+                         "source": os.path.abspath(path),
+                         "size": stat.st_size,
+                         "mtime": stat.st_mtime_ns,
+                         "sha1": fileDigest(path),
+                         "dateLimit": dateLimit,
+                         "ratingLimit": ratingLimit,
+                         "keep": keep,
+                         "db": dbDigest,
+                         "decks": seq,
+                         "partitions": partitions}
+        self.save()
+        return seq
+
+    def matchingPartitions(self, decktype=None, cardClass=None):
+        """Return the partitions a query may find decks in, as deckAdvisor.matchDeck() filters them
+
+        Args:
+          decktype: standard, wild or None for both, the "Unknown" decks always match
+          cardClass: The class of the decks, or None for all classes
+        """
+        if decktype == 'standard':
+            decktype = 'Standard'
+        if decktype == 'wild':
+            decktype = 'Wild'
+        return [partition for partition in self.manifest["partitions"].values()
+                if not (cardClass and partition["cardclass"] != cardClass)
+                and not (decktype and not (decktype in partition["type"]) and partition["type"] != "Unknown")]
+
+    def read(self, decktype=None, cardClass=None):
+        """Read the decks of the matching partitions, in the corpus order
+
+        Yields:
+          newdict: The unscored result dict, without the 'deck' field
+        """
+        files = [open(self.filePath(partition["file"]), "rt")
+                 for partition in self.matchingPartitions(decktype, cardClass)]
+        try:
+            for newdict in heapq.merge(*[map(json.loads, f) for f in files], key=lambda newdict: newdict['seq']):
+                newdict.pop('seq')
+                yield newdict
+        finally:
+            for f in files:
+                f.close()
+
+    def save(self):
+        """Write the manifest
+        """
+        tmpPath = self.manifestPath + ".tmp"
+        with open (tmpPath, "wt") as f:
+            json.dump(self.manifest, f, indent=1)
+        os.replace(tmpPath, self.manifestPath)
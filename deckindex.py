@@ -0,0 +1,108 @@
+'''
+Card -> deck posting lists over a deck list
+
+'''
+
+class DeckIndex:
+    """An inverted index from card dbf_id to the ids of the decks containing or lacking it
+    A deck id is the position of the deck in the indexed deck list.
+    Every query costs in proportion to the sizes of the posting lists it touches.
+    """
+    def __init__(self):
+        """Constructor
+        All the member vars are listed
+        """
+        self.postings = {} # dbf_id -> list of deck ids containing the card, in increasing order
+        self.lackPostings = {} # dbf_id -> {deck id: lacked count}
+        self.lackedCards = {} # deck id -> the card ids the deck lacks
+        self.num_of_decks = 0 # How many decks are indexed
+
+    def add(self, deckId, cards, lacked=None):
+        """Index a deck, deck ids must be added in increasing order
+
+        Args:
+          deckId: The id of the deck
+          cards: The deck in format [(card id, count)]
+          lacked: The lacked cards of the deck in format [(card id, count)], or None if unknown
+        """
+        for cardPair in cards:
+            posting = self.postings.get(cardPair[0])
+            if posting == None:
+                self.postings[cardPair[0]] = [deckId]
+            else:
+                posting.append(deckId)
+        self.num_of_decks += 1
+        if lacked != None:
+            self.setLacked(deckId, lacked)
+
+    def setLacked(self, deckId, lacked):
+        """Set or replace the lacked cards of a deck
+
+        Args:
+          deckId: The id of the deck
+          lacked: The lacked cards of the deck in format [(card id, count)]
+        """
+        for card in self.lackedCards.get(deckId, []):
+            posting = self.lackPostings[card]
+            posting.pop(deckId)
+            if not posting:
+                self.lackPostings.pop(card)
+        for cardPair in lacked:
+            posting = self.lackPostings.get(cardPair[0])
+            if posting == None:
+                self.lackPostings[cardPair[0]] = {deckId: cardPair[1]}
+            else:
+                posting[deckId] = cardPair[1]
+        self.lackedCards[deckId] = [cardPair[0] for cardPair in lacked]
+
+    def decksContaining(self, card):
+        """Return the ids of the decks containing CARD
+
+        Args:
+          card: A dbf id of a card
+        """
+        return self.postings.get(card, [])
+
+    def decksContainingAny(self, cards):
+        """Return the sorted ids of the decks containing any of CARDS
+
+        Args:
+          cards: An iterable of card dbf ids
+        """
+        deckIds = set()
+        for card in cards:
+            deckIds.update(self.postings.get(card, []))
+        return sorted(deckIds)
+
+    def decksLacking(self, card):
+        """Return the sorted ids of the decks lacking CARD
+
+        Args:
+          card: A dbf id of a card
+        """
+        return sorted(self.lackPostings.get(card, {}))
+
+    def decksLackingOnly(self, card):
+        """Return the sorted ids of the decks that lack CARD and nothing else
+        ie. the decks completed by crafting enough copies of CARD
+
+        Args:
+          card: A dbf id of a card
+        """
+        return sorted(deckId for deckId in self.lackPostings.get(card, {})
+                      if len(self.lackedCards[deckId]) == 1)
+
+    def decksCompletedBy(self, crafts):
+        """Return the sorted ids of the decks that become complete after CRAFTS
+        The decks that are complete already are not included.
+
+        Args:
+          crafts: The crafted cards in format [(card id, count)]
+        """
+        covered = {} # deck id -> how many kinds of its lacked cards are crafted enough
+        for cardPair in crafts:
+            for deckId, count in self.lackPostings.get(cardPair[0], {}).items():
+                if count <= cardPair[1]:
+                    covered[deckId] = covered.get(deckId, 0) + 1
+        return sorted(deckId for deckId in covered
+                      if covered[deckId] == len(self.lackedCards[deckId]))
@@ -0,0 +1,170 @@
+'''
+Cache of the filtered deck json and the scored results
+
+'''
+
+import os
+import json
+import hashlib
+from datetime import datetime as dt
+from carddb import fileDigest
+
+MANIFEST_VERSION = 1
+RESULTS_PER_ENTRY = 4 # The results of the most recent collections kept for an entry
+
+def _dateKey(dateLimit):
+    return dt.strptime(dateLimit, "%m/%d/%Y")
+
+class FilterCache:
+    """The filtered versions of deck json files, and the results scored from them
+    An entry is keyed by the source file's size, mtime and sha1 plus the date
+    and rating limits. Its filtered file holds the decks passing the filters
+    before deduplication, so any stricter filter (a later date or a higher
+    rating) can be run on it instead of the source, with the same result.
+    The scored results of an entry are keyed by the collection fingerprint
+    and the dedup policy.
+    """
+    def __init__(self, directory, maxEntries=8):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          directory: Where the manifest and the cached files are kept
+          maxEntries: How many entries to keep, the least recently used ones are removed
+        """
+        self.directory = directory
+        self.manifestPath = os.path.join(directory, "manifest.json")
+        self.maxEntries = maxEntries
+        self.entries = [] # The entry dicts, see newEntry()
+        self.clock = 0 # Increased by every lookup, stamps the entries used
+        self.digests = {} # (path, size, mtime) -> sha1, of the files hashed by this object
+        try:
+            with open (self.manifestPath, "rt") as f:
+                manifest = json.load(f)
+            if manifest.get("version") == MANIFEST_VERSION:
+                self.entries = manifest["entries"]
+                self.clock = manifest["clock"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def filePath(self, name):
+        return os.path.join(self.directory, name)
+
+    def filteredSize(self, entry):
+        return os.path.getsize(self.filePath(entry["filtered"]))
+
+    def sourceKey(self, path):
+        """Return the identity of the source file PATH: (size, mtime, sha1)
+        The sha1 is only computed if no entry of the same size and mtime knows it.
+        """
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        for entry in self.entries:
+            if (entry["source"], entry["size"], entry["mtime"]) == key:
+                return stat.st_size, stat.st_mtime_ns, entry["sha1"]
+        if key not in self.digests:
+            self.digests[key] = fileDigest(path)
+        return stat.st_size, stat.st_mtime_ns, self.digests[key]
+
+    def lookup(self, path, dateLimit, ratingLimit):
+        """Find the entry to read the decks of source PATH from
+
+        Args:
+          path: The source deck json file
+          dateLimit, ratingLimit: The filters, see deckAdvisor.calculateLacksFromJSONFile()
+        Returns:
+          entry: The entry with exactly these filters, or else the smallest one
+            with looser filters, or None
+          exact: Whether the entry has exactly these filters
+        """
+        size, mtime, sha1 = self.sourceKey(path)
+        # The entries of the old content of the source are useless now
+        for entry in list(self.entries):
+            if entry["source"] == os.path.abspath(path) and entry["sha1"] != sha1:
+                self.remove(entry)
+        # An entry whose filtered file is lost can't be used
+        for entry in list(self.entries):
+            if not os.path.exists(self.filePath(entry["filtered"])):
+                self.remove(entry)
+        best = None
+        for entry in self.entries:
+            if entry["sha1"] != sha1 or entry["size"] != size:
+                continue
+            entry["mtime"] = mtime # The file may be touched without being changed
+            if entry["dateLimit"] == dateLimit and entry["ratingLimit"] == ratingLimit:
+                best = entry
+                break
+            if _dateKey(entry["dateLimit"]) <= _dateKey(dateLimit) and entry["ratingLimit"] <= ratingLimit:
+                if best == None or self.filteredSize(entry) < self.filteredSize(best):
+                    best = entry
+        if best == None:
+            return None, False
+        self.clock += 1
+        best["used"] = self.clock
+        return best, best["dateLimit"] == dateLimit and best["ratingLimit"] == ratingLimit
+
+    def newEntry(self, path, dateLimit, ratingLimit):
+        """Create an entry for source PATH, it's added by add() after its filtered file is written
+        """
+        size, mtime, sha1 = self.sourceKey(path)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        name = hashlib.sha1(("%s|%s|%d" % (sha1, dateLimit, ratingLimit)).encode()).hexdigest()[:16]
+        return {"source": os.path.abspath(path),
+                "size": size,
+                "mtime": mtime,
+                "sha1": sha1,
+                "dateLimit": dateLimit,
+                "ratingLimit": ratingLimit,
+                "filtered": "filtered-%s.json" % name, # The decks passing the filters, not deduplicated
+                "results": {}, # "collection fingerprint/keep" -> the results file
+                "used": 0}
+
+    def add(self, entry):
+        """Add an entry whose filtered file is written
+        """
+        self.clock += 1
+        entry["used"] = self.clock
+        self.entries.append(entry)
+        while len(self.entries) > self.maxEntries:
+            self.remove(min(self.entries, key=lambda entry: entry["used"]))
+
+    def remove(self, entry):
+        """Remove an entry and its files
+        """
+        self.entries.remove(entry)
+        for name in [entry["filtered"]] + list(entry["results"].values()):
+            if os.path.exists(self.filePath(name)):
+                os.remove(self.filePath(name))
+
+    def resultsPath(self, entry, collectionFingerprint, dbDigest, keep, create=False):
+        """Return the results file of ENTRY scored against a collection, or None if there isn't one
+
+        Args:
+          entry: The entry
+          collectionFingerprint: Collection.fingerprint() of the collection
+          dbDigest: carddb.databaseDigest() of the card database the results are scored with
+          keep: The dedup policy
+          create: If True, register the file and return its path even if it doesn't exist
+        """
+        key = "%s/%s/%s" % (collectionFingerprint, dbDigest, keep)
+        name = entry["results"].get(key)
+        if name == None and create:
+            while len(entry["results"]) >= RESULTS_PER_ENTRY:
+                oldest = entry["results"].pop(next(iter(entry["results"])))
+                if os.path.exists(self.filePath(oldest)):
+                    os.remove(self.filePath(oldest))
+            name = entry["results"][key] = "results-%s-%s-%s-%s.json" % (entry["filtered"][9:-5], collectionFingerprint[:16], dbDigest[:8], keep)
+        if name == None or not (create or os.path.exists(self.filePath(name))):
+            return None
+        return self.filePath(name)
+
+    def save(self):
+        """Write the manifest
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        tmpPath = self.manifestPath + ".tmp"
+        with open (tmpPath, "wt") as f:
+            json.dump({"version": MANIFEST_VERSION, "clock": self.clock, "entries": self.entries}, f, indent=1)
+        os.replace(tmpPath, self.manifestPath)
@@ -0,0 +1,131 @@
+'''
+Canonical deck fingerprints and fingerprint deduplication
+
+'''
+
+import struct
+import hashlib
+from array import array
+
+def deckFingerprint(cards, cardClass):
+    """Return the 64-bit fingerprint of a deck
+    Only the multiset of cards and the class are hashed, so the deckstrings of
+    the same deck with another hero of the class, another card order or another
+    format get the same fingerprint. It's never 0.
+
+    Args:
+      cards: The deck in format [(card id, count)]
+      cardClass: The class of the deck, an int
+    """
+    pairs = sorted(cards)
+    values = [int(cardClass)]
+    for cardPair in pairs:
+        values.append(cardPair[0])
+        values.append(cardPair[1])
+    key = struct.pack("<%dI" % len(values), *values)
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little") or 1
+
+def deckClass(deck, db_dbf):
+    """Return the class of a Deck by its hero, 0 if the hero is unknown
+    """
+    if deck.heroes and deck.heroes[0] in db_dbf:
+        return int(db_dbf[deck.heroes[0]].card_class)
+    return 0
+
+class IntHashSet:
+    """A set of non-zero 64-bit ints in a flat open addressing table
+    It takes 16 bytes or less per member, a set of python ints takes ~70.
+    """
+    def __init__(self, capacity=1024):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          capacity: The initial number of slots, rounded up to a power of 2
+        """
+        size = 8
+        while size < capacity:
+            size <<= 1
+        self.table = array('Q', bytes(8 * size)) # 0 means an empty slot
+        self.mask = size - 1
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def _slot(self, value):
+        """Return the slot holding VALUE, or the empty slot it goes into
+        """
+        table = self.table
+        mask = self.mask
+        i = (value ^ (value >> 29)) & mask
+        while True:
+            slot = table[i]
+            if slot == value or slot == 0:
+                return i
+            i = (i + 1) & mask
+
+    def __contains__(self, value):
+        return self.table[self._slot(value)] == value
+
+    def add(self, value):
+        """Add VALUE into the set
+
+        Returns:
+          added: False if VALUE is in the set already
+        """
+        i = self._slot(value)
+        if self.table[i] == value:
+            return False
+        self.table[i] = value
+        self.count += 1
+        if self.count * 2 > self.mask:
+            self._grow()
+        return True
+
+    def _grow(self):
+        old = self.table
+        self.table = array('Q', bytes(16 * len(old)))
+        self.mask = 2 * len(old) - 1
+        for value in old:
+            if value != 0:
+                self.table[self._slot(value)] = value
+
+def dedupByFingerprint(items, fingerprintOf, ratingOf, keep="first", stats=None):
+    """Drop the items whose fingerprint has already passed through
+
+    Args:
+      items: An iterable of items
+      fingerprintOf: A function returning the fingerprint of an item
+      ratingOf: A function returning the rating of an item, used if KEEP is "best"
+      keep: "first" keeps the first copy of a deck, the items are streamed.
+        "best" keeps the highest rated copy (the first one of the ties) at the
+        place of the first copy, all the kept items are held until the end.
+      stats: A Stats to count the dropped items in, or None
+    Yields:
+      item: The items kept
+    """
+    if keep == "first":
+        seen = IntHashSet()
+        for item in items:
+            if seen.add(fingerprintOf(item)):
+                yield item
+            elif stats != None:
+                stats.drop("duplicate")
+    elif keep == "best":
+        kept = []
+        position = {} # fingerprint -> position of its copy in kept
+        for item in items:
+            fingerprint = fingerprintOf(item)
+            pos = position.get(fingerprint)
+            if pos == None:
+                position[fingerprint] = len(kept)
+                kept.append(item)
+                continue
+            if stats != None:
+                stats.drop("duplicate")
+            if ratingOf(item) > ratingOf(kept[pos]):
+                kept[pos] = item
+        yield from kept
+    else:
+        raise ValueError("unknown keep policy: %s" % keep)
@@ -0,0 +1,152 @@
+'''
+A local stand-in of hearthpwn serving saved pages, to run the crawlers against
+
+'''
+
+import os
+import time
+import hashlib
+import argparse
+import threading
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "hearthpwn")
+ORIGIN = "http://www.hearthpwn.com"
+
+def fixtureFile(directory, path):
+    """Return the file serving url PATH: /decks?page=2 is decks@page=2.html
+    """
+    parts = urlsplit(path)
+    name = parts.path.strip('/') or "index"
+    if parts.query:
+        name += '@' + parts.query
+    return os.path.join(directory, name + ".html")
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # Keep-alive
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        server = self.server
+        location = server.redirects.get(self.path)
+        if location != None:
+            self.reply(301, b"moved", {"Location": location})
+            return
+        path = fixtureFile(server.directory, self.path)
+        if not os.path.isfile(path):
+            self.reply(404, b"not found")
+            return
+        with server.lock:
+            server.hits[self.path] = server.hits.get(self.path, 0) + 1
+            failing = server.hits[self.path] <= server.failures.get(self.path, 0)
+        if failing:
+            self.reply(503, b"try again later")
+            return
+        if server.delay > 0:
+            time.sleep(server.delay)
+        with open (path, "rb") as f:
+            body = f.read().replace(ORIGIN.encode(), server.baseUrl.encode())
+        mtime = int(os.path.getmtime(path))
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()[:16]
+        headers = {"ETag": etag, "Last-Modified": formatdate(mtime, usegmt=True)}
+        if self.notModified(etag, mtime):
+            self.reply(304, b"", headers)
+        else:
+            self.reply(200, body, headers)
+
+    def notModified(self, etag, mtime):
+        """Whether the conditional headers of the request match the file
+        """
+        ifNoneMatch = self.headers.get("If-None-Match")
+        if ifNoneMatch != None:
+            return etag in [tag.strip() for tag in ifNoneMatch.split(',')]
+        ifModifiedSince = self.headers.get("If-Modified-Since")
+        if ifModifiedSince != None:
+            try:
+                return mtime <= parsedate_to_datetime(ifModifiedSince).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def reply(self, status, body, headers={}):
+        with self.server.lock:
+            self.server.log.append((self.path, status, time.time()))
+        self.send_response(status)
+        if status != 304:
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class FixtureServer(ThreadingHTTPServer):
+    """Serve the saved pages of DIRECTORY on localhost, in a background thread
+    The absolute hearthpwn links in the pages are rewritten to the server.
+    Every response has an ETag and a Last-Modified, and the conditional
+    requests are answered with 304.
+    """
+    daemon_threads = True
+
+    def __init__(self, directory=FIXTURES, port=0, delay=0):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          directory: The saved pages, see fixtureFile()
+          port: The port to listen on, 0 for any free one
+          delay: Seconds to wait before every page served, to simulate a slow site
+        """
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", port), FixtureHandler)
+        self.directory = directory
+        self.delay = delay
+        self.baseUrl = "http://127.0.0.1:%d" % self.server_address[1]
+        self.log = [] # (path, status, time) of every response
+        self.hits = {} # path -> how many times it's requested
+        self.failures = {} # path -> how many of its first requests are answered with 503
+        self.redirects = {} # path -> the Location it's redirected to with 301
+        self.connections = 0 # How many connections are accepted
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve saved hearthpwn pages on localhost")
+    parser.add_argument("--directory", default=FIXTURES, help="the saved pages")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--delay", type=float, default=0, help="seconds to wait before every page served")
+    args = parser.parse_args(argv)
+    server = FixtureServer(args.directory, args.port, args.delay)
+    print ("Serving", args.directory, "at", server.baseUrl)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
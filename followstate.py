@@ -0,0 +1,157 @@
+'''
+State of following a growing deck json file between runs
+
+'''
+
+import os
+import json
+import hashlib
+from array import array
+from fingerprint import IntHashSet
+
+FOLLOW_VERSION = 1
+HEAD_BYTES = 4096 # The bytes at the start of the file hashed to notice a rewrite
+
+def headDigest(path, length):
+    """Return the sha1 of the first LENGTH bytes of PATH
+    """
+    with open (path, "rb") as f:
+        return hashlib.sha1(f.read(length)).hexdigest()
+
+class FollowState:
+    """How far a deck json file is processed, and what is kept of the decks read so far
+    The crawler only appends to the file, so a run reads the bytes after
+    offset only. The file is read from the start again if it's replaced (a
+    new inode), truncated or rewritten (the first bytes changed), or if the
+    filters, the collection or the card database differ from the last run.
+    Kept between the runs: the fingerprints of the decks kept (an IntHashSet
+    table, loaded without rehashing), the current top recommended decks and
+    the card counters of the reports. The scored results are appended to
+    a json lines file.
+    """
+    def __init__(self, directory):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          directory: Where the state files are kept
+        """
+        self.directory = directory
+        self.statePath = os.path.join(directory, "follow.json")
+        self.seenPath = os.path.join(directory, "fingerprints.bin")
+        self.resultsPath = os.path.join(directory, "results.json")
+        self.source = None # {"path", "dev", "inode", "offset", "head"} of the file followed
+        self.key = None # The filters, the collection fingerprint and the card database digest the state is built with
+        self.count = 0 # How many decks are kept, the seq of the next one
+        self.seen = IntHashSet() # The fingerprints of the decks kept
+        self.top = [] # The top recommended result dicts, each with its 'seq'
+        self.topKey = None # The recommendation filters of top
+        self.reports = None # The card counters, see heavyhitters.CardReports.getState()
+        try:
+            with open (self.statePath, "rt") as f:
+                state = json.load(f)
+            if state.get("version") == FOLLOW_VERSION:
+                self.source = state["source"]
+                self.key = state["key"]
+                self.count = state["count"]
+                self.top = state["top"]
+                self.topKey = state["topKey"]
+                self.reports = state["reports"]
+                table = array('Q')
+                with open (self.seenPath, "rb") as f:
+                    table.frombytes(f.read())
+                self.seen.table = table
+                self.seen.mask = len(table) - 1
+                self.seen.count = state["seen"]
+                # The files are written one by one, check they are of the same run
+                if len(table) - table.count(0) != state["seen"]:
+                    raise ValueError("the fingerprints don't match the state")
+                # Drop the results appended by a run that stopped before saving
+                resultsSize = os.path.getsize(self.resultsPath) if os.path.exists(self.resultsPath) else 0
+                if resultsSize < state["resultsSize"]:
+                    raise ValueError("the results are lost")
+                if resultsSize > state["resultsSize"]:
+                    with open (self.resultsPath, "r+b") as f:
+                        f.truncate(state["resultsSize"])
+        except (OSError, ValueError, KeyError):
+            self.reset()
+
+    def reset(self, key=None):
+        """Forget everything, the file is read from the start then
+        """
+        self.source = None
+        self.key = key
+        self.count = 0
+        self.seen = IntHashSet()
+        self.top = []
+        self.topKey = None
+        self.reports = None
+        if os.path.exists(self.resultsPath):
+            os.remove(self.resultsPath)
+
+    def startOffset(self, path, key):
+        """Return the offset to read PATH from, resetting the state if it can't go on from the last run
+
+        Args:
+          path: The deck json file
+          key: The filters, the collection fingerprint and the card database digest of this run, a json-able value
+        """
+        st = os.stat(path)
+        source = self.source
+        if self.key != key or source == None or source["path"] != os.path.abspath(path)\
+           or (source["dev"], source["inode"]) != (st.st_dev, st.st_ino) or st.st_size < source["offset"]\
+           or headDigest(path, min(HEAD_BYTES, source["offset"])) != source["head"]:
+            self.reset(key)
+            return 0
+        return source["offset"]
+
+    def readNewLines(self, path, offset):
+        """Read the complete lines of PATH after OFFSET, a line still being written is left for the next run
+
+        Returns:
+          lines: The new lines
+          offset: The offset after the last complete line
+        """
+        with open (path, "rb") as f:
+            f.seek(offset)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        return data[:end].decode("utf-8").splitlines(), offset + end
+
+    def advance(self, path, offset):
+        """Record that PATH is processed up to OFFSET
+        """
+        st = os.stat(path)
+        self.source = {"path": os.path.abspath(path), "dev": st.st_dev, "inode": st.st_ino,
+                       "offset": offset, "head": headDigest(path, min(HEAD_BYTES, offset))}
+
+    def appendResults(self, deckList):
+        """Append result dicts to the results file, without their 'deck' field
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with open (self.resultsPath, "at") as f:
+            for item in deckList:
+                json.dump(dict((field, value) for field, value in item.items() if field != 'deck'), f)
+                f.write('\n')
+
+    def save(self):
+        """Write the state files
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with open (self.seenPath + ".tmp", "wb") as f:
+            self.seen.table.tofile(f)
+        tmpPath = self.statePath + ".tmp"
+        with open (tmpPath, "wt") as f:
+            json.dump({"version": FOLLOW_VERSION,
+                       "source": self.source,
+                       "key": self.key,
+                       "count": self.count,
+                       "seen": len(self.seen),
+                       "resultsSize": os.path.getsize(self.resultsPath) if os.path.exists(self.resultsPath) else 0,
+                       "top": self.top,
+                       "topKey": self.topKey,
+                       "reports": self.reports}, f)
+        os.replace(self.seenPath + ".tmp", self.seenPath)
+        os.replace(tmpPath, self.statePath)
@@ -6,34 +6,100 @@
 # Use this file as a pyspider script
 # To crawl deck from http://www.hearthpwn.com/decks
 # Refer to http://docs.pyspider.org/en/latest/Quickstart/ for more details
+#
+# The crawl is incremental: crawlcheckpoint.CrawlCheckpoint remembers the decks
+# crawled, only new or updated decks are fetched, the index pages are followed
+# until one lists known decks only, and every request is conditional on the
+# ETag/Last-Modified of the last response.
+# Set HEARTHPWN_URL to crawl another site, eg. the local fixtureserver.py.
 
 from pyspider.libs.base_handler import *
+import os
 import re
+from crawlcheckpoint import CrawlCheckpoint, deckIdFromUrl
+
+BASE_URL = os.environ.get("HEARTHPWN_URL", "http://www.hearthpwn.com")
+CHECKPOINT = os.environ.get("HEARTHPWN_CHECKPOINT", "cache/crawl_checkpoint.json")
+
+def pageNumber(url):
+    match = re.search(r"[?&]page=(\d+)", url)
+    return int(match.group(1)) if match != None else 1
 
 class Handler(BaseHandler):
     crawl_config = {
     }
 
+    checkpoint = None
+
+    def getCheckpoint(self):
+        if Handler.checkpoint == None:
+            Handler.checkpoint = CrawlCheckpoint(CHECKPOINT)
+        return Handler.checkpoint
+
+    def crawlConditional(self, url, **kwargs):
+        """Crawl URL, conditional on the validators of its last response
+        The 304 responses are passed to the callback as well.
+        """
+        headers = self.getCheckpoint().conditionalHeaders(url)
+        self.crawl(url, headers=headers, **kwargs)
+
     @every(minutes=24 * 60)
     def on_start(self):
-        self.crawl('http://www.hearthpwn.com/decks', callback=self.index_page)
+        # The first index page changes every day, crawl it whatever its age is
+        self.crawlConditional(BASE_URL + '/decks', callback=self.index_page, force_update=True)
 
     @config(age=10 * 24 * 60 * 60)
+    @catch_status_code_error
     def index_page(self, response):
-        for each in response.doc('a[href^="http"]').items():
-            if re.match("http://www.hearthpwn.com/decks/", each.attr.href):
-                self.crawl(each.attr.href, callback=self.detail_page)
-            if re.match("http://www.hearthpwn.com/decks\?page=", each.attr.href):
-                self.crawl(each.attr.href, callback=self.index_page)
+        checkpoint = self.getCheckpoint()
+        if response.status_code == 304: # Not changed since the last crawl
+            return
+        if response.status_code != 200:
+            raise Exception("index page %s: HTTP %d" % (response.url, response.status_code))
+        checkpoint.storeValidators(response.url, response.headers)
+
+        decks = []
+        for row in response.doc('tr').items():
+            link = row('a[href^="' + BASE_URL + '/decks/"]')
+            if link:
+                epoch = row('abbr[data-epoch]').attr('data-epoch')
+                decks.append((link.attr.href, int(epoch) if epoch else None))
+        newDecks = checkpoint.newDecks(decks)
+        for url, updated in newDecks:
+            # The update time as itag makes pyspider fetch an updated deck again
+            self.crawlConditional(url, callback=self.detail_page, save={"updated": updated},
+                                  itag=str(updated) if updated != None else None)
+
+        # The decks are listed newest first, a page without new decks ends the crawl
+        if newDecks:
+            nextPage = pageNumber(response.url) + 1
+            for each in response.doc('a[href^="http"]').items():
+                if re.match(re.escape(BASE_URL) + "/decks\?page=", each.attr.href) and pageNumber(each.attr.href) == nextPage:
+                    self.crawlConditional(each.attr.href, callback=self.index_page, force_update=True)
+                    break
+        checkpoint.save()
+
+    def on_finished(self, response, task):
+        # Called by pyspider when the queue is empty, save the marks of the last detail pages
+        self.getCheckpoint().save()
 
     @config(priority=2)
+    @catch_status_code_error
     def detail_page(self, response):
+        checkpoint = self.getCheckpoint()
+        deckId = deckIdFromUrl(response.url)
+        if response.status_code == 304: # Known already, nothing new to emit
+            checkpoint.markSeen(deckId, response.save.get("updated"))
+            return
+        if response.status_code != 200:
+            raise Exception("deck page %s: HTTP %d" % (response.url, response.status_code))
+        details = [each for each in response.doc('[class="deck-details"]')('li').items()]
         new_dict = {"url": response.url,
                     "title": response.doc('title').text(),
                     "deckstring": [each.attr("data-clipboard-text") for each in response.doc('[data-ga-click-event-tracking-label="Top"]').items()][0],
-                    "date": [each for each in response.doc('[class="deck-details"]')('li').items()][-1].text(),
-                    "deck-type": [each for each in response.doc('[class="deck-details"]')('li').items()][0].text(),
-                    "archetype": [each for each in response.doc('[class="deck-details"]')('li').items()][1].text(),
+                    "date": details[-1].text(),
+                    "deck-type": details[0].text(),
+                    "archetype": details[1].text(),
                     "rating-sum": response.doc('[class="deck-rating-form"]').text()
                    }
         if response.doc('[class="is-std"]').text():
@@ -41,4 +107,6 @@ class Handler(BaseHandler):
         else:
             new_dict['type'] = 'Wild'
 
+        checkpoint.storeValidators(response.url, response.headers)
+        checkpoint.markSeen(deckId, response.save.get("updated"))
         return new_dict
@@ -0,0 +1,238 @@
+'''
+Streaming card counters for the most wanted and the useless card reports
+
+'''
+
+import heapq
+import operator
+import numpy as np
+from planner import deckWeight
+
+PRIME = (1 << 31) - 1
+
+class ExactCounter:
+    """Exact weighted counts of every key, the top keys are picked by partial selection
+    """
+    def __init__(self):
+        """Constructor
+        All the member vars are listed
+        """
+        self.counts = {} # key -> count, in the order the keys are first seen
+
+    def add(self, key, weight=1):
+        self.counts[key] = self.counts.get(key, 0) + weight
+
+    def estimate(self, key):
+        return self.counts.get(key, 0)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def top(self, k):
+        """Return the K (key, count) of the largest counts, largest first
+        The ties go to the key seen last, as reversed(sorted(...)) does.
+        """
+        return heapq.nlargest(k, reversed(self.counts.items()), key=operator.itemgetter(1))
+
+class SpaceSaving:
+    """Approximate top keys of an unbounded stream in CAPACITY counters (Metwally et al.)
+    A new key takes over the counter of the smallest count when all the counters
+    are used, so every count is at most the smallest count too large, and every
+    key counted more than total / CAPACITY is kept.
+    """
+    def __init__(self, capacity=1024):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          capacity: The number of counters
+        """
+        self.capacity = capacity
+        self.counts = {} # key -> count, an overestimate by at most errors[key]
+        self.errors = {} # key -> the count inherited from the key evicted
+        self.heap = [] # (count, key) of the counters, stale entries are skipped when popped
+        self.total = 0 # The total weight added
+
+    def add(self, key, weight=1):
+        self.total += weight
+        if key in self.counts:
+            self.counts[key] += weight
+            heapq.heappush(self.heap, (self.counts[key], key))
+        elif len(self.counts) < self.capacity:
+            self.counts[key] = weight
+            self.errors[key] = 0
+            heapq.heappush(self.heap, (weight, key))
+        else:
+            minimum, evicted = self.popMinimum()
+            del self.counts[evicted]
+            del self.errors[evicted]
+            self.counts[key] = minimum + weight
+            self.errors[key] = minimum
+            heapq.heappush(self.heap, (minimum + weight, key))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, key) for key, count in self.counts.items()]
+            heapq.heapify(self.heap)
+
+    def popMinimum(self):
+        """Pop the counter of the smallest count, skipping the stale heap entries
+        """
+        while True:
+            count, key = heapq.heappop(self.heap)
+            if self.counts.get(key) == count:
+                return count, key
+
+    def estimate(self, key):
+        """Return the count of KEY, an overestimate; 0 if it isn't kept
+        """
+        return self.counts.get(key, 0)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def top(self, k):
+        """Return the K (key, estimated count) of the largest counts, largest first
+        """
+        return heapq.nlargest(k, self.counts.items(), key=operator.itemgetter(1))
+
+class CountMinSketch:
+    """Approximate counts of any number of keys in a fixed DEPTH x WIDTH table (Cormode and Muthukrishnan)
+    A count is never too small, and too large by at most e / WIDTH of the total
+    weight with probability 1 - exp(-DEPTH).
+    """
+    def __init__(self, width=2048, depth=4, seed=1):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          width: The counters of a row
+          depth: The rows, each with its own hash function
+          seed: The seed of the hash functions
+        """
+        rng = np.random.RandomState(seed)
+        self.width = width
+        self.depth = depth
+        self.hashes = [(int(a), int(b)) for a, b in zip(rng.randint(1, PRIME, size=depth), rng.randint(0, PRIME, size=depth))] # Row hash (a * key + b) % PRIME % width
+        self.table = [[0] * width for row in range(depth)]
+        self.total = 0 # The total weight added
+
+    def add(self, key, weight=1):
+        width = self.width
+        for row, (a, b) in zip(self.table, self.hashes):
+            row[(a * key + b) % PRIME % width] += weight
+        self.total += weight
+
+    def estimate(self, key):
+        """Return the count of KEY, an overestimate
+        """
+        width = self.width
+        return min(row[(a * key + b) % PRIME % width] for row, (a, b) in zip(self.table, self.hashes))
+
+class CardReports:
+    """The most wanted and the useless cards, counted while the decks are scored
+    It's the streaming form of theMostWantedCards() and theUselessCards(): every
+    scored result dict is added once, and the reports are read at the end
+    without another pass over the deck list.
+    In "exact" mode the counts are exact, and the reports the same as the
+    functions'. In "approx" mode the memory is bounded whatever the corpus:
+    the lacked cards are kept in Space-Saving summaries and the already-have
+    counts in a Count-Min sketch, read for the cards of the collection.
+    """
+    def __init__(self, collection=None, mode="exact", weight=None, capacity=4096, width=2048, depth=4):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          collection: The card collection, its cards are the candidates of the useless report
+          mode: "exact" or "approx"
+          weight: None to count every deck once, or "rating" to weight a deck by its rating
+          capacity: The number of counters of a Space-Saving summary, approx mode only
+          width, depth: The size of the Count-Min sketch, approx mode only
+        """
+        if mode not in ("exact", "approx"):
+            raise ValueError("unknown mode: %s" % mode)
+        if weight not in (None, "rating"):
+            raise ValueError("unknown weight: %s" % weight)
+        self.collection = collection
+        self.mode = mode
+        self.weight = weight
+        if mode == "exact":
+            self.lackedOne = ExactCounter() # card -> decks lacking one copy
+            self.lackedTwo = ExactCounter() # card -> decks lacking two copies
+            self.totalLacked = ExactCounter() # card -> copies lacked in all decks
+            self.alreadyHave = ExactCounter() # card -> copies owned used in all decks
+        else:
+            self.lackedOne = SpaceSaving(capacity)
+            self.lackedTwo = SpaceSaving(capacity)
+            self.totalLacked = SpaceSaving(capacity)
+            self.alreadyHave = CountMinSketch(width, depth)
+        self.decks = 0 # How many decks are added
+
+    def deckWeight(self, item):
+        """The weight of a deck: 1, or planner.deckWeight() by rating
+        """
+        if self.weight == "rating":
+            return deckWeight(item)
+        return 1
+
+    def add(self, item):
+        """Count the lacked and already-have cards of a scored result dict
+        """
+        weight = self.deckWeight(item)
+        self.decks += 1
+        if weight == 0:
+            return
+        for cardPair in item['lacked']:
+            self.totalLacked.add(cardPair[0], cardPair[1] * weight)
+            if cardPair[1] == 1:
+                self.lackedOne.add(cardPair[0], weight)
+            else:
+                self.lackedTwo.add(cardPair[0], weight)
+        for cardPair in item['alreadyHave']:
+            self.alreadyHave.add(cardPair[0], cardPair[1] * weight)
+
+    def addAll(self, deckList):
+        for item in deckList:
+            self.add(item)
+
+    def getState(self):
+        """Return the counters as a json-able dict, exact mode only
+        """
+        if self.mode != "exact":
+            raise ValueError("only the exact counters can be saved")
+        return {"weight": self.weight, "decks": self.decks,
+                "lackedOne": list(self.lackedOne.counts.items()),
+                "lackedTwo": list(self.lackedTwo.counts.items()),
+                "totalLacked": list(self.totalLacked.counts.items()),
+                "alreadyHave": list(self.alreadyHave.counts.items())}
+
+    def setState(self, state):
+        """Restore the counters saved by getState(), the decks added later are counted on top of them
+        """
+        if self.mode != "exact" or state["weight"] != self.weight:
+            raise ValueError("the counters are saved with another mode or weight")
+        self.decks = state["decks"]
+        for name in ("lackedOne", "lackedTwo", "totalLacked", "alreadyHave"):
+            getattr(self, name).counts = dict((card, count) for card, count in state[name])
+
+    def mostWanted(self, top=10):
+        """Return the most wanted cards, as theMostWantedCards() does but only the TOP of every list
+
+        Returns:
+          lackedOne, lackedTwo, totalLacked: Card pair lists, largest first
+        """
+        return self.lackedOne.top(top), self.lackedTwo.top(top), self.totalLacked.top(top)
+
+    def useless(self, top=10):
+        """Return the least used cards, as theUselessCards() does but only the TOP of them
+
+        Returns:
+          cardPairs: A list of (card id, times used), least used first
+        """
+        if self.mode == "exact":
+            cardPairs = list(self.alreadyHave.counts.items())
+            if self.collection != None:
+                cardPairs += [(card, 0) for card in self.collection.collect_db if card not in self.alreadyHave]
+        else:
+            cards = list(self.collection.collect_db) if self.collection != None else []
+            cardPairs = [(card, self.alreadyHave.estimate(card)) for card in cards]
+        return heapq.nsmallest(top, cardPairs, key=operator.itemgetter(1))
@@ -0,0 +1,75 @@
+'''
+Incremental re-scoring of the deck list when the collection changes
+
+'''
+
+from deckAdvisor import calcArcaneDust
+from deckindex import DeckIndex
+
+class IncrementalScorer:
+    """Keep 'lacked', 'alreadyHave' and 'dust' of a deck list up to date with a collection
+    The scorer listens to the collection, and on every Collection.add() or
+    limitTo() only re-scores the decks containing the changed cards.
+    """
+    def __init__(self, collection, db_dbf, deckList=()):
+        """Constructor
+
+        Args:
+          collection: The card collection to follow
+          db_dbf: The all-cards database
+          deckList: The result dicts to keep up to date, the ones without
+            'lacked' calculated yet are scored when added
+        """
+        self.collection = collection
+        self.db_dbf = db_dbf
+        self.deckList = [] # The scored result dicts, a deck id is the position in it
+        self.index = DeckIndex() # card -> deck ids
+        for item in deckList:
+            self.add(item)
+        collection.addListener(self.rescoreCards)
+
+    def close(self):
+        """Stop following the collection
+        """
+        self.collection.removeListener(self.rescoreCards)
+
+    def add(self, item):
+        """Add a result dict into the scored list
+
+        Args:
+          item: A result dict, with at least the 'deck' field
+        Returns:
+          deckId: The id of the deck
+        """
+        deckId = len(self.deckList)
+        self.deckList.append(item)
+        if item.get('lacked') == None:
+            self.index.add(deckId, item['deck'].cards)
+            self.rescore(deckId)
+        else:
+            self.index.add(deckId, item['deck'].cards, item['lacked'])
+        return deckId
+
+    def rescore(self, deckId):
+        """Re-calculate the results of a deck in place
+
+        Args:
+          deckId: The id of the deck
+        """
+        item = self.deckList[deckId]
+        item["lacked"], item["alreadyHave"] = self.collection.calculateLacks(item['deck'].cards)
+        _, item["dust"] = calcArcaneDust(item["lacked"], self.db_dbf)
+        self.index.setLacked(deckId, item["lacked"])
+
+    def rescoreCards(self, cards):
+        """Re-score the decks containing any of CARDS
+
+        Args:
+          cards: The changed card ids
+        Returns:
+          deckIds: The ids of the re-scored decks
+        """
+        deckIds = self.index.decksContainingAny(cards)
+        for deckId in deckIds:
+            self.rescore(deckId)
+        return deckIds
@@ -0,0 +1,200 @@
+'''
+Budgeted crafting planner
+
+'''
+
+import heapq
+import itertools
+from batch import DUST_IN
+
+class CraftPlan:
+    """The result of planCrafts()
+    """
+    def __init__(self):
+        """Constructor
+        All the member vars are listed
+        """
+        self.crafts = {} # card id -> how many copies to craft
+        self.dust = 0 # The dust the crafts consume
+        self.completed = [] # The ids of the decks completed by the crafts, in the order they complete
+        self.weight = 0 # The total weight of the completed decks
+
+    def cardPairs(self):
+        """Return the crafts as a card pair list, sorted by card id
+        """
+        return sorted(self.crafts.items())
+
+def deckWeight(item):
+    """The default deck weight: its 'rating-sum', 1 if it's unknown, 0 if it's negative
+    """
+    rating = item.get('rating-sum')
+    if not isinstance(rating, int):
+        return 1
+    return max(rating, 0)
+
+def planCrafts(deckList, db_dbf, budget, weight=deckWeight):
+    """Choose the cards to craft within BUDGET that complete the most decks, weighted by WEIGHT
+    Lazy greedy: every incomplete deck is a candidate whose cost is the dust still
+    needed for its lacked cards, and whose gain is the weight of all the decks
+    completed by crafting them. Candidates wait in a heap keyed by an upper
+    bound of their gain/cost ratio, see gainBound(), and the exact gain is
+    recomputed only when a candidate reaches the top; ties go to the lowest
+    deck id. Every craft updates the per-deck completion counters and
+    remaining costs of the decks lacking the crafted cards only. A craft can
+    raise the gain of other candidates: theirs if it makes them cheaper, and
+    the gain of every candidate lacking all the cards a deck still needs after
+    the craft shrinks it. These are pushed again with a new bound, so the key
+    of every candidate stays an upper bound and the plan is the greedy one.
+    To find the decks completed along with a candidate cheaply, every deck is
+    anchored on its two least common uncovered cards (one if it lacks only one):
+    a deck can only be completed by crafts that include its anchor.
+
+    Args:
+      deckList: A list of dict produced by calculateLacksFromJSONFile() or calculateLacksFromFile()
+      db_dbf: The all-cards database
+      budget: The dust that can be spent
+      weight: A function returning the weight of a deck dict
+    Returns:
+      plan: A CraftPlan, its deck ids are positions in deckList
+    """
+    plan = CraftPlan()
+    cost = {} # card id -> dust to craft one copy, the same as calcArcaneDust()
+    need = {} # deck id -> {card id: lacked count}
+    uncovered = {} # deck id -> the lacked card ids not crafted enough yet
+    remainingCost = {} # deck id -> the dust still needed to complete the deck
+    weights = {} # deck id -> weight
+    postings = {} # card id -> [(deck id, lacked count)]
+    for deckId, item in enumerate(deckList):
+        if not item['lacked']:
+            continue
+        w = weight(item)
+        if w <= 0:
+            continue
+        weights[deckId] = w
+        need[deckId] = dict(item['lacked'])
+        uncovered[deckId] = set(need[deckId])
+        remainingCost[deckId] = 0
+        for card, count in item['lacked']:
+            if card not in cost:
+                cost[card] = DUST_IN.get(db_dbf[card].rarity, 0)
+            remainingCost[deckId] += cost[card] * count
+            postings.setdefault(card, []).append((deckId, count))
+
+    anchors = {} # anchor -> the ids of the decks anchored on it
+    anchorWeight = {} # anchor -> the total weight of the decks anchored on it
+    anchorOf = {} # deck id -> its anchor, a sorted tuple of one or two card ids
+    def anchor(deckId):
+        cards = sorted(uncovered[deckId], key=lambda card: len(postings[card]))[:2]
+        key = tuple(sorted(cards))
+        anchors.setdefault(key, set()).add(deckId)
+        anchorWeight[key] = anchorWeight.get(key, 0) + weights[deckId]
+        anchorOf[deckId] = key
+
+    def anchorsWithin(cards):
+        """All the anchors made of the card ids CARDS
+        """
+        cards = sorted(cards)
+        return itertools.chain(((card,) for card in cards), itertools.combinations(cards, 2))
+    for deckId in need:
+        anchor(deckId)
+
+    def gainOf(deckId):
+        """The weight of the decks completed by crafting what deck DECKID still needs
+        """
+        target = {card: need[deckId][card] for card in uncovered[deckId]}
+        size = len(target)
+        gain = 0
+        for key in anchorsWithin(target):
+            for other in anchors.get(key, ()):
+                cards = uncovered[other]
+                if len(cards) <= size:
+                    otherNeed = need[other]
+                    if all(target.get(c, 0) >= otherNeed[c] for c in cards):
+                        gain += weights[other]
+        return gain
+
+    def gainBound(deckId):
+        """An upper bound of gainOf(DECKID), every deck it counts is anchored within the cards
+        """
+        return sum(anchorWeight.get(key, 0) for key in anchorsWithin(uncovered[deckId]))
+
+    def ratio(gain, dust):
+        return gain / dust if dust > 0 else float("inf")
+
+    heap = [(-ratio(gainBound(deckId), remainingCost[deckId]), deckId, remainingCost[deckId]) for deckId in need]
+    heapq.heapify(heap)
+
+    while heap:
+        key, deckId, dust = heapq.heappop(heap)
+        if not uncovered[deckId] or dust != remainingCost[deckId]:
+            continue # Completed already, or a stale entry re-pushed with a new cost
+        if dust > budget - plan.dust:
+            continue # Pushed again if crafts for other decks make it cheaper
+        gain = gainOf(deckId)
+        current = -ratio(gain, dust)
+        if heap and (current, deckId) > heap[0][:2]:
+            heapq.heappush(heap, (current, deckId, dust)) # Not the best one any more
+            continue
+        if gain <= 0:
+            break
+
+        # Craft the cards deck DECKID still needs
+        plan.dust += dust
+        reanchor = set()
+        shrunk = set() # The decks some of whose cards are crafted enough
+        repush = set() # The candidates whose gain or cost may have changed
+        for card in list(uncovered[deckId]):
+            before = plan.crafts.get(card, 0)
+            after = need[deckId][card]
+            plan.crafts[card] = after
+            for other, count in postings[card]:
+                if card not in uncovered[other]:
+                    continue
+                if count <= after:
+                    uncovered[other].discard(card)
+                    shrunk.add(other)
+                    remainingCost[other] -= cost[card] * (count - before)
+                    key = anchorOf.get(other)
+                    if key != None and card in key:
+                        anchors[key].discard(other)
+                        anchorWeight[key] -= weights[other]
+                        anchorOf.pop(other)
+                        reanchor.add(other)
+                else:
+                    remainingCost[other] -= cost[card] * (after - before)
+                if not uncovered[other]:
+                    plan.completed.append(other)
+                    plan.weight += weights[other]
+                elif other != deckId:
+                    repush.add(other)
+        for other in reanchor:
+            if uncovered[other]:
+                anchor(other)
+        # The candidates that may complete a shrunk deck now lack all of its cards, its rarest one in particular
+        for other in shrunk:
+            if uncovered[other]:
+                rarest = min(uncovered[other], key=lambda card: len(postings[card]))
+                for candidate, count in postings[rarest]:
+                    if rarest in uncovered[candidate] and count >= need[other][rarest]:
+                        repush.add(candidate)
+        for other in repush:
+            heapq.heappush(heap, (-ratio(gainBound(other), remainingCost[other]), other, remainingCost[other]))
+    return plan
+
+def outputCraftPlan(plan, db, deckList):
+    """Print a CraftPlan
+
+    Args:
+      plan: The CraftPlan to print
+      db: The all cards' database
+      deckList: The deck list the plan is made from
+    """
+    print ("========")
+    print ("Craft plan, dust:", plan.dust, ",  decks completed:", len(plan.completed), ",  weight:", plan.weight)
+    for cardPair in plan.cardPairs():
+        card = db[cardPair[0]]
+        print (cardPair[1], 'x ('+str(card.cost)+')', card.name, ":", card.rarity)
+    print ("Completed decks:")
+    for deckId in plan.completed:
+        item = deckList[deckId]
+        print (item['name'], ",  rating:", item['rating-sum'], ",  url:", item['url'])
@@ -0,0 +1,165 @@
+'''
+Columnar, memory-mappable store of scored deck results
+
+'''
+
+import os
+import json
+import mmap
+import struct
+import numpy as np
+
+STORE_MAGIC = b"DARS"
+STORE_VERSION = 1
+# magic, version, length of the json column table that follows
+HEADER = struct.Struct("<4sII")
+ALIGN = 8
+
+RATING_UNKNOWN = np.iinfo(np.int32).min # 'rating-sum' is "Unknown"
+CLASS_UNKNOWN = -1 # 'cardclass' is None
+
+# Column name -> dtype
+COLUMNS = [("deckstringOffsets", "<i8"), # deck i is deckstringBytes[offsets[i]:offsets[i+1]]
+           ("deckstringBytes", "u1"),
+           ("dust", "<i4"),
+           ("rating", "<i4"),
+           ("cardclass", "<i2"),
+           ("format", "i1"), # FormatType of the deck
+           ("date", "<i4"), # YYYYMMDD, 0 if unknown
+           ("lackedIndptr", "<i8"), # The lacked cards of deck i, in CSR form
+           ("lackedCards", "<i4"),
+           ("lackedCounts", "i1")]
+
+def dateToInt(date):
+    """Convert a M/D/YYYY date string into an int YYYYMMDD, 0 if it can't be parsed
+    """
+    try:
+        month, day, year = [int(x) for x in date.split('/')]
+    except (ValueError, AttributeError):
+        return 0
+    return year * 10000 + month * 100 + day
+
+def writeResultStore(path, deckList):
+    """Write the scored results into a columnar store file
+
+    Args:
+      path: The store file to write
+      deckList: A list (or any iterable) of result dicts
+    """
+    deckstrings = bytearray()
+    offsets = [0]
+    columns = {"dust": [], "rating": [], "cardclass": [], "format": [], "date": []}
+    indptr = [0]
+    lackedCards = []
+    lackedCounts = []
+    for item in deckList:
+        deckstrings += item['deckstring'].strip().encode()
+        offsets.append(len(deckstrings))
+        columns["dust"].append(item['dust'])
+        rating = item['rating-sum']
+        columns["rating"].append(rating if isinstance(rating, int) else RATING_UNKNOWN)
+        cardClass = item.get('cardclass')
+        columns["cardclass"].append(int(cardClass) if cardClass != None else CLASS_UNKNOWN)
+        columns["format"].append(int(item['deck'].format))
+        columns["date"].append(dateToInt(item['date']))
+        for cardPair in item['lacked']:
+            lackedCards.append(cardPair[0])
+            lackedCounts.append(cardPair[1])
+        indptr.append(len(lackedCards))
+
+    arrays = dict((name, np.asarray(columns[name], dtype=dtype)) for name, dtype in COLUMNS if name in columns)
+    arrays["deckstringOffsets"] = np.asarray(offsets, dtype="<i8")
+    arrays["deckstringBytes"] = np.frombuffer(bytes(deckstrings), dtype="u1")
+    arrays["lackedIndptr"] = np.asarray(indptr, dtype="<i8")
+    arrays["lackedCards"] = np.asarray(lackedCards, dtype="<i4")
+    arrays["lackedCounts"] = np.asarray(lackedCounts, dtype="i1")
+
+    # The column table needs the offsets, which depend on the table's length:
+    # reserve enough room for it first.
+    table = {"count": len(offsets) - 1, "columns": {}}
+    for name, dtype in COLUMNS:
+        table["columns"][name] = {"dtype": dtype, "offset": 2**62, "length": len(arrays[name])}
+    tableLength = len(json.dumps(table).encode())
+    offset = HEADER.size + tableLength
+    for name, dtype in COLUMNS:
+        offset = (offset + ALIGN - 1) // ALIGN * ALIGN
+        table["columns"][name]["offset"] = offset
+        offset += arrays[name].nbytes
+    tableBytes = json.dumps(table).encode().ljust(tableLength)
+
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    tmpPath = path + ".tmp"
+    with open (tmpPath, "wb") as f:
+        f.write(HEADER.pack(STORE_MAGIC, STORE_VERSION, tableLength))
+        f.write(tableBytes)
+        for name, dtype in COLUMNS:
+            f.write(b"\0" * (table["columns"][name]["offset"] - f.tell()))
+            f.write(arrays[name].tobytes())
+    os.replace(tmpPath, path)
+
+class ResultStore:
+    """A read-only view of a store file written by writeResultStore()
+    Every column is a numpy array mapped from the file, nothing is parsed
+    until it's accessed.
+    """
+    def __init__(self, path):
+        """Constructor
+
+        Args:
+          path: The store file to open
+        """
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, tableLength = HEADER.unpack_from(self._mm, 0)
+        if magic != STORE_MAGIC or version != STORE_VERSION:
+            self.close()
+            raise ValueError("not a result store file: %s" % path)
+        table = json.loads(bytes(self._mm[HEADER.size:HEADER.size+tableLength]))
+        self.count = table["count"]
+        self.columns = {}
+        for name, column in table["columns"].items():
+            self.columns[name] = np.frombuffer(self._mm, dtype=column["dtype"],
+                                               count=column["length"], offset=column["offset"])
+
+    def __getattr__(self, name):
+        columns = self.__dict__.get("columns")
+        if columns != None and name in columns:
+            return columns[name]
+        raise AttributeError(name)
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        """Unmap the store file
+        """
+        self.columns = {}
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def deckstring(self, i):
+        """Return the deckstring of deck I
+        """
+        offsets = self.columns["deckstringOffsets"]
+        return self.columns["deckstringBytes"][offsets[i]:offsets[i+1]].tobytes().decode()
+
+    def lacked(self, i):
+        """Return the lacked cards of deck I in format [(card id, count)]
+        """
+        indptr = self.columns["lackedIndptr"]
+        start, end = indptr[i], indptr[i+1]
+        return list(zip(self.columns["lackedCards"][start:end].tolist(),
+                        self.columns["lackedCounts"][start:end].tolist()))
@@ -0,0 +1,201 @@
+'''
+Similar deck search over card multisets with MinHash and LSH banding
+
+'''
+
+import numpy as np
+from hearthstone.deckstrings import Deck
+
+PRIME = (1 << 31) - 1
+MAX_COPIES = 4 # Copies of a card beyond it are not told apart
+
+def deckTokens(cards):
+    """Return the multiset of a deck as a set of token ids: copy k of card c is c * MAX_COPIES + k
+
+    Args:
+      cards: The cards in format [(card id, count)]
+    """
+    return np.array([cardPair[0] * MAX_COPIES + k for cardPair in cards for k in range(min(cardPair[1], MAX_COPIES))],
+                    dtype=np.uint64)
+
+def multisetJaccard(cardsA, cardsB):
+    """Return the exact Jaccard similarity of two decks as card multisets
+    """
+    a = dict(cardsA)
+    b = dict(cardsB)
+    inter = sum(min(count, b.get(card, 0)) for card, count in a.items())
+    union = sum(a.values()) + sum(b.values()) - inter
+    return inter / union if union > 0 else 1.0
+
+class SimilarityIndex:
+    """MinHash signatures of decks, searchable with LSH banding
+    The signature of a deck is its token minimizing each of numPerm hash
+    functions, so two decks agree on a signature row with the probability of
+    their Jaccard similarity, and the rows a collection owns estimate how much
+    of a deck it contains.
+    Every band of rows is hashed into a key; the keys of every band are kept
+    sorted for binary search, with the decks added since the last sort in an
+    unsorted tail, so decks can be added while they are ingested.
+    """
+    def __init__(self, numPerm=64, bands=16, seed=1):
+        """Constructor
+        All the member vars are listed
+
+        Args:
+          numPerm: The number of hash functions, ie. the signature length
+          bands: The number of LSH bands, it must divide numPerm. With r = numPerm/bands
+            rows a band, decks of Jaccard similarity s share a band with probability
+            1 - (1 - s^r)^bands, about 50% at s = (1/bands)^(1/r).
+          seed: The seed of the hash functions
+        """
+        if numPerm % bands != 0:
+            raise ValueError("bands must divide numPerm")
+        rng = np.random.RandomState(seed)
+        self.numPerm = numPerm
+        self.bands = bands
+        self.rows = numPerm // bands
+        self.a = rng.randint(1, PRIME, size=numPerm).astype(np.uint64)
+        self.b = rng.randint(0, PRIME, size=numPerm).astype(np.uint64)
+        self.mix = (rng.randint(1, 1 << 62, size=self.rows).astype(np.uint64) << np.uint64(1)) | np.uint64(1)
+        self.signatures = np.zeros((0, numPerm), dtype=np.uint32) # deck id -> signature
+        self.keys = np.zeros((0, bands), dtype=np.uint64) # deck id -> band keys
+        self.pending = [] # The (signature, keys) added after the arrays are built
+        self.sortedKeys = [np.zeros(0, dtype=np.uint64)] * bands # band -> the keys of the sorted decks, sorted
+        self.sortedIds = [np.zeros(0, dtype=np.int64)] * bands # band -> the deck ids in the order of sortedKeys
+        self.sortedCount = 0 # The decks [0, sortedCount) are in sortedKeys
+
+    def __len__(self):
+        return len(self.signatures) + len(self.pending)
+
+    def signature(self, cards):
+        """Return the MinHash signature of a deck, the tokens minimizing every hash function
+
+        Args:
+          cards: The cards in format [(card id, count)]
+        """
+        tokens = deckTokens(cards)
+        if len(tokens) == 0:
+            return np.zeros(self.numPerm, dtype=np.uint32)
+        hashes = (self.a[:, None] * tokens[None, :] + self.b[:, None]) % np.uint64(PRIME)
+        return tokens[hashes.argmin(axis=1)].astype(np.uint32)
+
+    def bandKeys(self, signatures):
+        """Return the band keys of signatures, an array of shape (n, bands)
+        """
+        rows = signatures.reshape(len(signatures), self.bands, self.rows).astype(np.uint64)
+        return (rows * self.mix).sum(axis=2, dtype=np.uint64)
+
+    def add(self, cards):
+        """Add a deck, and return its id: the number of decks added before it
+
+        Args:
+          cards: The cards in format [(card id, count)]
+        """
+        signature = self.signature(cards)
+        self.pending.append((signature, self.bandKeys(signature[None, :])[0]))
+        return len(self) - 1
+
+    def _flush(self):
+        """Move the pending decks into the arrays, and sort the keys if the unsorted tail is large
+        """
+        if self.pending:
+            self.signatures = np.vstack([self.signatures] + [signature[None, :] for signature, keys in self.pending])
+            self.keys = np.vstack([self.keys] + [keys[None, :] for signature, keys in self.pending])
+            self.pending = []
+        if len(self.signatures) - self.sortedCount > max(1024, self.sortedCount // 4):
+            for band in range(self.bands):
+                order = np.argsort(self.keys[:, band], kind="stable")
+                self.sortedKeys[band] = self.keys[order, band]
+                self.sortedIds[band] = order
+            self.sortedCount = len(self.signatures)
+
+    def candidates(self, signature):
+        """Return the sorted ids of the decks sharing at least a band with SIGNATURE
+        """
+        self._flush()
+        keys = self.bandKeys(signature[None, :])[0]
+        found = []
+        for band in range(self.bands):
+            sortedKeys = self.sortedKeys[band]
+            lo = np.searchsorted(sortedKeys, keys[band], side="left")
+            hi = np.searchsorted(sortedKeys, keys[band], side="right")
+            found.append(self.sortedIds[band][lo:hi])
+        tail = self.keys[self.sortedCount:]
+        found.append(np.nonzero((tail == keys).any(axis=1))[0] + self.sortedCount)
+        return np.unique(np.concatenate(found))
+
+    def similar(self, cards, top=10, minSimilarity=0.0, exclude=()):
+        """Find the decks most similar to a deck
+
+        Args:
+          cards: The deck in format [(card id, count)]
+          top: The number of decks to return
+          minSimilarity: Ignore the decks whose estimated similarity is smaller
+          exclude: The deck ids to leave out, eg. the deck itself
+        Returns:
+          decks: A list of (deck id, estimated Jaccard similarity), most similar first
+        """
+        signature = self.signature(cards)
+        ids = self.candidates(signature)
+        if exclude:
+            ids = ids[~np.isin(ids, list(exclude))]
+        scores = (self.signatures[ids] == signature).mean(axis=1)
+        keep = scores >= minSimilarity
+        ids, scores = ids[keep], scores[keep]
+        order = np.lexsort((ids, -scores))[:top]
+        return [(int(ids[i]), float(scores[i])) for i in order]
+
+    def similarToDeckstring(self, deckstring, top=10, minSimilarity=0.0):
+        """The same as similar(), for a deckstring
+        """
+        return self.similar(Deck.from_deckstring(deckstring).cards, top, minSimilarity)
+
+    def closestToCollection(self, collection, top=10):
+        """Find the decks a collection owns the largest part of
+        The part is estimated by the signature rows owned by the collection. It's
+        a vectorized scan of all the signatures, the collection can't be banded.
+
+        Args:
+          collection: A Collection
+          top: The number of decks to return
+        Returns:
+          decks: A list of (deck id, estimated owned part of the deck), largest first
+        """
+        self._flush()
+        if len(self.signatures) == 0:
+            return []
+        owned = deckTokens(list(collection.collect_db.items())).astype(np.uint32)
+        scores = np.isin(self.signatures, owned).mean(axis=1)
+        top = min(top, len(scores))
+        ids = np.argpartition(-scores, top - 1)[:top]
+        ids = ids[np.lexsort((ids, -scores[ids]))]
+        return [(int(i), float(scores[i])) for i in ids]
+
+def collapseNearDuplicates(deckList, threshold=0.8, top=None, numPerm=64, bands=32):
+    """Drop the decks whose card multiset is at least THRESHOLD similar to an earlier deck kept
+    The decks kept are added into a SimilarityIndex, and a deck is compared
+    exactly with the kept decks sharing a band with it only. With r = numPerm/bands
+    rows a band, a pair of similarity s shares a band with probability
+    1 - (1 - s^r)^bands, the default r = 2 misses a pair of s = 0.6 less than once in a million.
+    A deck dropped is always at least THRESHOLD similar to a deck kept, and
+    the copies of a deck are always dropped, they share every band.
+
+    Args:
+      deckList: A list (or any iterable) of result dicts, best first
+      threshold: The Jaccard similarity making a deck a near duplicate
+      top: Stop reading DECKLIST once this many decks are kept, or None
+      numPerm, bands: The signature length and the bands of the SimilarityIndex
+    Returns:
+      deckList: The decks kept, in the same order
+    """
+    index = SimilarityIndex(numPerm, bands)
+    kept = []
+    for item in deckList:
+        cards = item['deck'].cards
+        if any(multisetJaccard(cards, kept[i]['deck'].cards) >= threshold for i in index.candidates(index.signature(cards))):
+            continue
+        kept.append(item)
+        index.add(cards)
+        if top != None and len(kept) >= top:
+            break
+    return kept
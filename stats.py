@@ -0,0 +1,142 @@
+'''
+Per-stage timing and filter counters of an advisor run
+
+'''
+
+import os
+import json
+import time
+
+class _StageTimer:
+    """The context manager returned by Stats.stage()
+    """
+    def __init__(self, stats, name, records):
+        self.stats = stats
+        self.name = name
+        self.records = records
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.addTime(self.name, time.perf_counter() - self.wall, time.process_time() - self.cpu, self.records)
+
+class Stats:
+    """Collect the wall and CPU time of every stage, and the reasons decks are dropped
+    Nothing in the pipeline is instrumented unless a Stats object is passed in,
+    so a run without it pays (almost) nothing.
+    """
+    def __init__(self):
+        """Constructor
+        All the member vars are listed
+        """
+        self.stages = {} # stage name -> {"wall": seconds, "cpu": seconds, "records": count}
+        self.order = [] # The stage names, in the order they are first seen
+        self.drops = {} # drop reason -> how many decks are dropped for it
+        self.upstream = {} # stage name -> the stage whose time is included in it
+
+    def addTime(self, name, wall, cpu, records=None):
+        """Add WALL and CPU seconds (and RECORDS processed) to stage NAME
+        """
+        stage = self.stages.get(name)
+        if stage == None:
+            stage = self.stages[name] = {"wall": 0.0, "cpu": 0.0, "records": 0}
+            self.order.append(name)
+        stage["wall"] += wall
+        stage["cpu"] += cpu
+        if records != None:
+            stage["records"] += records
+
+    def stage(self, name, records=None):
+        """Return a context manager timing the code inside it as stage NAME
+
+        Args:
+          name: The stage name
+          records: The number of records the stage processes, if known
+        """
+        return _StageTimer(self, name, records)
+
+    def probe(self, iterable, name, upstream=None):
+        """Time the pulling of records from a pipeline stage
+        The time of a pipeline stage includes the stages before it, name the
+        previous probed stage as UPSTREAM to subtract its time in the report.
+
+        Args:
+          iterable: The stage to pull records from
+          name: The stage name
+          upstream: The name of the previous probed stage, or None
+        Yields:
+          The records of ITERABLE
+        """
+        if upstream != None:
+            self.upstream[name] = upstream
+        iterator = iter(iterable)
+        while True:
+            wall = time.perf_counter()
+            cpu = time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.addTime(name, time.perf_counter() - wall, time.process_time() - cpu)
+                return
+            self.addTime(name, time.perf_counter() - wall, time.process_time() - cpu, 1)
+            yield item
+
+    def drop(self, reason, count=1):
+        """Count decks dropped for REASON
+        """
+        self.drops[reason] = self.drops.get(reason, 0) + count
+
+    def merge(self, other):
+        """Add the times and counters of another Stats, eg. from a worker process
+        """
+        for name in other.order:
+            stage = other.stages[name]
+            self.addTime(name, stage["wall"], stage["cpu"], stage["records"])
+        for reason, count in other.drops.items():
+            self.drop(reason, count)
+        self.upstream.update(other.upstream)
+
+    def report(self):
+        """Return the stats as a dict, the stage times exclude their upstream stages
+        """
+        stages = []
+        for name in self.order:
+            stage = self.stages[name]
+            wall, cpu = stage["wall"], stage["cpu"]
+            upstream = self.stages.get(self.upstream.get(name))
+            if upstream != None:
+                wall -= upstream["wall"]
+                cpu -= upstream["cpu"]
+            stages.append({"stage": name,
+                           "wall": wall,
+                           "cpu": cpu,
+                           "records": stage["records"],
+                           "records_per_second": stage["records"] / wall if wall > 0 else None})
+        return {"stages": stages, "drops": dict(self.drops)}
+
+    def output(self):
+        """Print the stats summary
+        """
+        report = self.report()
+        print ("========")
+        print ("Stats:")
+        print ("%-16s %10s %10s %10s %12s" % ("stage", "wall(s)", "cpu(s)", "records", "records/s"))
+        for stage in report["stages"]:
+            rate = "%12.0f" % stage["records_per_second"] if stage["records_per_second"] and stage["records"] else "%12s" % "-"
+            print ("%-16s %10.4f %10.4f %10d %s" % (stage["stage"], stage["wall"], stage["cpu"], stage["records"], rate))
+        if report["drops"]:
+            print ("Dropped decks:")
+            for reason, count in sorted(report["drops"].items()):
+                print ("  %-16s %d" % (reason, count))
+
+    def writeJSON(self, path):
+        """Dump the stats into the json file PATH
+        """
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open (path, "wt") as f:
+            json.dump(self.report(), f, indent=1)